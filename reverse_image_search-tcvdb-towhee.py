@@ -1,3 +1,4 @@
+import asyncio
 import csv
 from glob import glob
 from pathlib import Path
@@ -5,7 +6,9 @@ import gradio as gr
 from towhee import pipe, ops, DataCollection
 
 # Towhee parameters
+from reverse_image_search.embedding_cache import EmbeddingCache
 from reverse_image_search.tcvdb_client import TcvdbClient
+from reverse_image_search.thumbnail_store import ThumbnailStore
 
 MODEL = 'resnet50'
 DEVICE = None  # if None, use default device (cuda is enabled if available)
@@ -22,6 +25,16 @@ USERNAME = 'root'
 # path to csv (column_1 indicates image path) OR a pattern of image paths
 INSERT_SRC = 'reverse_image_search.csv'
 
+# Directory of the on-disk embedding cache
+CACHE_DIR = './.embedding_cache'
+
+# Number of documents buffered by the insert operator before one upsert request
+UPSERT_BATCH_SIZE = 100
+
+# Directory of the thumbnails shown in the result gallery
+THUMBNAIL_DIR = './.thumbnails'
+thumbnail_store = ThumbnailStore(THUMBNAIL_DIR)
+
 # Load image path
 def load_image(x):
     if x.endswith('csv'):
@@ -35,9 +48,10 @@ def load_image(x):
             yield item
 
 
-def search_and_show_images(file_path):
+async def search_and_show_images(file_path):
     # 使用 `file_path` 进行搜索，返回结果的路径
-    results = p_search(file_path)  # 假设 `p_search` 是你的搜索函数
+    # The towhee pipeline blocks, it runs on the default executor so the event loop keeps serving other requests
+    results = await asyncio.get_running_loop().run_in_executor(None, p_search, file_path)
     # 从 'DataQueue' 对象中获取数据
     data = results.get()
 
@@ -52,7 +66,7 @@ def search_and_show_images(file_path):
     # '/root/image-search/reverse_image_search/train/minibus/n03769881_619.JPEG',
     # '/root/image-search/reverse_image_search/train/apiary/n02727426_948.JPEG']
     pred = data[1]
-    return pred
+    return await asyncio.get_running_loop().run_in_executor(None, thumbnail_store.thumbnails, pred)
 
 
 if __name__ == '__main__':
@@ -62,29 +76,33 @@ if __name__ == '__main__':
     # test_vdb.clear()  # 测试前清理环境
     # test_vdb.create_db_and_collection()
 
-    # Embedding pipeline
+    # Embedding pipeline, only images missing from the embedding cache are decoded and embedded
+    image_decode = ops.image_decode()
+    image_embedding = ops.image_embedding.timm(model_name=MODEL, device=DEVICE)
+    embedding_cache = EmbeddingCache(CACHE_DIR, model_key='towhee/image_embedding.timm/' + MODEL)
+
     p_embed = (
         pipe.input('src')
             .flat_map('src', 'img_path', load_image)
-            .map('img_path', 'img', ops.image_decode())
-            .map('img', 'vec', ops.image_embedding.timm(model_name=MODEL, device=DEVICE))
+            .map('img_path', 'vec', embedding_cache.cached(lambda img_path: image_embedding(image_decode(img_path))))
     )
 
     # Display embedding result, no need for implementation
-    p_display = p_embed.output('img_path', 'img', 'vec')
+    p_display = p_embed.map('img_path', 'img', ops.image_decode()).output('img_path', 'img', 'vec')
     DataCollection(p_display('./test/goldfish/*.JPEG')).show()
 
     # Insert pipeline
     p_insert = (
         p_embed.map(('img_path', 'vec'), 'mr', ops.local.tcvdb_client(
             host=HOST, port=PORT, key=PASSWORD, username=USERNAME,
-            collectionName=COLLECTION_NAME, dbName=DB_NAME
+            collectionName=COLLECTION_NAME, dbName=DB_NAME, batch_size=UPSERT_BATCH_SIZE
         ))
             .output('mr')
     )
 
     # Insert data
     p_insert(INSERT_SRC)
+    embedding_cache.flush()
 
     # Search pipeline
     p_search_pre = (
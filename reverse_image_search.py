@@ -1,4 +1,6 @@
 import csv
+import logging
+import time
 from glob import glob
 from pathlib import Path
 from statistics import mean
@@ -6,6 +8,10 @@ from statistics import mean
 from towhee import pipe, ops, DataCollection
 from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility
 
+from reverse_image_search.embedding_cache import EmbeddingCache
+from reverse_image_search.utils import chunked
+
+logger = logging.getLogger()
 
 # Towhee parameters
 MODEL = 'resnet50'
@@ -19,11 +25,20 @@ DIM = 2048 # dimension of embedding extracted by MODEL
 COLLECTION_NAME = 'reverse_image_search'
 INDEX_TYPE = 'IVF_FLAT'
 METRIC_TYPE = 'L2'
+INDEX_PARAMS = {'nlist': 2048}
+# Rows per insert request of the bulk load
+INSERT_BATCH_SIZE = 1000
+# 'bulk' drops and reloads COLLECTION_NAME, 'shadow' loads a new collection while searches keep using
+# the current one, then points the COLLECTION_NAME alias at it. Once shadow loaded, 'bulk' refuses to run
+LOAD_MODE = 'bulk'
 
 # path to csv (column_1 indicates image path) OR a pattern of image paths
 INSERT_SRC = 'reverse_image_search/reverse_image_search.csv'
 QUERY_SRC = 'test/*/*.JPEG'
 
+# Directory of the on-disk embedding cache
+CACHE_DIR = './.embedding_cache'
+
 
 # Load image path
 def load_image(x):
@@ -38,22 +53,46 @@ def load_image(x):
             yield item
 
 
-# Embedding pipeline
+# The towhee operators load the model weights, they are created on first use instead of at import
+_image_ops = None
+
+
+def image_ops():
+    global _image_ops
+    if _image_ops is None:
+        _image_ops = ops.image_decode(), ops.image_embedding.timm(model_name=MODEL, device=DEVICE)
+    return _image_ops
+
+
+def embed_image(img_path):
+    image_decode, image_embedding = image_ops()
+    return image_embedding(image_decode(img_path))
+
+
+# Embedding pipeline, only images missing from the embedding cache are decoded and embedded
+embedding_cache = EmbeddingCache(CACHE_DIR, model_key='towhee/image_embedding.timm/' + MODEL, dim=DIM)
+
+embed = embedding_cache.cached(embed_image)
+
 p_embed = (
     pipe.input('src')
         .flat_map('src', 'img_path', load_image)
-        .map('img_path', 'img', ops.image_decode())
-        .map('img', 'vec', ops.image_embedding.timm(model_name=MODEL, device=DEVICE))
+        .map('img_path', 'vec', embed)
 )
 
 
-# Display embedding result, no need for implementation
-p_display = p_embed.output('img_path', 'img', 'vec')
-DataCollection(p_display('./test/goldfish/*.JPEG')).show()
 
 
-# Create milvus collection (delete first if exists)
-def create_milvus_collection(collection_name, dim):
+# Names of the collections `alias` points at, empty when it is not an alias
+def aliased_collections(alias):
+    return [name for name in utility.list_collections() if alias in utility.list_aliases(name)]
+
+
+# Create milvus collection (delete first if exists), the index can be built after loading the data
+def create_milvus_collection(collection_name, dim, index=True):
+    if aliased_collections(collection_name):
+        # Dropping the collection behind it would break the searches, reloading goes through the alias swap
+        raise RuntimeError(f'{collection_name} is an alias created by a shadow load, use LOAD_MODE = "shadow"')
     if utility.has_collection(collection_name):
         utility.drop_collection(collection_name)
 
@@ -64,55 +103,111 @@ def create_milvus_collection(collection_name, dim):
     ]
     schema = CollectionSchema(fields=fields, description='reverse image search')
     collection = Collection(name=collection_name, schema=schema)
+    if index:
+        build_index(collection)
+    return collection
+
 
+def build_index(collection, poll_interval=5):
     index_params = {
         'metric_type': METRIC_TYPE,
         'index_type': INDEX_TYPE,
-        'params': {"nlist": 2048}
+        'params': INDEX_PARAMS
     }
     collection.create_index(field_name='embedding', index_params=index_params)
+    # Report the progress until every row is indexed
+    while True:
+        progress = utility.index_building_progress(collection.name)
+        print(f'Index building on {collection.name}: {progress["indexed_rows"]}/{progress["total_rows"]} rows')
+        if progress['indexed_rows'] >= progress['total_rows']:
+            break
+        time.sleep(poll_interval)
+    utility.wait_for_index_building_complete(collection.name)
+
+
+# Embed and insert all images in batches of `batch_size` rows, then flush the collection
+def bulk_insert(collection, src, batch_size=INSERT_BATCH_SIZE):
+    start = time.time()
+    inserted = 0
+    for paths in chunked(load_image(src), batch_size):
+        mr = collection.insert([paths, [embed(path) for path in paths]])
+        if mr.insert_count != len(paths):
+            raise RuntimeError(f'Insert to milvus failed: {mr.insert_count} of {len(paths)} rows from {paths[0]}')
+        inserted += mr.insert_count
+        print(f'Inserted {inserted} rows into {collection.name}, {inserted / (time.time() - start):.1f} rows/s')
+    embedding_cache.flush()
+    collection.flush()
+    return inserted
+
+
+# Create the collection without an index, load all data, then build the index once and load the collection
+def bulk_load(collection_name, src):
+    collection = create_milvus_collection(collection_name, DIM, index=False)
+    print(f'A new collection created: {collection_name}')
+    bulk_insert(collection, src)
+    build_index(collection)
+    collection.load()
     return collection
 
 
-# Connect to Milvus service
-connections.connect(host=HOST, port=PORT)
+# Bulk load a new collection while `alias` still serves searches, then swap the alias to it and drop the old one
+def shadow_load(alias, src):
+    previous = aliased_collections(alias)
+    collection = bulk_load(f'{alias}_{int(time.time())}', src)
+    if previous:
+        utility.alter_alias(collection.name, alias)
+    else:
+        if utility.has_collection(alias):
+            # A plain collection can't share its name with an alias, on this first migration it keeps serving
+            # until the new collection is loaded, the searches only fail between the drop and the alias creation
+            utility.drop_collection(alias)
+        utility.create_alias(collection.name, alias)
+    print(f'Alias {alias} now points at {collection.name}')
+    for name in previous:
+        utility.drop_collection(name)
+    return collection
 
-# Create collection
-collection = create_milvus_collection(COLLECTION_NAME, DIM)
-print(f'A new collection created: {COLLECTION_NAME}')
 
-# Insert pipeline
-p_insert = (
-        p_embed.map(('img_path', 'vec'), 'mr', ops.ann_insert.milvus_client(
-                    host=HOST,
-                    port=PORT,
-                    collection_name=COLLECTION_NAME
-                    ))
-          .output('mr')
-)
+if __name__ == '__main__':
+    # Load the model and embed one query image before any work is timed, the first batch is not slower than the next
+    warmup_image = next(load_image(QUERY_SRC), None)
+    if warmup_image is not None:
+        embed_image(warmup_image)
+    else:
+        logger.warning('No image matches %s, skipping the model warmup', QUERY_SRC)
 
-# Insert data
-p_insert(INSERT_SRC)
+    # Display embedding result, no need for implementation, only runs with debug logging enabled
+    if logger.isEnabledFor(logging.DEBUG):
+        p_display = p_embed.map('img_path', 'img', ops.image_decode()).output('img_path', 'img', 'vec')
+        DataCollection(p_display('./test/goldfish/*.JPEG')).show()
 
-# Check collection
-print('Number of data inserted:', collection.num_entities)
+    # Connect to Milvus service
+    connections.connect(host=HOST, port=PORT)
 
-# Search pipeline
-p_search_pre = (
-        p_embed.map('vec', ('search_res'), ops.ann_search.milvus_client(
-                    host=HOST, port=PORT, limit=TOPK,
-                    collection_name=COLLECTION_NAME))
-               .map('search_res', 'pred', lambda x: [str(Path(y[0]).resolve()) for y in x])
-#                .output('img_path', 'pred')
-)
-p_search = p_search_pre.output('img_path', 'pred')
+    # Create the collection and insert data
+    if LOAD_MODE == 'shadow':
+        collection = shadow_load(COLLECTION_NAME, INSERT_SRC)
+    else:
+        collection = bulk_load(COLLECTION_NAME, INSERT_SRC)
+
+    # Check collection
+    print('Number of data inserted:', collection.num_entities)
+
+    # Search pipeline
+    p_search_pre = (
+            p_embed.map('vec', ('search_res'), ops.ann_search.milvus_client(
+                        host=HOST, port=PORT, limit=TOPK,
+                        collection_name=COLLECTION_NAME))
+                   .map('search_res', 'pred', lambda x: [str(Path(y[0]).resolve()) for y in x])
+    #                .output('img_path', 'pred')
+    )
+    p_search = p_search_pre.output('img_path', 'pred')
 
-# Search for example query image(s)
-collection.load()
-dc = p_search('test/goldfish/*.JPEG')
+    # Search for example query image(s), the collection is already loaded
+    dc = p_search('test/goldfish/*.JPEG')
 
-# Display search results with image paths
-# DataCollection(dc).show()
+    # Display search results with image paths
+    # DataCollection(dc).show()
 
-for row in dc.get():
-    print(row)
\ No newline at end of file
+    for row in dc.get():
+        print(row)
@@ -1,3 +1,4 @@
+import threading
 import uuid
 import logging
 from towhee.operator import PyOperator, SharedType
@@ -7,57 +8,167 @@ from pymilvus import connections, Collection
 logger = logging.getLogger()
 
 
+class InsertError(RuntimeError):
+    """
+    A batch insert failed or was partially applied, the rows stay buffered for the next flush.
+    """
+
+    def __init__(self, collection_name, batch, rows, inserted=None, first_key=None):
+        self.collection_name = collection_name
+        self.batch = batch
+        self.rows = rows
+        self.inserted = inserted
+        self.first_key = first_key
+        super().__init__('Insert of batch %d (%d rows from %r) to milvus collection %s failed, %s rows inserted'
+                         % (batch, rows, first_key, collection_name, 'no' if inserted is None else inserted))
+
+
+# Connections shared by all operator instances, keyed by endpoint and credentials
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def _connect(host, port, uri, user, password, token):
+    """
+    Return the alias of the connection to a Milvus endpoint, opening it on first use.
+    """
+    key = (host, port, uri, user, password, token)
+    with _connections_lock:
+        alias = _connections.get(key)
+        if alias is None or not connections.has_connection(alias):
+            alias = uuid.uuid4().hex
+            if uri and token:
+                connections.connect(alias=alias, uri=uri, token=token, secure=True)
+            elif user and password:
+                connections.connect(alias=alias, host=host, port=port, user=user, password=password, secure=True)
+            else:
+                connections.connect(alias=alias, host=host, port=port)
+            _connections[key] = alias
+        return alias
+
+
 class MilvusClient(PyOperator):
     """
     Milvus ANN index class.
+
+    With `batch_size` > 1 rows are buffered as columns and inserted `batch_size` at a time, the
+    buffer is also flushed `max_delay` seconds after its first row, by `flush()` and when the
+    operator is deleted.
+
+    Args:
+        batch_size (`int`):
+            The number of rows per insert request, 1 inserts every row immediately.
+        max_delay (`float`):
+            The maximum number of seconds a row waits in the buffer.
     """
 
     def __init__(
-        self, host: str = 'localhost', port: int = 19530, collection_name: str = None,  uri: str = None, user: str = None, password: str = None, token: str = None
+        self, host: str = 'localhost', port: int = 19530, collection_name: str = None,  uri: str = None, user: str = None, password: str = None, token: str = None,
+        batch_size: int = 1, max_delay: float = 5.0
     ):
         self._host = host
         self._port = port
         self._uri = uri
         self._collection_name = collection_name
-        self._connect_name = uuid.uuid4().hex
-        if uri and token:
-            connections.connect(alias=self._connect_name, uri=self._uri, token=token, secure=True)
-        elif user and password:
-            connections.connect(alias=self._connect_name, host=self._host, port=self._port,
-                                user=user, password=password, secure=True)
-        else:
-            connections.connect(alias=self._connect_name, host=self._host, port=self._port)
-        
-    
+        self._connect_name = _connect(host, port, uri, user, password, token)
         self._collection = Collection(self._collection_name, using=self._connect_name)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._columns = None
+        self._count = 0
+        self._batches = 0
+        self._timer = None
+        self._lock = threading.Lock()
 
     def __call__(self, *data):
         """
-        Insert one row to Milvus.
+        Insert one row to Milvus, or add it to the buffer.
 
         Args:
         data (`list`):
             The data to insert into milvus.
 
         Returns:
-            A MutationResult object contains `insert_count` represents how many and a `primary_keys` of primary keys.
+            A MutationResult object contains `insert_count` represents how many and a `primary_keys` of primary keys,
+            of the batch inserted by this call, None if the row was only buffered.
 
         """
-        row = []
+        values = []
         for item in data:
             if isinstance(item, list):
-                row.extend([[i] for i in item])
+                values.extend(item)
             else:
-                row.append([item])
-        mr = self._collection.insert(row)
-        if mr.insert_count != len(row[0]):
-            raise RuntimeError("Insert to milvus failed")
+                values.append(item)
+        with self._lock:
+            if self._columns is None:
+                self._columns = [[] for _ in values]
+            if not self._count:
+                self._arm_timer()
+            for column, value in zip(self._columns, values):
+                column.append(value)
+            self._count += 1
+            if self._count >= self.batch_size:
+                return self._flush()
+        return None
+
+    def _arm_timer(self):
+        if self.batch_size > 1 and self.max_delay != float('inf'):
+            # Flush from a timer thread, so a partial batch is sent even if no more rows arrive
+            self._timer = threading.Timer(self.max_delay, self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """
+        Insert the buffered rows, returns the MutationResult of the last batch or None if the buffer was empty.
+        """
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        mr = None
+        try:
+            while self._count:
+                size = min(self._count, max(self.batch_size, 1))
+                batch = [column[:size] for column in self._columns]
+                self._batches += 1
+                try:
+                    mr = self._collection.insert(batch)
+                except Exception as e:  # pylint: disable=broad-except
+                    raise InsertError(self._collection_name, self._batches, size, first_key=batch[0][0]) from e
+                if mr.insert_count != size:
+                    raise InsertError(self._collection_name, self._batches, size, mr.insert_count, batch[0][0])
+                # Only drop a batch from the buffer once it was written
+                self._columns = [column[size:] for column in self._columns]
+                self._count -= size
+        finally:
+            # After a failed insert the rows left are retried by the timer, even if no more rows arrive
+            if self._count and self._timer is None:
+                self._arm_timer()
         return mr
 
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except InsertError:
+            # Nobody waits on the timer thread, `_flush` re-armed the timer for the rows still buffered
+            logger.exception('Failed to flush buffered rows to milvus')
+
     @property
     def shared_type(self):
         return SharedType.NotShareable
 
+    def __del__(self):
+        if not getattr(self, '_count', 0):
+            return
+        try:
+            self.flush()
+        except InsertError:
+            logger.exception('Failed to flush buffered rows to milvus')
+
     # def __del__(self):
     #     if connections.has_connection(self._connect_name):
     #         try:
@@ -1,7 +1,54 @@
-from pymilvus import connections, Collection
+from pymilvus import connections, Collection, MilvusException
 from towhee.operator import PyOperator, SharedType
+import logging
+import threading
 import uuid
 
+logger = logging.getLogger()
+
+# Maximum number of query vectors (nq) of one search request
+MAX_NQ = 16384
+
+# Connections shared by all operator instances, keyed by endpoint and credentials
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Collections loaded by this process, keyed by connection alias and collection name
+_loaded = set()
+_loaded_lock = threading.Lock()
+
+
+def _connect(host, port, uri, user, password, token):
+    """
+    Return the alias of the connection to a Milvus endpoint, opening it on first use.
+    """
+    key = (host, port, uri, user, password, token)
+    with _connections_lock:
+        alias = _connections.get(key)
+        if alias is None or not connections.has_connection(alias):
+            alias = uuid.uuid4().hex
+            if uri and token:
+                connections.connect(alias=alias, uri=uri, token=token, secure=True)
+            elif user and password:
+                connections.connect(alias=alias, host=host, port=port, user=user, password=password, secure=True)
+            else:
+                connections.connect(alias=alias, host=host, port=port)
+            _connections[key] = alias
+        return alias
+
+
+def _load(collection, alias, reload=False):
+    """
+    Load a collection into memory once per process, or again when `reload` after a failed search
+    (released or dropped and recreated by another client).
+    """
+    key = (alias, collection.name)
+    with _loaded_lock:
+        if key in _loaded and not reload:
+            return
+        collection.load()
+        _loaded.add(key)
+
 
 class MilvusClient(PyOperator):
     """
@@ -34,21 +81,13 @@ class MilvusClient(PyOperator):
         self._port = port
         self._uri = uri
         self._collection_name = collection_name
-        self._connect_name = uuid.uuid4().hex
-        if uri and token:
-            connections.connect(alias=self._connect_name, uri=self._uri, token=token, secure=True)
-        elif user and password:
-            connections.connect(alias=self._connect_name, host=self._host, port=self._port,
-                                user=user, password=password, secure=True)
-        else:
-            connections.connect(alias=self._connect_name, host=self._host, port=self._port)
-        
-    
-        self._collection = Collection(self._collection_name, using=self._connect_name)      
+        self._connect_name = _connect(host, port, uri, user, password, token)
+        self._collection = Collection(self._collection_name, using=self._connect_name)
 
         self.kwargs = kwargs
+        fields_schema = self._collection.schema.fields
+        self._primary_field = next((schema.name for schema in fields_schema if schema.is_primary), None)
         if 'anns_field' not in self.kwargs:
-            fields_schema = self._collection.schema.fields
             for schema in fields_schema:
                 if schema.dtype in (101, 100):
                     self.kwargs['anns_field'] = schema.name
@@ -82,21 +121,41 @@ class MilvusClient(PyOperator):
                 self.kwargs['param']['metric_type'] = 'L2'
 
     def __call__(self, query: 'ndarray'):
-        self._collection.load()
-        milvus_result = self._collection.search(
-            data=[query],
-            **self.kwargs
-        )
-
-        result = []
-        for hit in milvus_result[0]:
-            row = []
-            row.extend([hit.id, hit.score])
-            if 'output_fields' in self.kwargs:
-                for k in self.kwargs['output_fields']:
-                 row.append(hit.entity.get(k))
-            result.append(row)
-        return result
+        milvus_result = self._search([query])
+        return self._rows(milvus_result[0])
+
+    def search_many(self, queries):
+        """
+        Search many query vectors with one `collection.search` per `MAX_NQ` vectors.
+
+        Args:
+            queries (`np.ndarray` or `List[ndarray]`):
+                The query vectors, shape (N, D).
+
+        Returns:
+            N lists of [id, score, *output_fields] rows, in the order of `queries`.
+        """
+        results = []
+        for start in range(0, len(queries), MAX_NQ):
+            results.extend(self._rows(hits) for hits in self._search(list(queries[start:start + MAX_NQ])))
+        return results
+
+    def _search(self, data):
+        _load(self._collection, self._connect_name)
+        try:
+            return self._collection.search(data=data, **self.kwargs)
+        except MilvusException:
+            # The collection may have been released or recreated since it was loaded, load it and retry once
+            logger.warning('Search on %s failed, reloading the collection', self._collection_name, exc_info=True)
+            _load(self._collection, self._connect_name, reload=True)
+            return self._collection.search(data=data, **self.kwargs)
+
+    def _rows(self, hits):
+        # ids and distances are read as columns, only other output fields need the per-hit entities
+        output_fields = self.kwargs.get('output_fields') or []
+        if all(k == self._primary_field for k in output_fields):
+            return [[id, score] + [id] * len(output_fields) for id, score in zip(hits.ids, hits.distances)]
+        return [[hit.id, hit.score] + [hit.entity.get(k) for k in output_fields] for hit in hits]
 
     @property
     def shared_type(self):
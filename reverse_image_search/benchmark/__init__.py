@@ -0,0 +1,2 @@
+from reverse_image_search.benchmark.benchmark import bench_backend, bench_embed, bench_ingest, bench_search, \
+    cosine_drift, exact_truth, label_precision, latency_stats, recall_at_k
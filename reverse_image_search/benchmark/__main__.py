@@ -0,0 +1,105 @@
+"""
+Benchmark embedding, ingest and search, run from the `reverse_image_search` directory:
+
+    python -m reverse_image_search.benchmark --output benchmark.json
+
+Every backend, index setting and storage format is compared with exact search on the same
+embeddings, the report is a JSON file meant to be diffed between runs.
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+
+from torchvision.models import ResNet50_Weights
+
+from reverse_image_search.benchmark.benchmark import bench_backend, bench_embed, environment, exact_truth, \
+    load_paths, local_settings, write_report
+from reverse_image_search.embedding_cache import EmbeddingCache
+from reverse_image_search.local_vector_store import LocalVectorStore
+from reverse_image_search.resnet_embedding import ResnetEmbedding
+
+logger = logging.getLogger()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--insert-src', default='reverse_image_search.csv', help='csv or glob of indexed images')
+    parser.add_argument('--query-src', default='./test/*/*.JPEG', help='glob of query images')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3, help='passes over the queries per search setting')
+    parser.add_argument('--cache-dir', default='./.embedding_cache', help='embedding cache, "" disables it')
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--export-dir', default='', help='exported TorchScript models, "" runs the eager model')
+    parser.add_argument('--embed-images', type=int, default=256, help='images embedded per embed measurement, '
+                                                                      '0 skips the embed benchmark')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 64])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--ingest-batch-size', type=int, default=100)
+    parser.add_argument('--ivf-nlist', type=int, nargs='*', default=[16])
+    parser.add_argument('--nprobe', type=int, nargs='*', default=[1, 4, 8])
+    parser.add_argument('--hnsw-m', type=int, nargs='*', default=[16])
+    parser.add_argument('--ef-construction', type=int, default=200)
+    parser.add_argument('--ef', type=int, nargs='*', default=[16, 64])
+    parser.add_argument('--codecs', nargs='*', default=['float16', 'sq8', 'pq64'],
+                        help='compressed storage formats of the local store')
+    parser.add_argument('--rerank', type=int, nargs='*', default=[0, 50],
+                        help='candidates re-scored with float32 vectors, per codec')
+    parser.add_argument('--tcvdb-host', help='also benchmark this Tencent vector db, its collection gets upserted')
+    parser.add_argument('--tcvdb-port', default='10000')
+    parser.add_argument('--tcvdb-username', default='root')
+    parser.add_argument('--tcvdb-key')
+    parser.add_argument('--tcvdb-db', default='image-search')
+    parser.add_argument('--tcvdb-collection', default='reverse_image_search')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = load_paths(args.insert_src)
+    query_paths = load_paths(args.query_src)
+    report = {'environment': environment(), 'config': vars(args),
+              'dataset': {'images': len(paths), 'queries': len(query_paths)}}
+
+    embedding = ResnetEmbedding(weights=ResNet50_Weights.IMAGENET1K_V2, num_workers=args.num_workers,
+                                export_dir=args.export_dir or None)
+    # Cold start: loading (or exporting) the model and the first forward passes
+    report['warmup_s'] = embedding.warmup()
+    if args.embed_images:
+        report['embed'] = bench_embed(embedding, paths[:args.embed_images], args.batch_sizes, args.threads)
+    if args.cache_dir:
+        embedding.cache = EmbeddingCache(args.cache_dir, model_key=embedding.model_key)
+    features = embedding.extract(paths)
+    queries = embedding.extract(query_paths)
+    embedding.close()
+
+    truth = exact_truth(paths, features, queries, args.k)
+    report['backends'] = []
+    for name, store_kwargs, search_params in local_settings(args.ivf_nlist, args.nprobe, args.hnsw_m,
+                                                            args.ef_construction, args.ef, args.codecs, args.rerank):
+        workdir = tempfile.mkdtemp(prefix='bench-')
+        try:
+            store = LocalVectorStore(workdir, dim=features.shape[1], metric='COSINE', **store_kwargs)
+            report['backends'].append(bench_backend('local ' + name, store, paths, features, query_paths, queries,
+                                                    truth, args.k, args.ingest_batch_size, search_params, args.rounds))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.tcvdb_host:
+        # Only needs the tcvectordb SDK when asked for
+        from reverse_image_search.tcvdb_client import TcvdbClient
+
+        client = TcvdbClient(host=args.tcvdb_host, port=args.tcvdb_port, username=args.tcvdb_username,
+                             key=args.tcvdb_key, dbName=args.tcvdb_db, collectionName=args.tcvdb_collection,
+                             timeout=20)
+        report['backends'].append(bench_backend('tcvdb hnsw', client, paths, features, query_paths, queries, truth,
+                                                args.k, args.ingest_batch_size, rounds=args.rounds))
+
+    write_report(report, os.path.abspath(args.output))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
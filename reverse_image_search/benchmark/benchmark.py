@@ -0,0 +1,227 @@
+import csv
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from glob import glob
+
+import numpy as np
+
+from reverse_image_search.local_vector_store import HnswIndex, IvfIndex, LocalVectorStore
+from reverse_image_search.utils import chunked
+
+logger = logging.getLogger()
+
+
+def label_of(path: str) -> str:
+    """
+    The label of an image is the name of its directory, e.g. `train/goldfish/x.JPEG` is a goldfish.
+    """
+    return os.path.basename(os.path.dirname(os.path.normpath(path)))
+
+
+def load_paths(src: str):
+    """
+    Image paths of a csv (path column) or a glob pattern, like `load_image` in the scripts.
+    """
+    if src.endswith('csv'):
+        with open(src) as f:
+            reader = csv.reader(f)
+            next(reader)
+            return [item[1] for item in reader]
+    return sorted(glob(src))
+
+
+def latency_stats(seconds) -> dict:
+    """
+    Summarize per-call latencies in milliseconds.
+    """
+    ms = 1000 * np.asarray(seconds, dtype=np.float64)
+    if not len(ms):
+        return {}
+    return {
+        'mean': float(ms.mean()),
+        'p50': float(np.percentile(ms, 50)),
+        'p95': float(np.percentile(ms, 95)),
+        'p99': float(np.percentile(ms, 99)),
+        'max': float(ms.max()),
+    }
+
+
+def recall_at_k(results, truth, k: int) -> float:
+    """
+    Mean fraction of the exact top-k paths found by the search, both are lists of path lists.
+    """
+    found = [len(set(r[:k]) & set(t[:k])) / max(len(t[:k]), 1) for r, t in zip(results, truth)]
+    return float(np.mean(found)) if found else 0.0
+
+
+def label_precision(results, query_paths, k: int = 10) -> float:
+    """
+    Mean fraction of the top-k results sharing the label of their query.
+    """
+    precision = [sum(label_of(path) == label_of(query) for path in r[:k]) / k for r, query in zip(results, query_paths)]
+    return float(np.mean(precision)) if precision else 0.0
+
+
+def cosine_drift(reference: 'ndarray', other: 'ndarray') -> dict:
+    """
+    Cosine similarity between the rows of two embeddings of the same images, e.g. fp32 and INT8.
+    """
+    reference = reference / np.maximum(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12)
+    other = other / np.maximum(np.linalg.norm(other, axis=1, keepdims=True), 1e-12)
+    cosine = np.sum(reference * other, axis=1)
+    if not len(cosine):
+        return {}
+    return {
+        'mean': float(cosine.mean()),
+        'p5': float(np.percentile(cosine, 5)),
+        'min': float(cosine.min()),
+    }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def bench_embed(embedding, paths, batch_sizes=(1, 8, 32, 64), thread_counts=(1, 4)) -> list:
+    """
+    Images/s of `ResnetEmbedding.extract` for every batch size and torch thread count, cache disabled.
+    A warmup batch runs before every measurement.
+    """
+    import torch
+
+    cache, embedding.cache = embedding.cache, None
+    results = []
+    try:
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                embedding.extract(paths[:batch_size], batch_size=batch_size)
+                start = time.perf_counter()
+                embedding.extract(paths, batch_size=batch_size)
+                seconds = time.perf_counter() - start
+                results.append({'threads': threads, 'batch_size': batch_size, 'images': len(paths),
+                                'seconds': seconds, 'images_per_s': len(paths) / seconds})
+                logger.info('embed threads=%d batch_size=%d: %.1f images/s', threads, batch_size,
+                            len(paths) / seconds)
+    finally:
+        embedding.cache = cache
+    return results
+
+
+def bench_ingest(client, paths, features, batch_size: int = 100) -> dict:
+    """
+    Vectors/s of `upsert_many`, index maintenance included.
+    """
+    start = time.perf_counter()
+    for chunk in chunked(range(len(paths)), batch_size):
+        client.upsert_many([paths[i] for i in chunk], features[chunk[0]:chunk[-1] + 1], batch_size=batch_size)
+    seconds = time.perf_counter() - start
+    return {'vectors': len(paths), 'batch_size': batch_size, 'seconds': seconds,
+            'vectors_per_s': len(paths) / seconds}
+
+
+def bench_search(client, queries, k: int = 10, rounds: int = 1, **params):
+    """
+    Latency of single-query `search` and throughput of one `search_many` over all queries.
+
+    Returns:
+        A tuple (stats, results), results being the top-k paths of every query.
+    """
+    latencies = []
+    results = None
+    for _ in range(rounds):
+        results = []
+        for query in queries:
+            start = time.perf_counter()
+            rows = client.search(query, k, **params)
+            latencies.append(time.perf_counter() - start)
+            results.append([os.path.normpath(row[0]) for row in rows])
+
+    start = time.perf_counter()
+    client.search_many(queries, k, **params)
+    batch_seconds = time.perf_counter() - start
+    stats = {
+        'queries': len(queries) * rounds,
+        'qps': len(latencies) / sum(latencies),
+        'latency_ms': latency_stats(latencies),
+        'batch_qps': len(queries) / batch_seconds,
+    }
+    return stats, results
+
+
+def local_settings(ivf_nlist=(), nprobe=(), hnsw_m=(), ef_construction: int = 200, ef=(), codecs=(), rerank=()):
+    """
+    Yield (name, store kwargs, [search params]) for the exact store, every index setting and
+    every storage format.
+    """
+    yield 'exact', {}, [{}]
+    for nlist in ivf_nlist:
+        yield 'ivf nlist=%d' % nlist, {'index': IvfIndex(nlist=nlist)}, [{'nprobe': n} for n in nprobe] or [{}]
+    for m in hnsw_m:
+        yield ('hnsw m=%d ef_construction=%d' % (m, ef_construction),
+               {'index': HnswIndex(m=m, ef_construction=ef_construction)}, [{'ef': e} for e in ef] or [{}])
+    for codec in codecs:
+        yield 'codec=%s' % codec, {'codec': codec}, [{'rerank': r} for r in rerank] or [{}]
+
+
+def bench_backend(name, client, paths, features, query_paths, queries, truth, k: int = 10, batch_size: int = 100,
+                  search_params=({},), rounds: int = 1) -> dict:
+    """
+    Ingest `features` into `client`, then measure every search setting against the exact `truth`.
+    """
+    report = {'backend': name, 'ingest': bench_ingest(client, paths, features, batch_size), 'searches': []}
+    # Size of one vector as scanned, float32 unless the store compresses it
+    report['bytes_per_vector'] = getattr(client, 'bytes_per_vector', features.shape[1] * 4)
+    logger.info('%s ingest: %.1f vectors/s', name, report['ingest']['vectors_per_s'])
+    for params in search_params:
+        stats, results = bench_search(client, queries, k, rounds=rounds, **params)
+        stats.update({
+            'params': params,
+            'k': k,
+            'recall_at_k': recall_at_k(results, truth, k),
+            'label_precision_at_10': label_precision(results, query_paths, 10),
+        })
+        stats['recall_loss'] = 1.0 - stats['recall_at_k']
+        logger.info('%s %s: %.1f qps, p99 %.2f ms, recall@%d %.3f, label precision@10 %.3f', name, params,
+                    stats['qps'], stats['latency_ms']['p99'], k, stats['recall_at_k'], stats['label_precision_at_10'])
+        report['searches'].append(stats)
+    return report
+
+
+def exact_truth(paths, features, queries, k: int = 10, metric: str = 'COSINE'):
+    """
+    Exact top-k paths of every query, the reference of `recall_at_k`.
+    """
+    workdir = tempfile.mkdtemp(prefix='truth-')
+    try:
+        store = LocalVectorStore(workdir, dim=features.shape[1], metric=metric)
+        store.upsert_many(paths, features)
+        return [[os.path.normpath(row[0]) for row in rows] for rows in store.search_many(queries, k)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def write_report(report: dict, path: str):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info('Benchmark report written to %s', path)
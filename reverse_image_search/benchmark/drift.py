@@ -0,0 +1,89 @@
+"""
+Compare the INT8 embedding model with fp32, run from the `reverse_image_search` directory:
+
+    python -m reverse_image_search.benchmark.drift --output drift.json
+
+Both models embed the indexed and the query images, the report gives the embed throughput of
+each, the cosine similarity between the fp32 and INT8 embedding of every image, and the
+recall@k of an INT8 index searched with INT8 queries against the fp32 top-k.
+"""
+import argparse
+import logging
+import os
+import time
+
+from torchvision.models import ResNet50_Weights
+
+from reverse_image_search.benchmark.benchmark import cosine_drift, environment, exact_truth, label_precision, \
+    load_paths, recall_at_k, write_report
+from reverse_image_search.resnet_embedding import ResnetEmbedding
+from reverse_image_search.resnet_embedding.quantize import calibration_sample
+
+logger = logging.getLogger()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--insert-src', default='reverse_image_search.csv', help='csv or glob of indexed images')
+    parser.add_argument('--query-src', default='./test/*/*.JPEG', help='glob of query images')
+    parser.add_argument('--calibration-src', default='./train/*/*.JPEG', help='glob of the calibration images')
+    parser.add_argument('--calibration-size', type=int, default=256)
+    parser.add_argument('--output', default='drift.json')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--export-dir', default='', help='exported TorchScript models, "" runs the eager models')
+    return parser.parse_args(argv)
+
+
+def embed(embedding, paths, query_paths) -> tuple:
+    """
+    Embed the indexed and the query images without cache, returns (features, queries, stats).
+    """
+    warmup = embedding.warmup()
+    start = time.perf_counter()
+    features = embedding.extract(paths)
+    queries = embedding.extract(query_paths)
+    seconds = time.perf_counter() - start
+    embedding.close()
+    images = len(paths) + len(query_paths)
+    return features, queries, {'warmup_s': warmup, 'images': images, 'seconds': seconds,
+                               'images_per_s': images / seconds}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    paths = load_paths(args.insert_src)
+    query_paths = load_paths(args.query_src)
+    report = {'environment': environment(), 'config': vars(args),
+              'dataset': {'images': len(paths), 'queries': len(query_paths)}}
+
+    export_dir = args.export_dir or None
+    fp32 = ResnetEmbedding(weights=ResNet50_Weights.IMAGENET1K_V2, batch_size=args.batch_size,
+                           num_workers=args.num_workers, export_dir=export_dir)
+    int8 = ResnetEmbedding(weights=ResNet50_Weights.IMAGENET1K_V2, batch_size=args.batch_size,
+                           num_workers=args.num_workers, export_dir=export_dir, quantize=True,
+                           calibration_paths=calibration_sample(args.calibration_src, args.calibration_size))
+    features, queries, report['fp32'] = embed(fp32, paths, query_paths)
+    int8_features, int8_queries, report['int8'] = embed(int8, paths, query_paths)
+    report['speedup'] = report['int8']['images_per_s'] / report['fp32']['images_per_s']
+    logger.info('fp32 %.1f images/s, int8 %.1f images/s, speedup %.2fx', report['fp32']['images_per_s'],
+                report['int8']['images_per_s'], report['speedup'])
+
+    report['cosine_drift'] = {'indexed': cosine_drift(features, int8_features),
+                              'queries': cosine_drift(queries, int8_queries)}
+    truth = exact_truth(paths, features, queries, args.k)
+    results = exact_truth(paths, int8_features, int8_queries, args.k)
+    report['search'] = {
+        'k': args.k,
+        'recall_at_k': recall_at_k(results, truth, args.k),
+        'fp32_label_precision_at_10': label_precision(truth, query_paths, 10),
+        'int8_label_precision_at_10': label_precision(results, query_paths, 10),
+    }
+    logger.info('cosine drift %s, recall@%d %.3f', report['cosine_drift'], args.k, report['search']['recall_at_k'])
+    write_report(report, os.path.abspath(args.output))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
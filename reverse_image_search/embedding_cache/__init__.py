@@ -0,0 +1,5 @@
+from reverse_image_search.embedding_cache.embedding_cache import EmbeddingCache
+
+
+def embedding_cache(*args, **kwargs):
+    return EmbeddingCache(*args, **kwargs)
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from reverse_image_search.vector_codec.vector_codec import load_codec, make_codec
+
+logger = logging.getLogger()
+
+# size in bytes of one key in the index file
+KEY_SIZE = 16
+
+
+def file_key(path: str) -> bytes:
+    """
+    Hash the content of a file, so a renamed or copied image hits the same cache entry.
+    """
+    digest = hashlib.blake2b(digest_size=KEY_SIZE)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by (file content hash, model, preprocessing config).
+
+    Every `model_key` gets its own pair of files under `cache_dir`: `<ns>.f32`, a memory-mapped
+    float32 matrix of vectors, and `<ns>.keys`, the content hashes of its rows appended as fixed
+    size records. Keys are only appended once the vectors they point to are flushed, so an
+    interrupted run never leaves a key pointing at garbage.
+
+    With a `codec` the rows are stored compressed in `<ns>.codes` and decoded on read, the codec
+    parameters are saved to `<ns>.codec.npz`. Lossy codecs return approximate embeddings.
+
+    Args:
+        cache_dir (`str`):
+            The directory holding the cache files.
+        model_key (`str`):
+            Identifies the model, its weights and the preprocessing, any change gives a new namespace.
+        dim (`int`):
+            The dimension of the cached vectors.
+        flush_every (`int`):
+            Flush automatically after this many new vectors.
+        codec (`str` or codec):
+            'float16', or a trained codec of `reverse_image_search.vector_codec` ('sq8', 'pq<m>'),
+            None stores float32.
+    """
+
+    def __init__(self, cache_dir: str, model_key: str, dim: int = 2048, flush_every: int = 1024, codec=None):
+        self.model_key = model_key
+        self.dim = dim
+        self.flush_every = flush_every
+        if isinstance(codec, str):
+            codec = make_codec(codec)
+        os.makedirs(cache_dir, exist_ok=True)
+        namespace = hashlib.sha1(model_key.encode('utf-8')).hexdigest()[:16]
+        if codec is not None:
+            namespace = hashlib.sha1(('%s|%s' % (model_key, codec.name)).encode('utf-8')).hexdigest()[:16]
+            codec_path = os.path.join(cache_dir, namespace + '.codec.npz')
+            if os.path.exists(codec_path):
+                # Codes already written must be decoded with the parameters that encoded them
+                codec = load_codec(codec_path)
+            elif not codec.is_trained:
+                raise ValueError('The %s codec of an embedding cache must be trained first' % codec.name)
+            else:
+                codec.save(codec_path)
+        self.codec = codec
+        self._keys_path = os.path.join(cache_dir, namespace + '.keys')
+        self._vectors_path = os.path.join(cache_dir, namespace + ('.codes' if codec is not None else '.f32'))
+        self._width = codec.code_size(dim) if codec is not None else dim
+        self._dtype = codec.dtype if codec is not None else np.float32
+        self._lock = threading.Lock()
+        self._pending = []
+
+        meta_path = os.path.join(cache_dir, namespace + '.json')
+        if not os.path.exists(meta_path):
+            with open(meta_path, 'w') as f:
+                json.dump({'model_key': model_key, 'dim': dim, 'codec': codec.name if codec is not None else None}, f)
+
+        keys = b''
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path, 'rb') as f:
+                keys = f.read()
+        count = len(keys) // KEY_SIZE
+        self._index = {keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(count)}
+        self._count = count
+        self._vectors = None
+        self._open_vectors(max(count, 1024))
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key: bytes):
+        return key in self._index
+
+    def _open_vectors(self, capacity: int):
+        row_bytes = self._width * np.dtype(self._dtype).itemsize
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        if size < capacity * row_bytes:
+            with open(self._vectors_path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+            size = capacity * row_bytes
+        self._vectors = np.memmap(self._vectors_path, dtype=self._dtype, mode='r+',
+                                  shape=(size // row_bytes, self._width))
+
+    def _decode(self, rows):
+        if self.codec is None:
+            return np.array(self._vectors[rows])
+        return self.codec.decode(self._vectors[rows])
+
+    def get(self, key: bytes):
+        """
+        Return the cached vector for `key`, or None.
+        """
+        row = self._index.get(key)
+        if row is None:
+            return None
+        return self._decode([row])[0]
+
+    def put(self, key: bytes, vector: 'ndarray'):
+        with self._lock:
+            if key in self._index:
+                return
+            row = self._count
+            if row >= self._vectors.shape[0]:
+                self._vectors.flush()
+                self._open_vectors(2 * self._vectors.shape[0])
+            vector = np.asarray(vector, dtype=np.float32).reshape(1, self.dim)
+            self._vectors[row] = self.codec.encode(vector)[0] if self.codec is not None else vector[0]
+            self._index[key] = row
+            self._pending.append(key)
+            self._count += 1
+            if len(self._pending) >= self.flush_every:
+                self._flush()
+
+    def lookup(self, paths):
+        """
+        Look up a list of image paths.
+
+        Returns:
+            A tuple (keys, vectors, missing): the content keys, a float32 (N, dim) array filled
+            for the hits, and the indices of `paths` that have to be embedded.
+        """
+        keys = [file_key(path) for path in paths]
+        vectors = np.zeros((len(paths), self.dim), dtype=np.float32)
+        missing = []
+        hits = []
+        rows = []
+        for i, key in enumerate(keys):
+            row = self._index.get(key)
+            if row is None:
+                missing.append(i)
+            else:
+                hits.append(i)
+                rows.append(row)
+        if hits:
+            vectors[hits] = self._decode(rows)
+        return keys, vectors, missing
+
+    def cached(self, embed):
+        """
+        Wrap a `path -> vector` function (e.g. a towhee decode + embedding op) with the cache.
+        """
+        def wrapper(path):
+            key = file_key(path)
+            vector = self.get(key)
+            if vector is None:
+                vector = np.asarray(embed(path), dtype=np.float32)
+                self.put(key, vector)
+            return vector
+        return wrapper
+
+    def _flush(self):
+        if not self._pending:
+            return
+        self._vectors.flush()
+        with open(self._keys_path, 'ab') as f:
+            f.write(b''.join(self._pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
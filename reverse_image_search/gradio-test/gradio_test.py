@@ -3,10 +3,14 @@
 
 import os
 import gradio as gr
+from reverse_image_search.thumbnail_store import ThumbnailStore
+
+# 缩略图缓存目录, 图库只加载缩略图而不是原图
+thumbnail_store = ThumbnailStore('./.thumbnails')
 
 def get_img_lits(img_dir):
         imgs_List=[ os.path.join(img_dir,name) for name in sorted(os.listdir(img_dir)) if  name.endswith(('.png','.jpg','.webp','.tif','.jpeg'))]
-        return imgs_List
+        return thumbnail_store.thumbnails(imgs_List, num_workers=4)
 
 
 def input_text(dir):
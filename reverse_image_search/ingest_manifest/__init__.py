@@ -0,0 +1,5 @@
+from reverse_image_search.ingest_manifest.ingest_manifest import IngestManifest, ManifestEntry, incremental_ingest
+
+
+def ingest_manifest(*args, **kwargs):
+    return IngestManifest(*args, **kwargs)
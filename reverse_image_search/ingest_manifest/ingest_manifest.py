@@ -0,0 +1,125 @@
+import collections
+import logging
+import os
+import sqlite3
+
+from reverse_image_search.embedding_cache.embedding_cache import file_key
+from reverse_image_search.utils import chunked, document_id
+
+logger = logging.getLogger()
+
+ManifestEntry = collections.namedtuple('ManifestEntry', ['path', 'mtime_ns', 'size', 'hash', 'id'])
+
+
+class IngestManifest:
+    """
+    Local record of what is indexed: one (path, mtime, size, hash, id) row per image.
+
+    `diff` compares a list of paths with the manifest and yields only new or changed files, the
+    content hash is only computed when mtime or size changed. After `diff` is exhausted, `removed`
+    returns the entries whose path was not seen.
+
+    Args:
+        path (`str`):
+            The sqlite database file.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files '
+                           '(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT, id TEXT)')
+        self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)')
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def diff(self, paths, chunk_size: int = 1000):
+        """
+        Yield a `ManifestEntry` for every path that is new or whose content changed.
+        """
+        self._conn.execute('DELETE FROM seen')
+        for chunk in chunked((os.path.normpath(path) for path in paths), chunk_size):
+            self._conn.executemany('INSERT OR IGNORE INTO seen VALUES (?)', ((path,) for path in chunk))
+            known = {
+                row[0]: ManifestEntry(*row) for row in self._conn.execute(
+                    'SELECT path, mtime_ns, size, hash, id FROM files WHERE path IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk)
+            }
+            touched = []
+            for path in chunk:
+                stat = os.stat(path)
+                entry = known.get(path)
+                if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                    continue
+                digest = file_key(path).hex()
+                if entry is not None and entry.hash == digest:
+                    # Touched but not modified, only refresh the stat fields
+                    touched.append(entry._replace(mtime_ns=stat.st_mtime_ns, size=stat.st_size))
+                    continue
+                yield ManifestEntry(path, stat.st_mtime_ns, stat.st_size, digest, document_id(path))
+            self.record(touched)
+
+    def removed(self):
+        """
+        Return the entries not seen by the last `diff`.
+        """
+        rows = self._conn.execute('SELECT path, mtime_ns, size, hash, id FROM files '
+                                  'WHERE path NOT IN (SELECT path FROM seen)')
+        return [ManifestEntry(*row) for row in rows]
+
+    def record(self, entries):
+        """
+        Mark entries as indexed, call once the vector store acknowledged them.
+        """
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', entries)
+
+    def forget(self, entries):
+        with self._conn:
+            self._conn.executemany('DELETE FROM files WHERE path = ?', ((entry.path,) for entry in entries))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def incremental_ingest(paths, manifest: IngestManifest, embed, client, batch_size: int = 100, thumbnails=None):
+    """
+    Embed and upsert only new or changed images, and delete the documents of removed ones.
+
+    Args:
+    paths (`Iterable[str]`):
+        All image paths of the catalogue, e.g. `load_image(INSERT_SRC)`.
+    manifest (`IngestManifest`):
+        The manifest of the collection.
+    embed:
+        A function embedding a list of paths into an (N, dim) array.
+    client (`TcvdbClient`):
+        The vector store client.
+    thumbnails (`ThumbnailStore`):
+        Optional thumbnail store, the thumbnails of upserted images are generated with them.
+
+    Returns:
+        A tuple (upserted, removed) with the number of upserted and deleted documents.
+    """
+    upserted = 0
+    for entries in chunked(manifest.diff(paths), batch_size):
+        features = embed([entry.path for entry in entries])
+        client.upsert_many([entry.path for entry in entries], features, batch_size=batch_size,
+                           ids=[entry.id for entry in entries])
+        if thumbnails is not None:
+            thumbnails.generate([entry.path for entry in entries])
+        manifest.record(entries)
+        upserted += len(entries)
+
+    removed = manifest.removed()
+    if removed:
+        client.delete([entry.id for entry in removed])
+        manifest.forget(removed)
+    logger.info('Incremental ingest upserted %d and removed %d documents', upserted, len(removed))
+    return upserted, len(removed)
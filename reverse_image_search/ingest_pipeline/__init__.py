@@ -0,0 +1,7 @@
+from reverse_image_search.ingest_pipeline.checkpoint import IngestCheckpoint, source_fingerprint
+from reverse_image_search.ingest_pipeline.ingest_pipeline import IngestPipeline, Stage, ingest_stages, \
+    streaming_ingest
+
+
+def ingest_pipeline(*args, **kwargs):
+    return IngestPipeline(*args, **kwargs)
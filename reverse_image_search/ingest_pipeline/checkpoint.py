@@ -0,0 +1,126 @@
+import bisect
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from glob import glob
+
+logger = logging.getLogger()
+
+
+def source_fingerprint(src: str) -> str:
+    """
+    Identify the input of an ingest job: a csv by its path, size and mtime, a glob by its pattern
+    and a digest of the sorted paths it matches (the order the scripts ingest them in). Row numbers
+    are only comparable between runs over the same input.
+    """
+    if os.path.isfile(src):
+        stat = os.stat(src)
+        return '%s|%d|%d' % (os.path.abspath(src), stat.st_size, stat.st_mtime_ns)
+    listing = hashlib.blake2b('\n'.join(sorted(glob(src))).encode(), digest_size=16).hexdigest()
+    return '%s|%s' % (src, listing)
+
+
+def to_ranges(rows) -> list:
+    """
+    Compress row numbers into sorted [start, stop) ranges of consecutive rows.
+    """
+    ranges = []
+    for row in sorted(rows):
+        if ranges and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+    return ranges
+
+
+class IngestCheckpoint:
+    """
+    Durable record of the input rows acknowledged by the vector store, to resume an ingest job.
+
+    Rows are numbered in the order of the input (e.g. the lines of the csv). After every
+    successful upsert its rows are committed as [start, stop) ranges to a sqlite database with
+    synchronous writes, so a crash loses at most the batches in flight. A resumed run skips the
+    acknowledged rows and only embeds and upserts the others. Batches are acknowledged out of
+    order when several upsert workers run, which the ranges handle.
+
+    Args:
+        path (`str`):
+            The sqlite database file.
+        source (`str`):
+            The fingerprint of the input, see `source_fingerprint`. A checkpoint written for
+            another input is refused, its row numbers would not match.
+    """
+
+    def __init__(self, path: str, source: str = None):
+        self._lock = threading.Lock()
+        # Written by the upsert workers
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS acked (start INTEGER, stop INTEGER)')
+        if source is not None:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+            if row is None:
+                with self._conn:
+                    self._conn.execute("INSERT INTO meta VALUES ('source', ?)", (source,))
+            elif row[0] != source:
+                raise ValueError('The checkpoint %s belongs to another input (%s), delete it to start over'
+                                 % (path, row[0]))
+        self._compact()
+
+    def _compact(self):
+        """
+        Merge the ranges written by the previous runs into as few rows as possible.
+        """
+        ranges = []
+        for start, stop in self._conn.execute('SELECT start, stop FROM acked ORDER BY start'):
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([start, stop])
+        with self._conn:
+            self._conn.execute('DELETE FROM acked')
+            self._conn.executemany('INSERT INTO acked VALUES (?, ?)', ranges)
+        self._starts = [start for start, _ in ranges]
+        self._stops = [stop for _, stop in ranges]
+
+    def __len__(self):
+        """
+        The number of acknowledged rows when the checkpoint was opened.
+        """
+        return sum(stop - start for start, stop in zip(self._starts, self._stops))
+
+    def __contains__(self, row: int):
+        i = bisect.bisect_right(self._starts, row) - 1
+        return i >= 0 and row < self._stops[i]
+
+    def pending(self, items):
+        """
+        Yield (row, item) for the items of an iterable not acknowledged yet.
+        """
+        skipped = 0
+        for row, item in enumerate(items):
+            if row in self:
+                skipped += 1
+                continue
+            yield row, item
+        logger.info('Checkpoint: skipped %d rows acknowledged by previous runs', skipped)
+
+    def record(self, rows):
+        """
+        Mark rows as acknowledged, call once the vector store accepted them.
+        """
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT INTO acked VALUES (?, ?)', to_ranges(rows))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
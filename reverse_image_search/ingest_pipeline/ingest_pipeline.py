@@ -0,0 +1,331 @@
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+
+from reverse_image_search.resnet_embedding.preprocess import load_image_array, to_tensor_batch
+from reverse_image_search.utils import retry_with_backoff
+
+logger = logging.getLogger()
+
+# Put on a queue once per downstream worker when all upstream workers are done
+_END = object()
+
+
+class _Stopped(Exception):
+    """
+    Raised in the workers when another stage failed.
+    """
+
+
+class Stage:
+    """
+    One step of an `IngestPipeline`.
+
+    Args:
+        name (`str`):
+            The name of the stage in the stats.
+        fn:
+            A function mapping a list of at most `batch_size` items to a list of output items,
+            of any length (failed items can be dropped).
+        workers (`int`):
+            The number of threads running `fn`.
+        batch_size (`int`):
+            How many input items one call of `fn` takes, the last batch may be smaller.
+        queue_size (`int`):
+            The capacity in items of the input queue of the stage. Upstream stages block when it
+            is full, which bounds the memory whatever the number of items.
+    """
+
+    def __init__(self, name: str, fn, workers: int = 1, batch_size: int = 1, queue_size: int = None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size or 2 * workers * batch_size
+
+
+class StageStats:
+    """
+    Counters of one stage, `busy` is the time spent in `fn`, `starved` waiting for input and
+    `blocked` waiting for room in the downstream queue (back-pressure), summed over the workers.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.items = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self, seconds: float) -> dict:
+        worker_seconds = max(self.workers * seconds, 1e-9)
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'batches': self.batches,
+            'items_per_s': self.items / max(seconds, 1e-9),
+            'busy': self.busy / worker_seconds,
+            'starved': self.starved / worker_seconds,
+            'blocked': self.blocked / worker_seconds,
+        }
+
+
+class IngestPipeline:
+    """
+    Run items through stages connected by bounded queues, every stage in its own threads.
+
+    The stages overlap: while the model embeds a batch, the decode workers prepare the next ones
+    and the upsert workers send the previous ones. A full queue blocks its producers, so a slow
+    stage throttles everything upstream instead of letting items pile up in memory. The first
+    error of any stage stops the pipeline and is raised by `run`.
+
+    `stats` reports per stage the throughput and how the worker time splits between busy,
+    starved (the bottleneck is upstream) and blocked (the bottleneck is downstream).
+
+    Args:
+        stages (`list[Stage]`):
+            The stages, in order.
+        report_interval (`float`):
+            Log the stats every `report_interval` seconds while running, None disables it.
+    """
+
+    def __init__(self, stages, report_interval: float = 30.0):
+        self.stages = stages
+        self.report_interval = report_interval
+        self._stats = {}
+        self._start = None
+        self._seconds = 0.0
+
+    def run(self, items) -> dict:
+        """
+        Feed an iterable of items (e.g. a generator of paths) through the stages, returns the stats.
+        """
+        self._queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        self._stats = {'read': StageStats(1)}
+        self._stats.update((stage.name, StageStats(stage.workers)) for stage in self.stages)
+        self._finished = [0] * len(self.stages)
+        self._finished_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error = None
+        self._start = time.perf_counter()
+
+        threads = [threading.Thread(target=self._read, args=(items,), name='ingest-read', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.extend(threading.Thread(target=self._work, args=(i,), name='ingest-%s-%d' % (stage.name, n),
+                                            daemon=True) for n in range(stage.workers))
+        for thread in threads:
+            thread.start()
+        last_report = time.perf_counter()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1.0)
+                if self.report_interval and time.perf_counter() - last_report >= self.report_interval:
+                    self.log_stats()
+                    last_report = time.perf_counter()
+        self._seconds = time.perf_counter() - self._start
+        self.log_stats()
+        if self._error is not None:
+            raise self._error
+        return self.stats()
+
+    def stats(self) -> dict:
+        seconds = self._seconds or (time.perf_counter() - self._start if self._start else 0.0)
+        stages = {name: stats.snapshot(seconds) for name, stats in self._stats.items()}
+        bottleneck = max(stages, key=lambda name: stages[name]['busy']) if stages else None
+        return {'seconds': seconds, 'bottleneck': bottleneck, 'stages': stages}
+
+    def log_stats(self):
+        stats = self.stats()
+        for name, stage in stats['stages'].items():
+            logger.info('ingest %s x%d: %d items, %.1f items/s, busy %.0f%%, starved %.0f%%, blocked %.0f%%',
+                        name, stage['workers'], stage['items'], stage['items_per_s'], 100 * stage['busy'],
+                        100 * stage['starved'], 100 * stage['blocked'])
+        logger.info('ingest bottleneck: %s', stats['bottleneck'])
+
+    def _fail(self, error: Exception):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _put(self, q: queue.Queue, item, stats: StageStats):
+        start = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats.add(blocked=time.perf_counter() - start)
+
+    def _get(self, q: queue.Queue, stats: StageStats):
+        start = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        stats.add(starved=time.perf_counter() - start)
+        return item
+
+    def _read(self, items):
+        stats = self._stats['read']
+        try:
+            for item in items:
+                self._put(self._queues[0], item, stats)
+                stats.add(items=1)
+            for _ in range(self.stages[0].workers):
+                self._put(self._queues[0], _END, stats)
+        except _Stopped:
+            pass
+        except Exception as e:
+            logger.exception('Reading the ingest items failed')
+            self._fail(e)
+
+    def _work(self, i: int):
+        stage = self.stages[i]
+        stats = self._stats[stage.name]
+        downstream = self._queues[i + 1] if i + 1 < len(self.stages) else None
+        try:
+            batch = []
+            while True:
+                item = self._get(self._queues[i], stats)
+                if item is not _END:
+                    batch.append(item)
+                if batch and (item is _END or len(batch) >= stage.batch_size):
+                    start = time.perf_counter()
+                    outputs = stage.fn(batch)
+                    stats.add(items=len(batch), batches=1, busy=time.perf_counter() - start)
+                    if downstream is not None:
+                        for output in outputs:
+                            self._put(downstream, output, stats)
+                    batch = []
+                if item is _END:
+                    break
+            with self._finished_lock:
+                self._finished[i] += 1
+                last = self._finished[i] == stage.workers
+            if last and downstream is not None:
+                for _ in range(self.stages[i + 1].workers):
+                    self._put(downstream, _END, stats)
+        except _Stopped:
+            pass
+        except Exception as e:
+            logger.exception('Ingest stage %s failed', stage.name)
+            self._fail(e)
+
+
+def ingest_stages(embedding, client, decode_workers: int = 4, decode_batch_size: int = 8,
+                  embed_batch_size: int = 32, upsert_workers: int = 2, upsert_batch_size: int = 100,
+                  queue_size: int = 256, checkpoint=None, retry_attempts: int = 5, retry_delay: float = 1.0) -> list:
+    """
+    The stages of an image ingest: decode/preprocess, batched embed, batched upsert. The items
+    are (row, path) pairs, row being the position of the image in the input.
+
+    Images already in the embedding cache of `embedding` skip the model. Images that can't be
+    decoded are logged and skipped. A failed upsert is retried with exponential backoff using
+    the vectors of the batch, nothing is embedded again.
+
+    Args:
+        embedding (`ResnetEmbedding`):
+            The model, its cache and projection are used.
+        client (`TcvdbClient`):
+            The vector store client, or any object with `upsert_many`.
+        decode_workers (`int`):
+            Threads decoding images, Pillow releases the GIL while decoding and resizing.
+        decode_batch_size (`int`):
+            Images per decode task.
+        embed_batch_size (`int`):
+            Images per forward pass, the model runs on one thread using all torch threads.
+        upsert_workers (`int`):
+            Concurrent upsert requests.
+        upsert_batch_size (`int`):
+            Documents per upsert request.
+        queue_size (`int`):
+            Capacity of the queues in front of the embed and upsert stages, a decoded image
+            takes 150 KB.
+        checkpoint (`IngestCheckpoint`):
+            Optional checkpoint, the rows of every acknowledged upsert are recorded in it.
+        retry_attempts (`int`):
+            The maximum number of attempts of one upsert request.
+        retry_delay (`float`):
+            The delay in seconds before the first retry, doubled after every failure.
+    """
+    cache = embedding.cache
+    projection = embedding.projection
+
+    def decode(items):
+        paths = [path for _, path in items]
+        keys, vectors, missing = cache.lookup(paths) if cache is not None else (None, None, range(len(paths)))
+        missing = set(missing)
+        outputs = []
+        for i, (row, path) in enumerate(items):
+            if i not in missing:
+                outputs.append((row, path, None, None, vectors[i]))
+                continue
+            try:
+                outputs.append((row, path, keys[i] if keys else None, load_image_array(path), None))
+            except (OSError, ValueError) as e:
+                logger.warning('Skipping %s, it can not be decoded: %s', path, e)
+        return outputs
+
+    def embed(items):
+        todo = [i for i, item in enumerate(items) if item[4] is None]
+        vectors = [item[4] for item in items]
+        if todo:
+            features = embedding.forward(to_tensor_batch(np.stack([items[i][3] for i in todo])))
+            for i, vector in zip(todo, features):
+                vectors[i] = vector
+                if cache is not None:
+                    cache.put(items[i][2], vector)
+        vectors = np.stack(vectors)
+        if projection is not None:
+            vectors = projection.transform(vectors)
+        return [(item[0], item[1], vector) for item, vector in zip(items, vectors)]
+
+    def upsert(items):
+        # Document ids derive from the paths, upserting a batch again after a crash overwrites it
+        retry_with_backoff(client.upsert_many, [path for _, path, _ in items],
+                           np.stack([vector for _, _, vector in items]), batch_size=len(items),
+                           attempts=retry_attempts, base_delay=retry_delay)
+        rows = [row for row, _, _ in items]
+        if checkpoint is not None:
+            checkpoint.record(rows)
+        return rows
+
+    return [
+        Stage('decode', decode, workers=decode_workers, batch_size=decode_batch_size,
+              queue_size=decode_workers * decode_batch_size * 2),
+        Stage('embed', embed, workers=1, batch_size=embed_batch_size, queue_size=queue_size),
+        Stage('upsert', upsert, workers=upsert_workers, batch_size=upsert_batch_size, queue_size=queue_size),
+    ]
+
+
+def streaming_ingest(paths, embedding, client, checkpoint=None, report_interval: float = 30.0, **kwargs) -> dict:
+    """
+    Embed and upsert an iterable of image paths with overlapped stages, see `ingest_stages` for
+    the settings. With a `checkpoint` the rows acknowledged by previous runs are skipped and the
+    new ones recorded, an interrupted job resumes where it stopped. Returns the per-stage stats.
+    """
+    items = checkpoint.pending(paths) if checkpoint is not None else enumerate(paths)
+    pipeline = IngestPipeline(ingest_stages(embedding, client, checkpoint=checkpoint, **kwargs),
+                              report_interval=report_interval)
+    try:
+        return pipeline.run(items)
+    finally:
+        if embedding.cache is not None:
+            embedding.cache.flush()
@@ -0,0 +1,16 @@
+from reverse_image_search.local_vector_store.hnsw_index import HnswIndex
+from reverse_image_search.local_vector_store.ivf_index import IvfIndex
+from reverse_image_search.local_vector_store.local_vector_store import LocalInsertClient, LocalSearchClient, \
+    LocalVectorStore, load_index, open_store
+
+
+def local_vector_store(*args, **kwargs):
+    return LocalVectorStore(*args, **kwargs)
+
+
+def local_insert_client(*args, **kwargs):
+    return LocalInsertClient(*args, **kwargs)
+
+
+def local_search_client(*args, **kwargs):
+    return LocalSearchClient(*args, **kwargs)
@@ -0,0 +1,232 @@
+import heapq
+import logging
+import math
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+class HnswIndex:
+    """
+    Hierarchical navigable small world graph over a `LocalVectorStore`, the local counterpart of
+    the `HNSWParams(m=16, efconstruction=200)` index used by `TcvdbClient`.
+
+    Every row gets a random level, on each level it is linked to its `m` closest rows (2 * m on
+    level 0) picked among the results of a beam search of width `ef_construction`. A query descends greedily from the
+    top level and runs a beam search of width `ef` on level 0. Deleted rows stay in the graph to
+    keep it navigable and are filtered from the results.
+
+    Args:
+        m (`int`):
+            The number of links per row and level.
+        ef_construction (`int`):
+            The beam width while inserting, higher builds a better graph more slowly.
+        ef (`int`):
+            The beam width while searching, higher is slower with better recall.
+        seed (`int`):
+            Seed of the level generator.
+    """
+
+    kind = 'hnsw'
+    # keyword arguments of `search`, accepted by `LocalVectorStore.search`
+    search_params = ('ef',)
+
+    def __init__(self, m: int = 16, ef_construction: int = 200, ef: int = 64, seed: int = 0):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.seed = seed
+        self._level_mult = 1 / math.log(m)
+        self.reset()
+
+    def __len__(self):
+        return len(self._links[0]) if self._links else 0
+
+    def reset(self):
+        self._rng = np.random.default_rng(self.seed)
+        # one {row: [neighbour rows]} dict per level
+        self._links = []
+        self._entry = -1
+
+    def contains(self, rows: 'ndarray') -> 'ndarray':
+        level0 = self._links[0] if self._links else {}
+        return np.fromiter((row in level0 for row in np.asarray(rows).tolist()), dtype=bool, count=len(rows))
+
+    def _similarity(self, store, query, rows):
+        return store.similarity(query[None, :], np.asarray(rows, dtype=np.int64))[0]
+
+    def _search_level(self, store, query, entries, ef, level):
+        """
+        Beam search on one level, returns up to `ef` (similarity, row) pairs, best first.
+        """
+        visited = set(entries)
+        sims = self._similarity(store, query, entries)
+        # candidates is a max-heap (negated similarity), results a min-heap of the best `ef`
+        candidates = [(-sim, row) for sim, row in zip(sims.tolist(), entries)]
+        heapq.heapify(candidates)
+        results = [(sim, row) for sim, row in zip(sims.tolist(), entries)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        links = self._links[level]
+        while candidates:
+            neg_sim, row = heapq.heappop(candidates)
+            if -neg_sim < results[0][0] and len(results) >= ef:
+                break
+            neighbours = [n for n in links.get(row, ()) if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for sim, n in zip(self._similarity(store, query, neighbours).tolist(), neighbours):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, n))
+                    heapq.heappush(results, (sim, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _select(self, store, found, max_links):
+        """
+        Neighbour selection heuristic: keep a candidate only if it is closer to the new row than to
+        the neighbours already kept, so links spread across clusters instead of piling into one.
+        """
+        if len(found) <= max_links:
+            return [row for _, row in found]
+        rows = np.array([row for _, row in found], dtype=np.int64)
+        pairwise = store.similarity(store.vectors_of(rows), rows)
+        kept = []
+        for i, (sim, _) in enumerate(found):
+            if all(pairwise[i, j] < sim for j in kept):
+                kept.append(i)
+                if len(kept) == max_links:
+                    break
+        return rows[kept].tolist()
+
+    def _shrink(self, store, row, level, max_links):
+        links = self._links[level][row]
+        if len(links) <= max_links:
+            return
+        sims = self._similarity(store, store.vectors_of(np.array([row]))[0], links)
+        order = np.argsort(-sims).tolist()
+        self._links[level][row] = self._select(store, [(sims[i], links[i]) for i in order], max_links)
+
+    def add(self, store, rows: 'ndarray'):
+        """
+        Insert store rows one by one, the graph can grow incrementally. A row already in the graph
+        (overwritten vector) is unlinked and linked again according to its new vector.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        for row, vector in zip(rows.tolist(), store.vectors_of(rows)):
+            if self._links and row in self._links[0]:
+                self._update(store, row, vector)
+            else:
+                self._insert(store, row, vector)
+
+    def _insert(self, store, row, vector):
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+        while len(self._links) <= level:
+            self._links.append({})
+        if self._entry < 0:
+            for l in range(level + 1):
+                self._links[l][row] = []
+            self._entry = row
+            return
+
+        entry_level = self._connect(store, row, vector, level, self._entry)
+        for l in range(entry_level + 1, level + 1):
+            self._links[l][row] = []
+        if level > entry_level:
+            self._entry = row
+
+    def _update(self, store, row, vector):
+        levels = [l for l in range(len(self._links)) if row in self._links[l]]
+        for l in levels:
+            max_links = 2 * self.m if l == 0 else self.m
+            old = self._links[l][row]
+            self._links[l][row] = []
+            for n in old:
+                if row in self._links[l][n]:
+                    self._links[l][n].remove(row)
+            # The old neighbours lost a link through the row, let them link to each other instead
+            for n in old:
+                extra = [o for o in old if o != n and o not in self._links[l][n]]
+                if extra:
+                    self._links[l][n].extend(extra)
+                    self._shrink(store, n, l, max_links)
+
+        entry = self._entry
+        if entry == row:
+            # The row has no links left, descend from another row of the highest level holding one
+            others = (r for l in reversed(levels) for r in self._links[l] if r != row)
+            entry = next(others, -1)
+            if entry < 0:
+                return
+        self._connect(store, row, vector, levels[-1], entry)
+
+    def _connect(self, store, row, vector, level, entry):
+        """
+        Link `row` on the levels 0..level to its closest rows found from `entry`, returns the top
+        level of the entry.
+        """
+        entry_level = max(l for l in range(len(self._links)) if entry in self._links[l])
+        entries = [entry]
+        for l in range(entry_level, level, -1):
+            entries = [self._search_level(store, vector, entries, 1, l)[0][1]]
+        for l in range(min(level, entry_level), -1, -1):
+            found = [(sim, n) for sim, n in self._search_level(store, vector, entries, self.ef_construction, l)
+                     if n != row]
+            max_links = 2 * self.m if l == 0 else self.m
+            neighbours = self._select(store, found, self.m)
+            self._links[l][row] = neighbours
+            for n in neighbours:
+                if row not in self._links[l][n]:
+                    self._links[l][n].append(row)
+                    self._shrink(store, n, l, max_links)
+            entries = [n for _, n in found] or entries
+        return entry_level
+
+    def search(self, store, queries: 'ndarray', k: int, ef: int = None):
+        """
+        Search prepared queries, returns (rows, scores) arrays of shape (N, k), larger scores are closer.
+        """
+        ef = max(ef or self.ef, k)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if self._entry < 0:
+            return rows, scores
+        entry_level = max(l for l in range(len(self._links)) if self._entry in self._links[l])
+        for i, query in enumerate(queries):
+            entries = [self._entry]
+            for l in range(entry_level, 0, -1):
+                entries = [self._search_level(store, query, entries, 1, l)[0][1]]
+            found = [(sim, row) for sim, row in self._search_level(store, query, entries, ef, 0)
+                     if store.is_live(row)][:k]
+            for j, (sim, row) in enumerate(found):
+                rows[i, j] = row
+                scores[i, j] = sim
+        return rows, scores
+
+    def save(self, path: str):
+        # Every level is stored as CSR arrays: the rows, their link offsets and the links
+        arrays = {}
+        for l, links in enumerate(self._links):
+            level_rows = np.fromiter(links.keys(), dtype=np.int64, count=len(links))
+            counts = np.fromiter((len(links[r]) for r in level_rows.tolist()), dtype=np.int64, count=len(links))
+            arrays['rows_%d' % l] = level_rows
+            arrays['offsets_%d' % l] = np.concatenate([[0], np.cumsum(counts)])
+            arrays['links_%d' % l] = np.fromiter((n for r in level_rows.tolist() for n in links[r]), dtype=np.int64)
+        np.savez(path, kind=self.kind, m=self.m, ef_construction=self.ef_construction, ef=self.ef, seed=self.seed,
+                 entry=self._entry, levels=len(self._links), **arrays)
+
+    @classmethod
+    def from_arrays(cls, data):
+        index = cls(m=int(data['m']), ef_construction=int(data['ef_construction']), ef=int(data['ef']),
+                    seed=int(data['seed']))
+        index._entry = int(data['entry'])
+        for l in range(int(data['levels'])):
+            level_rows = data['rows_%d' % l].tolist()
+            offsets = data['offsets_%d' % l].tolist()
+            links = data['links_%d' % l].tolist()
+            index._links.append({row: links[offsets[i]:offsets[i + 1]] for i, row in enumerate(level_rows)})
+        return index
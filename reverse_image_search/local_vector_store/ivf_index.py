@@ -0,0 +1,159 @@
+import logging
+
+import numpy as np
+
+from reverse_image_search.vector_codec.vector_codec import assign_centroids, kmeans
+
+logger = logging.getLogger()
+
+# bucket of the rows added before the centroids are trained
+UNTRAINED = -2
+
+
+class IvfIndex:
+    """
+    Inverted file index over a `LocalVectorStore`, the local counterpart of Milvus IVF_FLAT.
+
+    Vectors are bucketed by their nearest k-means centroid, a query only scores the rows of its
+    `nprobe` nearest buckets. Only the centroids and one bucket number per row are kept, the
+    vectors themselves stay in the store. The centroids are trained once `min_train` rows were
+    added, until then the added rows are scanned exhaustively.
+
+    Args:
+        nlist (`int`):
+            The number of buckets.
+        nprobe (`int`):
+            The number of buckets scanned per query, higher is slower with better recall.
+        niter (`int`):
+            The number of k-means iterations when training.
+        min_train (`int`):
+            The number of rows to wait for before training, defaults to 39 * nlist: k-means needs a
+            few dozen points per centroid.
+        max_train (`int`):
+            The maximum number of vectors sampled to train the centroids, defaults to 64 * nlist.
+    """
+
+    kind = 'ivf'
+    # keyword arguments of `search`, accepted by `LocalVectorStore.search`
+    search_params = ('nprobe',)
+
+    def __init__(self, nlist: int = 2048, nprobe: int = 16, niter: int = 20, min_train: int = None,
+                 max_train: int = None):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.min_train = max(min_train or 39 * nlist, nlist)
+        self.max_train = max(max_train or 64 * nlist, self.min_train)
+        self.reset()
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def reset(self):
+        self.centroids = None
+        # bucket of every store row, -1 if not indexed, UNTRAINED while waiting for the centroids
+        self._assign = np.full(0, -1, dtype=np.int32)
+        self._untrained = np.empty(0, dtype=np.int64)
+        self._lists = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+        self._sizes = np.zeros(self.nlist, dtype=np.int64)
+
+    def contains(self, rows: 'ndarray') -> 'ndarray':
+        rows = np.asarray(rows, dtype=np.int64)
+        held = rows < len(self._assign)
+        held[held] = self._assign[rows[held]] != -1
+        return held
+
+    def train(self, vectors: 'ndarray', seed: int = 0):
+        if len(vectors) < self.nlist:
+            raise ValueError('IVF index needs at least nlist=%d training vectors, got %d' % (self.nlist, len(vectors)))
+        if len(vectors) > self.max_train:
+            vectors = vectors[np.sort(np.random.default_rng(seed).choice(len(vectors), self.max_train, replace=False))]
+        self.centroids = kmeans(vectors, self.nlist, self.niter, seed)
+
+    def add(self, store, rows: 'ndarray'):
+        """
+        Index store rows, a row indexed again (overwritten vector) moves to its new bucket.
+        """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if not len(rows):
+            return
+        if len(self._assign) <= rows.max():
+            grown = np.full(max(int(rows.max()) + 1, 2 * len(self._assign)), -1, dtype=np.int32)
+            grown[:len(self._assign)] = self._assign
+            self._assign = grown
+        if not self.is_trained:
+            self._assign[rows] = UNTRAINED
+            self._untrained = np.union1d(self._untrained, rows)
+            if len(self._untrained) < self.min_train:
+                return
+            rows, self._untrained = self._untrained, np.empty(0, dtype=np.int64)
+            logger.info('Training %d IVF centroids on %d rows', self.nlist, len(rows))
+            self.train(store.vectors_of(rows))
+        assign = assign_centroids(store.vectors_of(rows), self.centroids)
+        # A row overwritten within its bucket is already a member of it
+        moved = self._assign[rows] != assign
+        self._assign[rows] = assign
+        rows, assign = rows[moved], assign[moved]
+        if not len(rows):
+            return
+        order = np.argsort(assign, kind='stable')
+        buckets, starts = np.unique(assign[order], return_index=True)
+        for bucket, part in zip(buckets.tolist(), np.split(rows[order], starts[1:])):
+            self._append(bucket, part)
+
+    def _append(self, bucket, rows):
+        size = self._sizes[bucket]
+        members = self._lists[bucket]
+        if size + len(rows) > len(members):
+            grown = np.empty(max(2 * len(members), size + len(rows), 16), dtype=np.int64)
+            grown[:size] = members[:size]
+            self._lists[bucket] = members = grown
+        members[size:size + len(rows)] = rows
+        self._sizes[bucket] = size + len(rows)
+
+    def candidates(self, bucket: int) -> 'ndarray':
+        members = self._lists[bucket][:self._sizes[bucket]]
+        # Rows that moved to another bucket leave a stale entry behind, a row that moved back is listed twice
+        return np.unique(members[self._assign[members] == bucket])
+
+    def search(self, store, queries: 'ndarray', k: int, nprobe: int = None):
+        """
+        Search prepared queries, returns (rows, scores) arrays of shape (N, k), larger scores are closer.
+        """
+        if not self.is_trained:
+            return store.scan(queries, k, self._untrained)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        c_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        probes = np.argsort(c_norms[None, :] - 2 * queries @ self.centroids.T, axis=1)[:, :nprobe]
+        for i, buckets in enumerate(probes):
+            candidates = np.concatenate([self.candidates(bucket) for bucket in buckets.tolist()])
+            found_rows, found_scores = store.scan(queries[i:i + 1], k, candidates)
+            rows[i, :found_rows.shape[1]] = found_rows[0]
+            scores[i, :found_scores.shape[1]] = found_scores[0]
+        return rows, scores
+
+    def save(self, path: str):
+        centroids = self.centroids if self.is_trained else np.empty((0, 0), dtype=np.float32)
+        np.savez(path, kind=self.kind, nlist=self.nlist, nprobe=self.nprobe, niter=self.niter,
+                 min_train=self.min_train, max_train=self.max_train, centroids=centroids, assign=self._assign)
+
+    @classmethod
+    def from_arrays(cls, data):
+        index = cls(nlist=int(data['nlist']), nprobe=int(data['nprobe']), niter=int(data['niter']),
+                    min_train=int(data['min_train']), max_train=int(data['max_train']))
+        if data['centroids'].size:
+            index.centroids = data['centroids']
+        assign = data['assign']
+        index._assign = np.full(len(assign), -1, dtype=np.int32)
+        index._untrained = np.flatnonzero(assign == UNTRAINED)
+        rows = np.flatnonzero(assign >= 0)
+        if len(rows):
+            index._assign[rows] = assign[rows]
+            order = np.argsort(assign[rows], kind='stable')
+            buckets, starts = np.unique(assign[rows][order], return_index=True)
+            for bucket, part in zip(buckets.tolist(), np.split(rows[order], starts[1:])):
+                index._append(bucket, part)
+        return index
@@ -0,0 +1,553 @@
+import collections
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from reverse_image_search.local_vector_store.hnsw_index import HnswIndex
+from reverse_image_search.local_vector_store.ivf_index import IvfIndex
+from reverse_image_search.timing import timed
+from reverse_image_search.utils import document_id
+from reverse_image_search.vector_codec.vector_codec import load_codec, make_codec
+
+logger = logging.getLogger()
+
+METRICS = ('COSINE', 'L2')
+
+# maximum number of rows sampled to train a codec
+MAX_CODEC_TRAIN = 65536
+
+InsertResult = collections.namedtuple('InsertResult', ['insert_count', 'primary_keys'])
+
+INDEX_TYPES = {index_type.kind: index_type for index_type in (IvfIndex, HnswIndex)}
+
+
+def load_index(path: str):
+    """
+    Load an index saved by `save`, the type is read from the file.
+    """
+    with np.load(path) as data:
+        return INDEX_TYPES[str(data['kind'])].from_arrays(data)
+
+
+def top_k(scores: 'ndarray', k: int):
+    """
+    Return the (indices, scores) of the k largest scores of every row, best first.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class LocalVectorStore:
+    """
+    In-process exact vector search, a drop-in for `TcvdbClient` without a server.
+
+    Vectors live in a memory-mapped float32 matrix `vectors.f32` under `path`, the parallel
+    (row, id, path) table is an append-only log `rows.jsonl` replayed on open. Top-k is computed
+    with one matrix product per block of `block_size` rows and partial selection, so the memory
+    per query batch is bounded whatever the collection size.
+
+    With an `index` (`IvfIndex` or `HnswIndex`) the search is approximate: only the rows the
+    index proposes are scored. The index is updated by every upsert and persisted to `index.npz`
+    by `save_index`, a saved index is picked up again on open.
+
+    With a `codec` the exhaustive and IVF scans read compact codes from `codes.bin` instead of the
+    float32 matrix, which stays on disk for the exact `rerank` of the best candidates. Codecs
+    that need training wait until the store holds `codec.min_train` rows.
+
+    Args:
+        path (`str`):
+            The directory holding the store.
+        dim (`int`):
+            The dimension of the vectors.
+        metric (`str`):
+            'COSINE' (scores are similarities, higher is closer) or 'L2' (scores are squared
+            distances, lower is closer, like Milvus).
+        block_size (`int`):
+            The number of stored vectors scored per matrix product.
+        index (`IvfIndex` or `HnswIndex`):
+            An approximate index, None loads the saved one if any, else searches exhaustively.
+        codec (`str` or codec):
+            'float16', 'sq8', 'pq<m>' or a codec of `reverse_image_search.vector_codec`, None loads
+            the saved one if any, else scans float32 vectors.
+        rerank (`int`):
+            The number of candidates re-scored with the float32 vectors when a codec is used, 0
+            returns the approximate scores of the codes.
+    """
+
+    def __init__(self, path: str, dim: int = 2048, metric: str = 'COSINE', block_size: int = 1 << 16,
+                 index=None, codec=None, rerank: int = 0):
+        if metric not in METRICS:
+            raise ValueError('Unsupported metric %s, expected one of %s' % (metric, METRICS))
+        self.path = path
+        self.dim = dim
+        self.metric = metric
+        self.block_size = block_size
+        self._lock = threading.RLock()
+        self._vectors_path = os.path.join(path, 'vectors.f32')
+        self._rows_path = os.path.join(path, 'rows.jsonl')
+        self._index_path = os.path.join(path, 'index.npz')
+        self._codes_path = os.path.join(path, 'codes.bin')
+        self._codec_path = os.path.join(path, 'codec.npz')
+        self.rerank = rerank
+        # Bumped by every write, cached search results are keyed by it
+        self.version = 0
+        os.makedirs(path, exist_ok=True)
+        self._pending = []
+        self._load()
+        self._setup_codec(codec)
+        self.index = None
+        if index is None and os.path.exists(self._index_path):
+            index = load_index(self._index_path)
+        if index is not None:
+            self.attach_index(index)
+
+    def _load(self):
+        self._ids = []
+        self._paths = []
+        self._rows = {}
+        if os.path.exists(self._rows_path):
+            with open(self._rows_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._set_row(entry['row'], entry.get('id'), entry.get('path'))
+        self._count = len(self._ids)
+        self._vectors = None
+        self._open_vectors(max(self._count, 1024))
+        # Rows holding a live document, overwritten and deleted rows are masked out of the search
+        self._valid = np.zeros(self._vectors.shape[0], dtype=bool)
+        self._valid[:self._count] = [row_id is not None for row_id in self._ids]
+        # Squared norms of the stored vectors, used by L2
+        self._sq_norms = np.zeros(self._vectors.shape[0], dtype=np.float32)
+        for start in range(0, self._count, self.block_size):
+            block = self._vectors[start:start + self.block_size]
+            self._sq_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+
+    def _set_row(self, row, row_id, path):
+        while len(self._ids) <= row:
+            self._ids.append(None)
+            self._paths.append(None)
+        old_id = self._ids[row]
+        if old_id is not None and self._rows.get(old_id) == row:
+            del self._rows[old_id]
+        self._ids[row] = row_id
+        self._paths[row] = path
+        if row_id is not None:
+            self._rows[row_id] = row
+
+    def _open_vectors(self, capacity: int):
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        if size < capacity * row_bytes:
+            with open(self._vectors_path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+            size = capacity * row_bytes
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(size // row_bytes, self.dim))
+
+    def _grow(self, needed: int):
+        capacity = self._vectors.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        self._vectors.flush()
+        self._open_vectors(capacity)
+        self._sq_norms = np.concatenate([self._sq_norms, np.zeros(capacity - len(self._sq_norms), np.float32)])
+        self._valid = np.concatenate([self._valid, np.zeros(capacity - len(self._valid), bool)])
+        if self._codes is not None:
+            self._codes.flush()
+            self._open_codes(capacity)
+            self._code_sq_norms = np.concatenate([self._code_sq_norms,
+                                                  np.zeros(capacity - len(self._code_sq_norms), np.float32)])
+
+    def _setup_codec(self, codec):
+        if isinstance(codec, str):
+            codec = make_codec(codec)
+        saved = load_codec(self._codec_path) if os.path.exists(self._codec_path) else None
+        if codec is None or (saved is not None and saved.name == codec.name):
+            codec = saved
+        elif saved is not None:
+            logger.info('Switching %s from %s to %s codes', self.path, saved.name, codec.name)
+            for path in (self._codec_path, self._codes_path):
+                os.remove(path)
+        self.codec = codec
+        self._codes = None
+        self._code_sq_norms = None
+        if codec is None:
+            return
+        row_bytes = codec.code_size(self.dim) * np.dtype(codec.dtype).itemsize
+        if saved is codec and os.path.exists(self._codes_path) \
+                and os.path.getsize(self._codes_path) >= self._count * row_bytes:
+            self._open_codes(self._vectors.shape[0])
+            self._code_sq_norms = np.zeros(self._vectors.shape[0], dtype=np.float32)
+            for start in range(0, self._count, self.block_size):
+                decoded = codec.decode(self._codes[start:start + self.block_size])
+                self._code_sq_norms[start:start + len(decoded)] = np.einsum('ij,ij->i', decoded, decoded)
+        else:
+            self._build_codes()
+
+    def _open_codes(self, capacity: int):
+        width = self.codec.code_size(self.dim)
+        row_bytes = width * np.dtype(self.codec.dtype).itemsize
+        size = os.path.getsize(self._codes_path) if os.path.exists(self._codes_path) else 0
+        if size < capacity * row_bytes:
+            with open(self._codes_path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+            size = capacity * row_bytes
+        self._codes = np.memmap(self._codes_path, dtype=self.codec.dtype, mode='r+', shape=(size // row_bytes, width))
+
+    def _build_codes(self):
+        """
+        Train the codec once enough rows are stored, then encode every row.
+        """
+        if not self.codec.is_trained:
+            live = np.flatnonzero(self._valid[:self._count])
+            if len(live) < self.codec.min_train:
+                return
+            if len(live) > MAX_CODEC_TRAIN:
+                live = np.sort(np.random.default_rng(0).choice(live, MAX_CODEC_TRAIN, replace=False))
+            self.codec.train(np.asarray(self._vectors[live]))
+        self.codec.save(self._codec_path)
+        self._open_codes(self._vectors.shape[0])
+        self._code_sq_norms = np.zeros(self._vectors.shape[0], dtype=np.float32)
+        for start in range(0, self._count, self.block_size):
+            rows = np.arange(start, min(start + self.block_size, self._count))
+            self._encode(rows, self._vectors[start:start + len(rows)])
+        self._codes.flush()
+
+    def _encode(self, rows, vectors):
+        codes = self.codec.encode(vectors)
+        self._codes[rows] = codes
+        decoded = self.codec.decode(codes)
+        self._code_sq_norms[rows] = np.einsum('ij,ij->i', decoded, decoded)
+
+    @property
+    def bytes_per_vector(self) -> int:
+        """
+        The size of one vector as read by the scans.
+        """
+        if self._codes is None:
+            return self.dim * 4
+        return self._codes.shape[1] * self._codes.dtype.itemsize
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _prepare(self, items):
+        vectors = np.asarray(items, dtype=np.float32).reshape(-1, self.dim)
+        if self.metric == 'COSINE':
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+        return vectors
+
+    def __call__(self, path, item):
+        return self.upsert(path, item)
+
+    def upsert(self, path, item, id: str = None):
+        """
+        Insert or overwrite one row, see `TcvdbClient.upsert`.
+        """
+        return self.upsert_many([path], np.asarray(item).reshape(1, -1), ids=[id])
+
+    def upsert_many(self, paths, items, batch_size: int = None, ids=None):
+        """
+        Insert or overwrite many rows, ids default to `document_id(path)` like `TcvdbClient`.
+        `batch_size` is accepted for compatibility with `TcvdbClient.upsert_many`.
+        """
+        vectors = self._prepare(items)
+        ids = [id or document_id(path) for path, id in zip(paths, ids or [None] * len(paths))]
+        with self._lock:
+            rows = []
+            assigned = {}
+            for row_id in ids:
+                row = assigned.get(row_id, self._rows.get(row_id))
+                if row is None:
+                    row = self._count
+                    self._count += 1
+                assigned[row_id] = row
+                rows.append(row)
+            self._grow(self._count)
+            rows = np.asarray(rows, dtype=np.int64)
+            self._vectors[rows] = vectors
+            self._sq_norms[rows] = np.einsum('ij,ij->i', vectors, vectors)
+            self._valid[rows] = True
+            if self._codes is not None:
+                self._encode(rows, vectors)
+            for row, row_id, path in zip(rows.tolist(), ids, paths):
+                self._set_row(row, row_id, path)
+                self._pending.append({'row': row, 'id': row_id, 'path': path})
+            self.flush()
+            self.version += 1
+            if self.codec is not None and self._codes is None:
+                self._build_codes()
+            if self.index is not None:
+                self.index.add(self, np.unique(rows))
+        return InsertResult(len(ids), ids)
+
+    def delete(self, ids, batch_size: int = None):
+        with self._lock:
+            for row_id in ids:
+                row = self._rows.get(row_id)
+                if row is None:
+                    continue
+                self._set_row(row, None, None)
+                self._valid[row] = False
+                self._pending.append({'row': row})
+            self.flush()
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._vectors = None
+            for path in (self._vectors_path, self._rows_path, self._index_path, self._codes_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._pending = []
+            self._load()
+            self.version += 1
+            if self.index is not None:
+                self.index.reset()
+            if self.codec is not None:
+                # A trained codec is kept, the codes are rebuilt empty
+                self._codes = None
+                self._build_codes()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            # Vectors first, a logged row always points at written data
+            self._vectors.flush()
+            if self._codes is not None:
+                self._codes.flush()
+            with open(self._rows_path, 'a') as f:
+                f.write(''.join(json.dumps(entry) + '\n' for entry in self._pending))
+            self._pending = []
+
+    def attach_index(self, index):
+        """
+        Search through `index` from now on, the live rows it does not hold yet are added to it.
+        """
+        with self._lock:
+            rows = np.flatnonzero(self._valid[:self._count])
+            missing = rows[~index.contains(rows)]
+            if len(missing):
+                logger.info('Adding %d rows to the %s index of %s', len(missing), index.kind, self.path)
+                index.add(self, missing)
+            self.index = index
+
+    def save_index(self):
+        """
+        Persist the index to `index.npz`, written to a temporary file and renamed.
+        """
+        with self._lock:
+            if self.index is None:
+                return
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                self.index.save(f)
+            os.replace(tmp_path, self._index_path)
+
+    def search(self, query: 'ndarray', k: int = 10, **params):
+        return self.search_many(np.asarray(query).reshape(1, -1), k, **params)[0]
+
+    def search_many(self, queries: 'ndarray', k: int = 10, max_workers: int = None, **params):
+        """
+        Top-k for an (N, dim) array of queries, returns N lists of [path, score] rows.
+        `max_workers` is accepted for compatibility, the BLAS library already uses all cores.
+        """
+        # Under the lock, a concurrent delete must not clear the paths of the rows found
+        with self._lock:
+            rows, scores = self.search_rows(queries, k, **params)
+            with timed('parse'):
+                return [
+                    [[self._paths[row], float(score)] for row, score in zip(row_list, score_list) if row >= 0]
+                    for row_list, score_list in zip(rows.tolist(), scores.tolist())
+                ]
+
+    def search_rows(self, queries: 'ndarray', k: int = 10, candidates: 'ndarray' = None, exact: bool = False,
+                    rerank: int = None, **params):
+        """
+        Return (rows, scores) arrays of shape (N, k), rows of missing results are -1.
+
+        Args:
+        candidates (`np.ndarray`):
+            Restrict the search to these rows.
+        exact (`bool`):
+            Scan every float32 row even if an index or a codec is used, the reference for recall
+            measurements.
+        rerank (`int`):
+            Override the number of candidates re-scored exactly, see the constructor.
+        params:
+            Search parameters of the index, `nprobe` for IVF or `ef` for HNSW. Other parameters
+            (e.g. the `filter` of `TcvdbClient`) are not supported and raise a TypeError.
+        """
+        unsupported = sorted(set(params).difference(getattr(self.index, 'search_params', ())))
+        if unsupported:
+            raise TypeError('Unsupported search parameters %s for %s' % (
+                unsupported, 'the %s index' % self.index.kind if self.index is not None else 'an exhaustive store'))
+        queries = self._prepare(queries)
+        # Held for the whole search, `upsert_many` grows the arrays and bumps `_count` under it
+        with self._lock, timed('search') as span:
+            rerank = self.rerank if rerank is None else rerank
+            rerank = rerank if self._codes is not None and not exact else 0
+            fetch = max(k, rerank)
+            if self.index is not None and candidates is None and not exact:
+                best_rows, best_scores = self.index.search(self, queries, fetch, **params)
+            else:
+                best_rows, best_scores = self.scan(queries, fetch, candidates, exact)
+            if rerank:
+                best_rows, best_scores = self._rerank(queries, best_rows, k)
+            span.set_items(queries.shape[0])
+        if self.metric == 'L2':
+            best_scores = -best_scores
+        return best_rows, best_scores
+
+    def _similarity(self, queries, block, sq_norms):
+        return self._combine(queries, queries @ block.T, sq_norms)
+
+    def _combine(self, queries, products, sq_norms):
+        # Larger is closer for both metrics, L2 is negated
+        if self.metric == 'COSINE':
+            return products
+        q_norms = np.einsum('ij,ij->i', queries, queries)
+        return -(q_norms[:, None] - 2 * products + sq_norms[None, :])
+
+    def _block_similarity(self, queries, rows, use_codes):
+        # `rows` is a slice or an array of row numbers
+        if use_codes:
+            return self._combine(queries, self.codec.inner_products(queries, self._codes[rows]),
+                                 self._code_sq_norms[rows])
+        return self._similarity(queries, self._vectors[rows], self._sq_norms[rows])
+
+    def _blocks(self, queries, candidates, use_codes):
+        """
+        Yield (rows, scores) per block, slicing the memmap when scanning everything.
+        """
+        if candidates is None:
+            for start in range(0, self._count, self.block_size):
+                end = min(start + self.block_size, self._count)
+                yield np.arange(start, end), self._block_similarity(queries, slice(start, end), use_codes)
+            return
+        candidates = np.asarray(candidates, dtype=np.int64)
+        for start in range(0, len(candidates), self.block_size):
+            rows = candidates[start:start + self.block_size]
+            yield rows, self._block_similarity(queries, rows, use_codes)
+
+    def _rerank(self, queries, rows, k):
+        """
+        Re-score candidate rows (N, R) with the float32 vectors and keep the k best.
+        """
+        safe = np.where(rows >= 0, rows, 0)
+        vectors = np.asarray(self._vectors[safe.ravel()]).reshape(rows.shape + (self.dim,))
+        products = np.einsum('nd,nrd->nr', queries, vectors)
+        if self.metric == 'COSINE':
+            scores = products
+        else:
+            q_norms = np.einsum('ij,ij->i', queries, queries)
+            scores = -(q_norms[:, None] - 2 * products + self._sq_norms[safe])
+        scores = np.where(rows >= 0, scores, -np.inf)
+        idx, best_scores = top_k(scores, k)
+        best_rows = np.take_along_axis(rows, idx, axis=1)
+        return np.where(np.isfinite(best_scores), best_rows, -1), best_scores
+
+    def similarity(self, queries: 'ndarray', rows: 'ndarray') -> 'ndarray':
+        """
+        Scores of prepared queries against stored rows, larger is closer for both metrics.
+        """
+        return self._similarity(queries, self._vectors[rows], self._sq_norms[rows])
+
+    def vectors_of(self, rows: 'ndarray') -> 'ndarray':
+        return np.asarray(self._vectors[rows])
+
+    def is_live(self, row: int) -> bool:
+        return bool(self._valid[row])
+
+    def scan(self, queries: 'ndarray', k: int, candidates: 'ndarray' = None, exact: bool = False):
+        """
+        Top-k of prepared queries over all rows or `candidates`, larger scores are closer.
+        The codes are scanned when a codec is trained, unless `exact`.
+        """
+        n = queries.shape[0]
+        best_rows = np.full((n, 0), -1, dtype=np.int64)
+        best_scores = np.full((n, 0), -np.inf, dtype=np.float32)
+        for rows, scores in self._blocks(queries, candidates, self._codes is not None and not exact):
+            scores = np.where(self._valid[rows][None, :], scores, -np.inf)
+            idx, top = top_k(scores, k)
+            merged_rows = np.concatenate([best_rows, rows[idx]], axis=1)
+            merged_scores = np.concatenate([best_scores, top], axis=1)
+            idx, best_scores = top_k(merged_scores, k)
+            best_rows = np.take_along_axis(merged_rows, idx, axis=1)
+        best_rows = np.where(np.isfinite(best_scores), best_rows, -1)
+        return best_rows, best_scores
+
+    def path_of(self, row: int) -> str:
+        return self._paths[row]
+
+
+# Stores shared by the towhee operators, keyed by directory
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path: str, dim: int = 2048, metric: str = 'COSINE') -> LocalVectorStore:
+    """
+    Return the store for a directory, opened once per process.
+    """
+    with _stores_lock:
+        store = _stores.get(os.path.abspath(path))
+        if store is None:
+            store = LocalVectorStore(path, dim=dim, metric=metric)
+            _stores[os.path.abspath(path)] = store
+        return store
+
+
+class LocalInsertClient:
+    """
+    Insert operator with the `__call__` contract of `ops.ann_insert.milvus_client`.
+
+    Args:
+        path (`str`):
+            The directory of the local store.
+    """
+
+    def __init__(self, path: str, dim: int = 2048, metric: str = 'COSINE'):
+        self._store = open_store(path, dim=dim, metric=metric)
+
+    def __call__(self, path, vector):
+        """
+        Insert one row, returns an object with `insert_count` and `primary_keys` like a Milvus MutationResult.
+        """
+        return self._store.upsert_many([path], np.asarray(vector).reshape(1, -1))
+
+
+class LocalSearchClient:
+    """
+    Search operator with the `__call__` contract of `ops.ann_search.milvus_client`.
+
+    Args:
+        path (`str`):
+            The directory of the local store.
+        limit (`int`):
+            The number of results, defaults to 10.
+    """
+
+    def __init__(self, path: str, dim: int = 2048, metric: str = 'COSINE', limit: int = 10):
+        self._store = open_store(path, dim=dim, metric=metric)
+        self.limit = limit
+
+    def __call__(self, query: 'ndarray'):
+        """
+        Returns a list of [path, score] rows, path being the primary key of the collection.
+        """
+        return self._store.search(query, k=self.limit)
@@ -0,0 +1,5 @@
+from reverse_image_search.micro_batcher.micro_batcher import MicroBatcher
+
+
+def micro_batcher(*args, **kwargs):
+    return MicroBatcher(*args, **kwargs)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from reverse_image_search.timing import timed
+
+logger = logging.getLogger()
+
+# Put on the queue by `close` to stop the worker
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Group concurrent single-item calls into batched calls of `fn`.
+
+    A worker thread takes the first waiting item, then keeps collecting items for at most
+    `max_delay` seconds or until `max_batch_size` items are waiting, and runs `fn` once over the
+    whole batch. Every caller gets the result at its own position. While a batch runs, new items
+    queue up and form the next batch, so the batches grow with the load and a lone request only
+    waits `max_delay`.
+
+    Args:
+        fn:
+            A function mapping a list of items to a list of results of the same length.
+        max_batch_size (`int`):
+            The maximum number of items of one call of `fn`.
+        max_delay (`float`):
+            How long in seconds the first item of a batch waits for more items.
+    """
+
+    def __init__(self, fn, max_batch_size: int = 32, max_delay: float = 0.005):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        """
+        Queue one item, returns a future of its result.
+        """
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    async def run(self, item):
+        """
+        Await the result of one item without blocking the event loop.
+        """
+        return await asyncio.wrap_future(self.submit(item))
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is _STOP:
+                # Serve the collected batch first, then stop
+                self._queue.put(_STOP)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch = [request for request in self._collect(first) if request[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                with timed('micro_batch') as span:
+                    results = self.fn([item for item, _ in batch])
+                    span.set_items(len(batch))
+                if len(results) != len(batch):
+                    raise ValueError('Expected %d results, got %d' % (len(batch), len(results)))
+            except Exception as e:
+                logger.exception('Batch of %d items failed', len(batch))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self):
+        """
+        Serve the queued items and stop the worker.
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,5 @@
+from reverse_image_search.projection.projection import PcaProjection, load_projection
+
+
+def projection(*args, **kwargs):
+    return PcaProjection(*args, **kwargs)
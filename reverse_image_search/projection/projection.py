@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger()
+
+# Bump when the saved arrays change meaning, older files are then refused
+FORMAT_VERSION = 1
+
+
+class PcaProjection:
+    """
+    Learned linear projection of the embeddings to fewer dimensions.
+
+    The principal components are fitted on a sample of the indexed embeddings, an embedding is
+    centered and projected onto the `dim` components of largest variance. With `whiten` every
+    component is also scaled to unit variance, which spreads the similarity over all kept
+    components instead of the few dominant ones.
+
+    The same fitted projection must be applied at ingest and at query time, vectors projected by
+    different fits are not comparable. `version` fingerprints the fitted parameters, it is saved
+    with them, so a refit is detected (the collection has to be re-ingested).
+
+    Args:
+        dim (`int`):
+            The output dimension, e.g. 128, 256 or 512.
+        whiten (`bool`):
+            Scale the components to unit variance.
+        eps (`float`):
+            Added to the variances before whitening, keeps near-zero components from blowing up.
+    """
+
+    def __init__(self, dim: int = 256, whiten: bool = False, eps: float = 1e-6):
+        self.dim = dim
+        self.whiten = whiten
+        self.eps = eps
+        self.mean = None
+        self.components = None
+        self.variances = None
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.components is not None
+
+    @property
+    def in_dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def version(self) -> str:
+        digest = hashlib.sha1(b'%d|%d|%r' % (FORMAT_VERSION, self.whiten, self.eps))
+        for array in (self.mean, self.components):
+            digest.update(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+        return '%s%d%s-%s' % ('pca', self.dim, 'w' if self.whiten else '', digest.hexdigest()[:12])
+
+    def fit(self, vectors: 'ndarray', max_samples: int = 20000, seed: int = 0) -> 'PcaProjection':
+        """
+        Fit on an (N, D) array of embeddings, at most `max_samples` random rows are used.
+        Returns self.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) > max_samples:
+            vectors = vectors[np.random.default_rng(seed).choice(len(vectors), max_samples, replace=False)]
+        if len(vectors) <= self.dim:
+            raise ValueError('Fitting a %d-d projection needs more than %d vectors, got %d'
+                             % (self.dim, self.dim, len(vectors)))
+        mean = vectors.mean(axis=0)
+        centered = (vectors - mean).astype(np.float64)
+        covariance = centered.T @ centered / (len(vectors) - 1)
+        # eigh returns the eigenvalues in ascending order
+        variances, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(variances)[::-1][:self.dim]
+        self.mean = mean
+        self.variances = np.maximum(variances[order], 0).astype(np.float32)
+        self.components = eigenvectors[:, order].astype(np.float32)
+        logger.info('Fitted a %s projection on %d vectors, %.1f%% of the variance kept', self.version,
+                    len(vectors), 100 * float(self.variances.sum()) / max(float(np.maximum(variances, 0).sum()), 1e-12))
+        return self
+
+    def transform(self, vectors: 'ndarray') -> 'ndarray':
+        """
+        Project an (N, D) or (D,) array, returns float32 vectors of `dim` dimensions.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        projected = (vectors - self.mean) @ self.components
+        if self.whiten:
+            projected /= np.sqrt(self.variances + self.eps)
+        return projected
+
+    def __call__(self, vectors: 'ndarray') -> 'ndarray':
+        return self.transform(vectors)
+
+    def save(self, path: str):
+        """
+        Write the fitted parameters and their version, atomically.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp.npz')
+        os.close(fd)
+        try:
+            np.savez(tmp_path, format_version=FORMAT_VERSION, version=self.version, dim=self.dim,
+                     whiten=self.whiten, eps=self.eps, mean=self.mean, components=self.components,
+                     variances=self.variances)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def from_arrays(cls, data):
+        if int(data['format_version']) != FORMAT_VERSION:
+            raise ValueError('Unsupported projection format %d, expected %d'
+                             % (int(data['format_version']), FORMAT_VERSION))
+        projection = cls(dim=int(data['dim']), whiten=bool(data['whiten']), eps=float(data['eps']))
+        projection.mean = data['mean']
+        projection.components = data['components']
+        projection.variances = data['variances']
+        if projection.version != str(data['version']):
+            raise ValueError('The projection parameters do not match their version %s' % data['version'])
+        return projection
+
+
+def load_projection(path: str) -> PcaProjection:
+    with np.load(path) as data:
+        return PcaProjection.from_arrays(data)
@@ -0,0 +1,5 @@
+from reverse_image_search.query_cache.query_cache import LruCache, QueryCache
+
+
+def query_cache(*args, **kwargs):
+    return QueryCache(*args, **kwargs)
@@ -0,0 +1,220 @@
+import collections
+import hashlib
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from reverse_image_search.embedding_cache.embedding_cache import file_key
+
+logger = logging.getLogger()
+
+
+def result_size(rows) -> int:
+    """
+    Rough size in bytes of a list of [path, score] rows.
+    """
+    return sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in rows)
+
+
+class LruCache:
+    """
+    Thread-safe LRU map bounded by the total size of its values, entries also expire after `ttl` seconds.
+
+    Args:
+        max_bytes (`int`):
+            The maximum total size of the values, the least recently used entries are evicted first.
+        ttl (`float`):
+            The lifetime of an entry in seconds, None keeps entries until evicted.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int):
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class QueryCache:
+    """
+    Two-level cache in front of the embedding model and the vector store, for repeated queries.
+
+    Level one maps the content hash of an image to its embedding, level two maps (embedding
+    digest, k, filter, collection version) to the top-k rows. The version is read from
+    `client.version`, which the clients bump on upsert, delete, clear and delete_and_drop, so
+    results never outlive a write made through them. Writes from other processes are only
+    covered by `result_ttl`. Identical requests running concurrently are computed once, the
+    other callers wait for the result.
+
+    `QueryCache` has the `search`/`search_many` methods of the client, other attributes are
+    forwarded to it, so it can be used in place of the client (e.g. wrapped by `AsyncTcvdbClient`).
+
+    Args:
+        client (`TcvdbClient` or `LocalVectorStore`):
+            The vector store client.
+        embed:
+            Optional function embedding an image path into a vector, used by `embedding` and `query`.
+        max_embedding_bytes (`int`):
+            The memory bound of the embeddings.
+        max_result_bytes (`int`):
+            The memory bound of the search results.
+        embedding_ttl (`float`):
+            The lifetime of an embedding in seconds, None keeps it until evicted.
+        result_ttl (`float`):
+            The lifetime of search results in seconds.
+    """
+
+    def __init__(self, client, embed=None, max_embedding_bytes: int = 64 << 20, max_result_bytes: int = 16 << 20,
+                 embedding_ttl: float = None, result_ttl: float = 300.0):
+        self.client = client
+        self.embed = embed
+        self.embeddings = LruCache(max_embedding_bytes, embedding_ttl)
+        self.results = LruCache(max_result_bytes, result_ttl)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _get_or_compute(self, cache: LruCache, key, compute, size):
+        value = cache.get(key)
+        if value is not None:
+            return value
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = compute()
+            cache.put(key, value, size(value))
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def embedding(self, path: str) -> 'ndarray':
+        """
+        The embedding of an image, keyed by its content so a renamed copy hits as well.
+        """
+        return self._get_or_compute(self.embeddings, ('embedding', file_key(path)),
+                                    lambda: np.asarray(self.embed(path), dtype=np.float32), lambda v: v.nbytes)
+
+    def _result_key(self, query, k, filter):
+        digest = hashlib.blake2b(np.ascontiguousarray(query, dtype=np.float32).tobytes(), digest_size=16).digest()
+        return 'result', digest, k, repr(filter), getattr(self.client, 'version', 0)
+
+    def search(self, query: 'ndarray', k: int = 10, filter=None):
+        """
+        Returns a list of [path, score] rows like `client.search`.
+        """
+        kwargs = {'filter': filter} if filter is not None else {}
+        return self._get_or_compute(self.results, self._result_key(query, k, filter),
+                                    lambda: self.client.search(query, k, **kwargs), result_size)
+
+    def search_many(self, queries: 'ndarray', k: int = 10, filter=None, **kwargs):
+        """
+        Search an (N, D) array, the queries missing from the cache are sent in one `client.search_many`.
+        Duplicate queries are sent once, queries already computed by a concurrent call wait for it.
+        """
+        queries = np.asarray(queries).reshape(-1, np.shape(queries)[-1])
+        keys = [self._result_key(query, k, filter) for query in queries]
+        results = [self.results.get(key) for key in keys]
+        # key -> (future, index of its first query) for the queries sent by this call
+        owned = {}
+        waiting = {}
+        with self._inflight_lock:
+            for i, key in enumerate(keys):
+                if results[i] is not None or key in owned or key in waiting:
+                    continue
+                future = self._inflight.get(key)
+                if future is None:
+                    future = self._inflight[key] = Future()
+                    owned[key] = future, i
+                else:
+                    waiting[key] = future
+        if owned:
+            if filter is not None:
+                kwargs['filter'] = filter
+            try:
+                found = self.client.search_many(queries[[i for _, i in owned.values()]], k, **kwargs)
+                for (key, (future, _)), rows in zip(owned.items(), found):
+                    self.results.put(key, rows, result_size(rows))
+                    future.set_result(rows)
+            except BaseException as e:
+                for future, _ in owned.values():
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            finally:
+                with self._inflight_lock:
+                    for key in owned:
+                        del self._inflight[key]
+        computed = {key: future.result() for key, (future, _) in owned.items()}
+        computed.update((key, future.result()) for key, future in waiting.items())
+        return [rows if rows is not None else computed[key] for rows, key in zip(results, keys)]
+
+    def query(self, path: str, k: int = 10, filter=None):
+        """
+        Embed an image (cached) and search it (cached).
+        """
+        return self.search(self.embedding(path), k, filter)
+
+    def invalidate(self):
+        """
+        Drop the cached search results, the embeddings only depend on the model and stay valid.
+        """
+        self.results.clear()
+
+    def stats(self) -> dict:
+        return {name: {'entries': len(cache), 'bytes': cache.size, 'hits': cache.hits, 'misses': cache.misses}
+                for name, cache in (('embeddings', self.embeddings), ('results', self.results))}
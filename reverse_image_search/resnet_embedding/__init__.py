@@ -0,0 +1,5 @@
+from reverse_image_search.resnet_embedding.resnet_embedding import ResnetEmbedding
+
+
+def resnet_embedding(*args, **kwargs):
+    return ResnetEmbedding(*args, **kwargs)
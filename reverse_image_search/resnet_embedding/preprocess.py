@@ -0,0 +1,125 @@
+import collections
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from reverse_image_search.utils import chunked
+
+RESIZE = 256
+CROP = 224
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# Images decoded by one worker task of `PreprocessPool`
+CHUNK_SIZE = 8
+
+# Geometric part of the transform, built once per process
+_crop_transform = None
+
+
+def _get_crop_transform():
+    global _crop_transform
+    if _crop_transform is None:
+        _crop_transform = transforms.Compose([
+            transforms.Resize(RESIZE),
+            transforms.CenterCrop(CROP),
+        ])
+    return _crop_transform
+
+
+def load_image_array(image_path: str) -> 'ndarray':
+    """
+    Decode, resize and center crop one image.
+
+    Returns:
+        A uint8 array of shape (224, 224, 3).
+    """
+    # Read the image Ensure the image is read as RGB
+    with Image.open(image_path) as img:
+        return preprocess_image(img)
+
+
+def preprocess_image(img: 'Image.Image') -> 'ndarray':
+    """
+    Resize and center crop a decoded image, returns a uint8 array of shape (224, 224, 3).
+    """
+    img = _get_crop_transform()(img.convert('RGB'))
+    return np.asarray(img, dtype=np.uint8)
+
+
+def load_image_bytes(data: bytes) -> 'ndarray':
+    """
+    Decode an encoded image (JPEG, PNG, ...) in memory, e.g. an upload, like `load_image_array`.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        return preprocess_image(img)
+
+
+def load_image_arrays(image_paths) -> 'ndarray':
+    """
+    Decode a chunk of images, returns a uint8 array of shape (N, 224, 224, 3).
+    """
+    return np.stack([load_image_array(path) for path in image_paths])
+
+
+def to_tensor_batch(arrays: 'ndarray') -> 'Tensor':
+    """
+    Convert a uint8 (N, H, W, 3) array into a normalized float (N, 3, H, W) tensor,
+    equivalent to `ToTensor` + `Normalize` applied to every image.
+    """
+    batch = torch.from_numpy(np.ascontiguousarray(arrays)).permute(0, 3, 1, 2).float().div_(255)
+    mean = torch.tensor(MEAN, dtype=batch.dtype).view(1, 3, 1, 1)
+    std = torch.tensor(STD, dtype=batch.dtype).view(1, 3, 1, 1)
+    return batch.sub_(mean).div_(std)
+
+
+class PreprocessPool:
+    """
+    Decode and preprocess images in a pool of worker processes.
+
+    Chunks of paths are submitted ahead of the consumer, at most `prefetch` chunks are in flight,
+    so JPEG decode overlaps with the model forward pass while memory stays bounded.
+
+    Args:
+        num_workers (`int`):
+            The number of worker processes, defaults to the number of CPUs.
+        chunk_size (`int`):
+            How many images one worker decodes per task.
+        prefetch (`int`):
+            The maximum number of chunks submitted but not yet consumed, defaults to 2 * num_workers.
+        mp_context:
+            The multiprocessing context passed to the executor.
+    """
+
+    def __init__(self, num_workers: int = None, chunk_size: int = CHUNK_SIZE, prefetch: int = None, mp_context=None):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch or 2 * self.num_workers
+        self._executor = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=mp_context)
+
+    def imap(self, image_paths):
+        """
+        Yield uint8 (224, 224, 3) arrays for `image_paths`, in input order.
+        """
+        pending = collections.deque()
+        for chunk in chunked(image_paths, self.chunk_size):
+            pending.append(self._executor.submit(load_image_arrays, chunk))
+            if len(pending) >= self.prefetch:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
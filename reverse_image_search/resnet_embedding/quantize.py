@@ -0,0 +1,52 @@
+import logging
+import random
+from glob import glob
+
+import torch
+
+from reverse_image_search.resnet_embedding.preprocess import CROP, load_image_arrays, to_tensor_batch
+from reverse_image_search.utils import chunked
+
+logger = logging.getLogger()
+
+
+def calibration_sample(pattern: str = './train/*/*.JPEG', size: int = 256, seed: int = 0) -> list:
+    """
+    A fixed random sample of images to calibrate the activation ranges, the same for every run.
+    """
+    paths = sorted(glob(pattern))
+    return sorted(random.Random(seed).sample(paths, min(size, len(paths))))
+
+
+def quantize_static(model: 'Module', calibration_paths, batch_size: int = 32) -> 'Module':
+    """
+    Post-training static INT8 quantization in FX graph mode.
+
+    Observers are inserted after every convolution (batch norms and ReLUs are fused into them),
+    the calibration images are run through the model to record the activation ranges, then the
+    model is converted to quantized kernels (fbgemm/x86 on CPU). Weights are quantized per
+    channel, activations per tensor.
+
+    Args:
+        model (`Module`):
+            The fp32 model in eval mode.
+        calibration_paths (`list[str]`):
+            Images representative of the catalogue, a few hundred are enough.
+        batch_size (`int`):
+            Images per calibration forward pass.
+
+    Returns:
+        The quantized model, taking and returning float tensors.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    if not calibration_paths:
+        raise ValueError('Static quantization needs calibration images')
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(torch.zeros(1, 3, CROP, CROP),))
+    with torch.inference_mode():
+        for paths in chunked(calibration_paths, batch_size):
+            prepared(to_tensor_batch(load_image_arrays(paths)))
+    logger.info('Calibrated the INT8 model on %d images', len(calibration_paths))
+    return convert_fx(prepared)
@@ -0,0 +1,275 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+import torchvision
+import torchvision.models as models
+from torchvision.models import ResNet50_Weights
+
+from reverse_image_search.resnet_embedding.preprocess import CHUNK_SIZE, CROP, MEAN, RESIZE, STD, PreprocessPool, \
+    load_image_arrays, to_tensor_batch
+from reverse_image_search.resnet_embedding.quantize import calibration_sample, quantize_static
+from reverse_image_search.timing import timed
+from reverse_image_search.utils import chunked
+
+logger = logging.getLogger()
+
+# dimension of the pooled ResNet50 output
+DIM = 2048
+
+# Bump when the exported graph changes, older artifacts are then ignored
+EXPORT_VERSION = 1
+
+
+class ResnetEmbedding:
+    """
+    Extract ResNet50 image embeddings (the 2048-d global average pooled features).
+
+    Args:
+        weights (`ResNet50_Weights`):
+            The torchvision weights to load, defaults to IMAGENET1K_V2.
+        batch_size (`int`):
+            How many images are stacked into one forward pass.
+        num_threads (`int`):
+            The number of intra-op threads used by torch, None keeps the torch default.
+        num_workers (`int`):
+            The number of processes decoding and preprocessing images ahead of the model,
+            0 decodes in the calling thread. Lists of at most `CHUNK_SIZE` images (e.g. a single
+            query) are always decoded in the calling thread, one worker task wouldn't overlap anything.
+        prefetch (`int`):
+            The maximum number of decoded chunks waiting for the model, see `PreprocessPool`.
+        cache (`EmbeddingCache`):
+            Optional embedding cache, only images missing from it go through the model.
+        export_dir (`str`):
+            Optional directory of exported models. The first process traces the model, freezes it
+            (eval-mode batch norms are folded into the convolutions) and saves it there, later
+            processes load the TorchScript file instead of building the model from the weights.
+            None runs the eager torchvision model.
+        quantize (`bool`):
+            Run an INT8 model quantized after training (see `quantize_static`), a few times
+            cheaper on CPU with slightly different embeddings. A failed quantization raises rather
+            than running the fp32 model under the INT8 `model_key`. Use
+            `python -m reverse_image_search.benchmark.drift` to measure the quality change.
+        calibration_paths (`list[str]`):
+            The images calibrating the quantized model, defaults to a fixed sample of `./train`.
+        projection (`PcaProjection`):
+            Optional fitted projection applied to the embeddings returned by `extract` and
+            `extract_arrays`, the embedding cache keeps the full 2048-d vectors.
+
+    The model is only loaded on first use, see `model` and `warmup`.
+    """
+
+    def __init__(self, weights: ResNet50_Weights = ResNet50_Weights.IMAGENET1K_V2, batch_size: int = 32,
+                 num_threads: int = None, num_workers: int = 0, prefetch: int = None, cache=None,
+                 export_dir: str = None, quantize: bool = False, calibration_paths=None, projection=None):
+        if quantize and calibration_paths is None:
+            calibration_paths = calibration_sample()
+        self.quantize = quantize
+        self.calibration_paths = calibration_paths
+        self.weights = weights
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.cache = cache
+        self.export_dir = export_dir
+        self.projection = projection
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._model = None
+        self._model_lock = threading.Lock()
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+    @property
+    def model(self):
+        """
+        The inference model, loaded on first access.
+        """
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    self._model = self._load_exported() if self.export_dir else self._build()
+                    logger.info('Loaded the embedding model in %.2fs', time.perf_counter() - start)
+        return self._model
+
+    def _build(self):
+        model = models.resnet50(weights=self.weights)
+        # Set model to eval mode and drop the classification layer
+        model = model.eval()
+        model = torch.nn.Sequential(*(list(model.children())[:-1]))
+        if not self.quantize:
+            return model
+        try:
+            return quantize_static(model, self.calibration_paths, self.batch_size)
+        except (RuntimeError, ValueError, OSError) as e:
+            raise RuntimeError('INT8 quantization failed, set quantize=False to run the fp32 model') from e
+
+    @property
+    def export_path(self) -> str:
+        """
+        The exported model file, keyed by the weights, the library versions and `EXPORT_VERSION`.
+        """
+        key = '%s|torch=%s|torchvision=%s|crop=%d|v%d' % (self.weights, torch.__version__, torchvision.__version__,
+                                                         CROP, EXPORT_VERSION)
+        if self.quantize:
+            # A different calibration gives a different model
+            key += '|int8=%s|%s' % (torch.backends.quantized.engine, '\n'.join(self.calibration_paths))
+        return os.path.join(self.export_dir, 'resnet50-%s.pt' % hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+    def _load_exported(self):
+        if not os.path.exists(self.export_path):
+            model = self._build()
+            try:
+                self._export(model, self.export_path)
+            except (RuntimeError, OSError) as e:
+                logger.warning('Failed to export the embedding model, running it eagerly: %s', e)
+                return model
+        model = torch.jit.load(self.export_path, map_location='cpu')
+        if self.quantize:
+            return model
+        # The optimizations for the host CPU (e.g. MKLDNN layouts) are applied on load, not saved
+        return torch.jit.optimize_for_inference(model)
+
+    def _export(self, model, path: str):
+        with torch.no_grad():
+            traced = torch.jit.trace(model, torch.zeros(1, 3, CROP, CROP))
+            frozen = torch.jit.freeze(traced)
+        os.makedirs(self.export_dir, exist_ok=True)
+        # Write to a temporary file first, concurrent processes may export at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=self.export_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            torch.jit.save(frozen, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        logger.info('Exported the embedding model to %s', path)
+
+    def warmup(self, batch_size: int = None, iterations: int = 2) -> float:
+        """
+        Load the model and run dummy batches through it, so the first request doesn't pay for
+        the lazy initializations of torch. Returns the time spent in seconds.
+        """
+        start = time.perf_counter()
+        batch = torch.zeros(batch_size or self.batch_size, 3, CROP, CROP)
+        for _ in range(iterations):
+            self.forward(batch)
+        seconds = time.perf_counter() - start
+        logger.info('Warmed up the embedding model in %.2fs', seconds)
+        return seconds
+
+    @property
+    def dim(self) -> int:
+        """
+        The dimension of the returned embeddings, the collections are created with it.
+        """
+        return self.projection.dim if self.projection is not None else DIM
+
+    def _project(self, features: 'ndarray') -> 'ndarray':
+        return self.projection.transform(features) if self.projection is not None else features
+
+    @property
+    def model_key(self) -> str:
+        """
+        Identifies the model weights and preprocessing, used to namespace cached embeddings.
+        """
+        key = 'torchvision/resnet50/%s/resize=%d,crop=%d,mean=%s,std=%s' % (self.weights, RESIZE, CROP, MEAN, STD)
+        # INT8 embeddings differ slightly, they never share cache entries with the fp32 ones
+        return key + '/int8' if self.quantize else key
+
+    def __call__(self, image_paths):
+        return self.extract(image_paths)
+
+    def extract(self, image_paths, batch_size: int = None) -> 'ndarray':
+        """
+        Embed a list or an iterator of image paths.
+
+        Args:
+        image_paths (`Iterable[str]`):
+            The paths of the images to embed.
+        batch_size (`int`):
+            Override the batch size given to the constructor.
+
+        Returns:
+            A float32 array of shape (N, dim), one row per image in input order.
+        """
+        batch_size = batch_size or self.batch_size
+        if self.cache is None:
+            return self._project(self._extract(image_paths, batch_size))
+
+        features = []
+        # Look up a large chunk at a time so the misses still fill whole batches
+        for paths in chunked(image_paths, 64 * batch_size):
+            keys, vectors, missing = self.cache.lookup(paths)
+            if missing:
+                computed = self._extract([paths[i] for i in missing], batch_size)
+                for i, vector in zip(missing, computed):
+                    vectors[i] = vector
+                    self.cache.put(keys[i], vector)
+            features.append(vectors)
+        self.cache.flush()
+        if not features:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return self._project(np.concatenate(features))
+
+    def _extract(self, image_paths, batch_size):
+        features = [self.forward(to_tensor_batch(arrays)) for arrays in self._decode(image_paths, batch_size)]
+        if not features:
+            return np.empty((0, DIM), dtype=np.float32)
+        return np.concatenate(features)
+
+    def extract_arrays(self, arrays: 'ndarray', batch_size: int = None) -> 'ndarray':
+        """
+        Embed already decoded images, a uint8 (N, 224, 224, 3) array as returned by
+        `load_image_array`/`load_image_bytes`. Returns a float32 (N, dim) array.
+        """
+        batch_size = batch_size or self.batch_size
+        features = [self.forward(to_tensor_batch(arrays[i:i + batch_size])) for i in range(0, len(arrays), batch_size)]
+        if not features:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return self._project(np.concatenate(features))
+
+    def _decode(self, image_paths, batch_size):
+        """
+        Yield uint8 (N, 224, 224, 3) batches, decoded by the worker pool when one is configured
+        and the input is more than one pool task.
+        """
+        small = isinstance(image_paths, (list, tuple)) and len(image_paths) <= CHUNK_SIZE
+        if not self.num_workers or small:
+            for batch in chunked(image_paths, batch_size):
+                yield load_image_arrays(batch)
+            return
+        if self._pool is None:
+            # Concurrent first calls (e.g. gradio executor threads) must not start two pools
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = PreprocessPool(num_workers=self.num_workers, prefetch=self.prefetch)
+        for batch in chunked(self._pool.imap(image_paths), batch_size):
+            yield np.stack(batch)
+
+    def forward(self, batch: 'Tensor') -> 'ndarray':
+        """
+        Run one forward pass over a preprocessed N×3×224×224 batch.
+        """
+        with timed('embed') as span, torch.inference_mode():
+            feature = self.model(batch)
+            span.set_items(feature.shape[0])
+        # Reshape the features to 2D
+        feature = feature.reshape(feature.shape[0], -1)
+        return feature.numpy().astype(np.float32, copy=False)
+
+    def close(self):
+        """
+        Stop the preprocessing workers, if any.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
@@ -1,14 +1,27 @@
+import asyncio
 import csv
-import torchvision.transforms as transforms
-from PIL import Image
+import logging
+import os
+import random
+import numpy as np
 import pandas as pd
-import torch
-import torchvision.models as models
 from glob import glob
 from pathlib import Path
 import gradio as gr
 from torchvision.models import ResNet50_Weights
-from reverse_image_search.tcvdb_client import TcvdbClient
+from reverse_image_search.embedding_cache import EmbeddingCache
+from reverse_image_search.ingest_manifest import IngestManifest, incremental_ingest
+from reverse_image_search.ingest_pipeline import IngestCheckpoint, source_fingerprint, streaming_ingest
+from reverse_image_search.local_vector_store import LocalVectorStore
+from reverse_image_search.micro_batcher import MicroBatcher
+from reverse_image_search.projection import PcaProjection, load_projection
+from reverse_image_search.query_cache import QueryCache
+from reverse_image_search.resnet_embedding import ResnetEmbedding
+from reverse_image_search.resnet_embedding.preprocess import load_image_bytes, preprocess_image
+from reverse_image_search.tcvdb_client import AsyncTcvdbClient, TcvdbClient
+from reverse_image_search.thumbnail_store import ThumbnailStore
+
+logger = logging.getLogger()
 
 # tcvdb parameters
 HOST = 'lb-xxx.clb.ap-beijing.tencentclb.com'
@@ -19,19 +32,73 @@ COLLECTION_NAME = 'reverse_image_search'
 PASSWORD = 'xxxxx'
 USERNAME = 'root'
 
+# 'tcvdb' or 'local', the local backend searches an on-disk store in-process and needs no server
+BACKEND = 'tcvdb'
+LOCAL_STORE_PATH = './.local_vector_store'
+# Approximate index of the local backend, e.g. IvfIndex(nlist=1024, nprobe=16) or HnswIndex(m=16, ef=64) from
+# reverse_image_search.local_vector_store, None searches exhaustively or uses the index saved in the store
+LOCAL_INDEX = None
+# Compressed vectors scanned by the local backend: None (float32), 'float16', 'sq8' or 'pq64',
+# the LOCAL_RERANK best candidates are re-scored with the float32 vectors kept on disk
+LOCAL_CODEC = None
+LOCAL_RERANK = 50
+
 # path to csv (column_1 indicates image path) OR a pattern of image paths
 INSERT_SRC = 'reverse_image_search.csv'
 
+# How INSERT_SRC is loaded before serving: None skips the ingest, 'incremental' only embeds and upserts new or
+# changed images and deletes the documents of removed ones (see MANIFEST_PATH), 'streaming' decodes, embeds and
+# upserts concurrently and resumes an interrupted run (see CHECKPOINT_PATH)
+INGEST_MODE = None
+
 # Test Image Path
 TEST_IMAGE_PATH = './test/goldfish/*.JPEG'
 
-# Initialize model
-# model = models.resnet50(pretrained=True)
-model = models.resnet50(weights=ResNet50_Weights.IMAGENET1K_V2)
+# How many images go through one forward pass
+BATCH_SIZE = 32
+# Number of processes decoding ingest batches ahead of the model, 0 decodes in the main process. Query images are
+# always decoded in the process serving the request
+NUM_WORKERS = 4
+
+# Directory of the on-disk embedding cache, None disables it
+CACHE_DIR = './.embedding_cache'
+
+# Local record of the indexed images, used by the incremental ingest
+MANIFEST_PATH = './.ingest_manifest.sqlite'
+
+# Rows of INSERT_SRC acknowledged by the vector store, an interrupted streaming ingest resumes from it
+CHECKPOINT_PATH = './.ingest_checkpoint.sqlite'
+
+# Uploaded queries arriving within MICRO_BATCH_DELAY seconds share one forward pass and one search request,
+# at most MICRO_BATCH_SIZE of them
+MICRO_BATCH_SIZE = BATCH_SIZE
+MICRO_BATCH_DELAY = 0.005
+
+# Directory of the thumbnails shown in the result gallery, and their maximum width and height
+THUMBNAIL_DIR = './.thumbnails'
+THUMBNAIL_SIZE = 256
 
-# Set model to eval mode
-model = model.eval()
-model = torch.nn.Sequential(*(list(model.children())[:-1]))
+# Directory of the exported TorchScript model, None runs the eager torchvision model
+MODEL_EXPORT_DIR = './.model_cache'
+
+# Run the INT8 model calibrated on ./train, cheaper on CPU with slightly different embeddings,
+# see `python -m reverse_image_search.benchmark.drift` for the quality change
+QUANTIZE = False
+
+# Project the embeddings to PROJECTION_DIM dimensions (e.g. 128, 256 or 512) with PCA, None keeps the 2048-d
+# ResNet50 features. The projection is fitted once on PROJECTION_SAMPLE images of INSERT_SRC and saved to
+# PROJECTION_PATH. To refit it delete the file and MANIFEST_PATH, recreate the collection and ingest again
+PROJECTION_DIM = None
+PROJECTION_WHITEN = False
+PROJECTION_PATH = './.projection.npz'
+PROJECTION_SAMPLE = 5000
+
+# The model is loaded on first use, or by the warmup before the web UI starts
+embedding = ResnetEmbedding(weights=ResNet50_Weights.IMAGENET1K_V2, batch_size=BATCH_SIZE,
+                            num_workers=NUM_WORKERS, export_dir=MODEL_EXPORT_DIR, quantize=QUANTIZE)
+if CACHE_DIR:
+    embedding.cache = EmbeddingCache(CACHE_DIR, model_key=embedding.model_key)
+thumbnail_store = ThumbnailStore(THUMBNAIL_DIR, size=THUMBNAIL_SIZE)
 
 
 # Load image path
@@ -43,37 +110,48 @@ def load_image(x):
             for item in reader:
                 yield item[1]
     else:
-        for item in glob(x):
+        # Sorted, the rows of an ingest checkpoint are positions in this listing
+        for item in sorted(glob(x)):
             yield item
 
 
+# Load the saved projection, or fit it on a sample of the indexed images, ingest and queries then use the same one
+def setup_projection():
+    if not PROJECTION_DIM:
+        return
+    if os.path.exists(PROJECTION_PATH):
+        projection = load_projection(PROJECTION_PATH)
+        if (projection.dim, projection.whiten) != (PROJECTION_DIM, PROJECTION_WHITEN):
+            raise ValueError(f'{PROJECTION_PATH} holds a {projection.version} projection, delete it to fit a '
+                             f'{PROJECTION_DIM}-d one and ingest everything again')
+    else:
+        paths = sorted(load_image(INSERT_SRC))
+        sample = random.Random(0).sample(paths, min(PROJECTION_SAMPLE, len(paths)))
+        projection = PcaProjection(PROJECTION_DIM, whiten=PROJECTION_WHITEN).fit(extract_features_batch(sample))
+        projection.save(PROJECTION_PATH)
+    logger.info('Embeddings are projected by %s', projection.version)
+    embedding.projection = projection
+
+
 # Embedding: Function to extract features from an image
 def extract_features(image_path):
-    transform = transforms.Compose([
-        transforms.Resize(256),
-        transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-    # Read the image Ensure the image is read as RGB
-    img = Image.open(image_path).convert('RGB')
-    img = transform(img)
-    img = img.unsqueeze(0)
-    feature = model(img)
-    # Reshape the features to 2D
-    feature = feature.view(feature.shape[0], -1)
-    return feature.detach().numpy()
+    return embedding.extract([image_path])
+
+
+# Embedding: Function to extract features from a list or an iterator of images, returns an N×dim float32 array
+def extract_features_batch(image_paths, batch_size=BATCH_SIZE):
+    return embedding.extract(image_paths, batch_size=batch_size)
 
 
 def display_multiple_embeddings(image_path_pattern):
     # Use glob to get all matching image paths
-    image_paths = load_image(image_path_pattern)
-    # Process each image and collect the results
+    image_paths = list(load_image(image_path_pattern))
+    # Process all images in batches and collect the results
+    features = extract_features_batch(image_paths)
     results = []
-    for img_path in image_paths:
-        feature = extract_features(img_path)
+    for feature in features:
         # Convert features to a pandas DataFrame
-        d = pd.DataFrame(feature)
+        d = pd.DataFrame(feature.reshape(1, -1))
         results.append(d)
 
     # Now 'results' is a list of DataFrames, one for each image.
@@ -83,10 +161,31 @@ def display_multiple_embeddings(image_path_pattern):
         print(d)
 
 
-def search_similar_image(path):
+# Insert data according to INGEST_MODE. The streaming engine logs the per-stage throughput to find the bottleneck
+# and retries failed upserts with backoff, run it again after a crash to resume from the checkpoint
+def ingest(client):
+    if INGEST_MODE is None:
+        return
+    if INGEST_MODE == 'incremental':
+        with IngestManifest(MANIFEST_PATH) as manifest:
+            incremental_ingest(load_image(INSERT_SRC), manifest, extract_features_batch, client,
+                               thumbnails=thumbnail_store)
+    elif INGEST_MODE == 'streaming':
+        with IngestCheckpoint(CHECKPOINT_PATH, source=source_fingerprint(INSERT_SRC)) as checkpoint:
+            streaming_ingest(load_image(INSERT_SRC), embedding, client, checkpoint=checkpoint,
+                             decode_workers=NUM_WORKERS, embed_batch_size=BATCH_SIZE)
+    else:
+        raise ValueError(f"Unknown INGEST_MODE {INGEST_MODE!r}, expected None, 'incremental' or 'streaming'")
+    if BACKEND == 'local':
+        client.save_index()
+
+
+async def search_similar_image(path):
+    loop = asyncio.get_running_loop()
     for query_image in load_image(path):
-        features = extract_features(query_image)
-        search_res = tcvdb_client.search(features)
+        # The model runs on the default executor, the search request on the client's pool, both are cached
+        features = await loop.run_in_executor(None, query_cache.embedding, query_image)
+        search_res = await async_client.search(features)
         # Process the search results
         # 获取 'pred' 字段的值，类如['/root/image-search/reverse_image_search/train/cuirass/n03146219_11082.JPEG',
         # '/root/image-search/reverse_image_search/train/loudspeaker/n03691459_40992.JPEG',
@@ -99,30 +198,63 @@ def search_similar_image(path):
         # '/root/image-search/reverse_image_search/train/minibus/n03769881_619.JPEG',
         # '/root/image-search/reverse_image_search/train/apiary/n02727426_948.JPEG']
         pred = [str(Path(res[0]).resolve()) for res in search_res]
-        print("Query image:", query_image)
-        print("Search results:", pred)
-        return pred
+        logger.debug('Query image: %s, search results: %s', query_image, pred)
+        # The gallery shows thumbnails, missing ones are created off the event loop
+        return await loop.run_in_executor(None, thumbnail_store.thumbnails, pred)
+
+
+def decode_query(image):
+    # Uploads are decoded in memory, gradio hands over a PIL image, API callers may send the encoded bytes
+    if isinstance(image, bytes):
+        return load_image_bytes(image)
+    return preprocess_image(image)
+
+
+def embed_and_search(images):
+    # Called by the micro-batcher with the decoded uploads of concurrent requests, one result list per upload
+    features = embedding.extract_arrays(np.stack(images))
+    return query_cache.search_many(features)
+
+
+async def search_uploaded_image(image):
+    loop = asyncio.get_running_loop()
+    # Decoding runs on the request's own executor thread, only the model and the search are batched
+    query = await loop.run_in_executor(None, decode_query, image)
+    search_res = await batcher.run(query)
+    pred = [str(Path(res[0]).resolve()) for res in search_res]
+    return await loop.run_in_executor(None, thumbnail_store.thumbnails, pred)
 
 
 if __name__ == '__main__':
-    # Initialize the TCVDB client
-    tcvdb_client = TcvdbClient(host=HOST, port=PORT, username=USERNAME, key=PASSWORD,
-                               dbName=DB_NAME, collectionName=COLLECTION_NAME, timeout=20)
+    setup_projection()
+    # 2048, or PROJECTION_DIM when the embeddings are projected
+    dim = embedding.dim
+
+    # Initialize the TCVDB client, or the in-process store with the same upsert/search surface
+    if BACKEND == 'local':
+        tcvdb_client = LocalVectorStore(LOCAL_STORE_PATH, dim=dim, metric='COSINE', index=LOCAL_INDEX,
+                                        codec=LOCAL_CODEC, rerank=LOCAL_RERANK)
+    else:
+        tcvdb_client = TcvdbClient(host=HOST, port=PORT, username=USERNAME, key=PASSWORD,
+                                   dbName=DB_NAME, collectionName=COLLECTION_NAME, timeout=20)
+    # Repeated query images skip the model and repeated searches skip the server until the collection changes
+    query_cache = QueryCache(tcvdb_client, embed=extract_features)
+    # Searches from the web UI are awaited, many requests can be in flight at once
+    async_client = AsyncTcvdbClient(query_cache)
+    # Concurrent uploads are embedded and searched together
+    batcher = MicroBatcher(embed_and_search, max_batch_size=MICRO_BATCH_SIZE, max_delay=MICRO_BATCH_DELAY)
     # 测试前清理环境
     # tcvdb_client.clear()
-    # tcvdb_client.create_db_and_collection()
+    # tcvdb_client.create_db_and_collection(dim)
 
-    # Display embedding result, no need for implementation
-    display_multiple_embeddings(TEST_IMAGE_PATH)
+    # Display embedding result, no need for implementation, only runs with debug logging enabled
+    if logger.isEnabledFor(logging.DEBUG):
+        display_multiple_embeddings(TEST_IMAGE_PATH)
 
-    # Insert data
-    # Read the CSV file to get all image paths, process each row and insert the features into the TCVDB
-    # for image_path in load_image(INSERT_SRC):
-    #     features = extract_features(image_path)
-    #     tcvdb_client.upsert(image_path, features)
+    ingest(tcvdb_client)
 
     # Search for example query image(s), process each query image and search in the TCVDB
-    # search_similar_image(TEST_IMAGE_PATH)
+    # asyncio.run(search_similar_image(TEST_IMAGE_PATH))
 
     # webui
     iface = gr.Interface(
@@ -131,4 +263,12 @@ if __name__ == '__main__':
         outputs=gr.Gallery(label="最终的结果图片").style(height='auto'),
         title='Tencent vector db 案例: 以图搜图',
     )
-    iface.launch()
+    upload_iface = gr.Interface(
+        fn=search_uploaded_image,
+        inputs=gr.components.Image(type='pil', label='上传图片'),
+        outputs=gr.Gallery(label="最终的结果图片").style(height='auto'),
+        title='Tencent vector db 案例: 以图搜图',
+    )
+    # Load the model and run a dummy batch before serving, the first request isn't slower than the next ones
+    embedding.warmup(MICRO_BATCH_SIZE)
+    gr.TabbedInterface([iface, upload_iface], ['路径搜索', '上传搜索']).launch()
@@ -1,28 +1,23 @@
 import numpy as np
-import json
-import tcvectordb
-from tcvectordb.model.enum import FieldType, IndexType, MetricType, EmbeddingModel, ReadConsistency
 
-
-def print_object(obj):
-    for elem in obj:
-        if hasattr(elem, '__dict__'):
-            print(json.dumps(vars(elem), indent=2))
-        else:
-            print(json.dumps(elem, indent=2))
+from reverse_image_search.tcvdb_client.connection_pool import DEFAULT_POOL_SIZE, get_client, get_collection
+from reverse_image_search.tcvdb_client.tcvdb_client import hits_to_rows, search_in_groups
+from reverse_image_search.timing import timed
+from reverse_image_search.utils import to_float_lists
 
 
 class SearchTcvdbClient():
     def __init__(self, host: str, port: str, username: str, key: str, dbName: str, collectionName: str,
-                 timeout: int = 20, **kwargs):
+                 timeout: int = 20, pool_size: int = DEFAULT_POOL_SIZE, **kwargs):
         """
         初始化客户端
+
+        相同地址和账号的客户端共用一个 VectorDBClient 及其 keep-alive 连接池（最多 pool_size 个连接）。
         """
-        # 创建客户端时可以指定 read_consistency，后续调用 sdk 接口的 read_consistency 将延用该值
         self.collectionName = collectionName
         self.db_name = dbName
-        self._client = tcvectordb.VectorDBClient(url="http://" + host + ":" + port, username=username, key=key,
-                                                 read_consistency=ReadConsistency.EVENTUAL_CONSISTENCY, timeout=timeout)
+        self._client = get_client("http://" + host + ":" + port, username=username, key=key, timeout=timeout,
+                                  pool_size=pool_size)
         self.kwargs = kwargs
 
         if 'limit' not in self.kwargs:
@@ -34,25 +29,40 @@ class SearchTcvdbClient():
             **self.kwargs
         )
 
-        result = []
-        # 过滤只显示指定的变量
-        for hit in tcvdb_result[0]:
-            row = []
-            row.extend([hit["path"], hit["score"]])
-            result.append(row)
-        return result
+        return hits_to_rows(tcvdb_result[0])
 
-    def query_data(self, query: [], **kwargs):
-        # 获取 Collection 对象
-        db = self._client.database(self.db_name)
-        coll = db.collection(self.collectionName)
-        vector = query
-        if isinstance(query, np.ndarray):
-            vector = list(map(float, query))  # Convert ndarray to list and float32 to float
+    def search_many(self, queries: 'ndarray', k: int = None, max_workers: int = 1):
+        """
+        Search many query vectors, `MAX_SEARCH_VECTORS` per request.
+
+        Args:
+        queries (`np.ndarray`):
+            The query vectors, shape (N, D).
+        k (`int`):
+            The number of results per query, defaults to the `limit` given to the constructor.
+        max_workers (`int`):
+            The number of requests in flight at the same time.
 
-        # print(type(vector))
-        # print(type(vector[0]))
-        # print(vector)
+        Returns:
+            N lists of [path, score] rows, in the order of `queries`.
+        """
+        kwargs = dict(self.kwargs, limit=k or self.kwargs['limit'])
+        vectors = to_float_lists(queries)
+        results = search_in_groups(lambda group: self.query_data(group, **kwargs), vectors, max_workers)
+        return [hits_to_rows(hits) for hits in results]
+
+    def query_data(self, query: [], **kwargs):
+        """
+        Search one or more vectors, `kwargs` are passed to `collection.search` (`limit`, `filter`, `params`, ...).
+        """
+        # 获取 Collection 对象，只在第一次调用时解析
+        coll = get_collection(self._client, self.db_name, self.collectionName)
+        # Convert ndarray to list and float32 to float, one vector per row
+        with timed('serialize') as span:
+            vectors = to_float_lists(query)
+            span.set_items(len(vectors))
+        kwargs.setdefault('retrieve_vector', False)  # 是否需要返回向量字段，False：不返回，True：返回
+        kwargs.setdefault('limit', 10)  # 指定 Top K 的 K 值
 
         # search
         # 1. search 提供按照 vector 搜索的能力
@@ -61,15 +71,15 @@ class SearchTcvdbClient():
         # 批量相似性查询，根据指定的多个向量查找多个 Top K 个相似性结果
         # query_all = coll.query(document_ids=document_ids, retrieve_vector=True, limit=2)
         # query_document_vector = [x.get("vector") for x in query_all]
-        res = coll.search(
-            vectors=[vector],  # 指定检索向量，最多指定20个
-            # params=SearchParams(ef=200),  # 若使用HNSW索引，则需要指定参数ef，ef越大，召回率越高，但也会影响检索速度
-            retrieve_vector=False,  # 是否需要返回向量字段，False：不返回，True：返回
-            limit=10,  # 指定 Top K 的 K 值
-            # filter=filter_param  # 对搜索结果进行过滤
-        )
-        # 输出相似性检索结果，检索结果为二维数组，每一位为一组返回结果，分别对应search时指定的多个向量
-        print_object(res)
+        with timed('network') as span:
+            res = coll.search(
+                vectors=vectors,  # 指定检索向量，最多指定20个
+                # params=SearchParams(ef=200),  # 若使用HNSW索引，则需要指定参数ef，ef越大，召回率越高，但也会影响检索速度
+                # filter=filter_param  # 对搜索结果进行过滤
+                **kwargs
+            )
+            # 检索结果为二维数组，每一位为一组返回结果，分别对应search时指定的多个向量
+            span.set_items(sum(len(hits) for hits in res))
         return res
 
         # 通过 embedding 文本搜索
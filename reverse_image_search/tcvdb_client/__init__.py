@@ -1,3 +1,4 @@
+from reverse_image_search.tcvdb_client.async_tcvdb_client import AsyncTcvdbClient
 from reverse_image_search.tcvdb_client.tcvdb_client import TcvdbClient
 
 
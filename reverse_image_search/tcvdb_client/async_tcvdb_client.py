@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from reverse_image_search.tcvdb_client.connection_pool import DEFAULT_POOL_SIZE
+from reverse_image_search.tcvdb_client.tcvdb_client import MAX_SEARCH_VECTORS
+
+logger = logging.getLogger()
+
+
+class AsyncTcvdbClient:
+    """
+    Asyncio API over a `TcvdbClient` (or a `LocalVectorStore`, which has the same methods).
+
+    The tcvectordb SDK is a blocking HTTP client, every request runs on a thread of a dedicated
+    pool while the event loop keeps serving other coroutines. At most `max_concurrency` requests
+    are in flight, further calls wait on a semaphore, so keep it at or below the `pool_size` of
+    the client to reuse keep-alive connections.
+
+    Args:
+        client (`TcvdbClient`):
+            The blocking client.
+        max_concurrency (`int`):
+            The maximum number of requests in flight.
+    """
+
+    def __init__(self, client, max_concurrency: int = DEFAULT_POOL_SIZE):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='tcvdb')
+        # Created lazily, a semaphore is bound to the event loop running when it is first awaited
+        self._semaphore = None
+
+    async def _run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def search(self, query: 'ndarray', k: int = 10):
+        """
+        Returns a list of [path, score] rows.
+        """
+        return await self._run(self.client.search, query, k)
+
+    async def search_many(self, queries: 'ndarray', k: int = 10):
+        """
+        Search an (N, D) array of queries, one request per `MAX_SEARCH_VECTORS` queries, all in flight
+        together within the concurrency bound. Returns N lists of [path, score] rows in input order.
+        """
+        queries = np.asarray(queries).reshape(-1, np.shape(queries)[-1])
+        groups = [queries[i:i + MAX_SEARCH_VECTORS] for i in range(0, len(queries), MAX_SEARCH_VECTORS)]
+        results = await asyncio.gather(*(self._run(self.client.search_many, group, k) for group in groups))
+        return [rows for group in results for rows in group]
+
+    async def upsert_many(self, paths, items, batch_size: int = 100, ids=None):
+        """
+        Upsert rows with one request per `batch_size` rows, the requests run concurrently.
+        """
+        ids = ids or [None] * len(paths)
+        await asyncio.gather(*(
+            self._run(self.client.upsert_many, paths[i:i + batch_size], items[i:i + batch_size], batch_size,
+                      ids[i:i + batch_size])
+            for i in range(0, len(paths), batch_size)
+        ))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
@@ -0,0 +1,90 @@
+import inspect
+import threading
+
+import tcvectordb
+from requests.adapters import HTTPAdapter
+from tcvectordb.model.enum import ReadConsistency
+
+# 每个 host 保持的 keep-alive 连接数，按并发调用数设置
+DEFAULT_POOL_SIZE = 32
+
+_lock = threading.Lock()
+_clients = {}
+_databases = {}
+_collections = {}
+
+
+def get_client(url: str, username: str, key: str, timeout: int = 20,
+               pool_size: int = DEFAULT_POOL_SIZE) -> tcvectordb.VectorDBClient:
+    """
+    Return the VectorDBClient shared by every Tcvdb client and operator instance with the same endpoint,
+    credentials and settings, its HTTP session keeps up to `pool_size` connections alive.
+    """
+    cache_key = (url, username, key, timeout, pool_size)
+    with _lock:
+        client = _clients.get(cache_key)
+        if client is None:
+            client = _create_client(url, username, key, timeout, pool_size)
+            _clients[cache_key] = client
+        return client
+
+
+def _create_client(url, username, key, timeout, pool_size):
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    # 创建客户端时可以指定 read_consistency，后续调用 sdk 接口的 read_consistency 将延用该值
+    kwargs = dict(url=url, username=username, key=key, read_consistency=ReadConsistency.EVENTUAL_CONSISTENCY,
+                  timeout=timeout)
+    if 'adapter' in inspect.signature(tcvectordb.VectorDBClient.__init__).parameters:
+        return tcvectordb.VectorDBClient(adapter=adapter, **kwargs)
+
+    client = tcvectordb.VectorDBClient(**kwargs)
+    # SDK versions without the `adapter` argument, mount the pool on the session directly
+    session = getattr(getattr(client, '_conn', None), 'session', None)
+    if session is not None:
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return client
+
+
+def get_database(client: tcvectordb.VectorDBClient, db_name: str):
+    """
+    Resolve a database handle once, `client.database()` lists all databases on every call.
+    """
+    cache_key = (id(client), db_name)
+    db = _databases.get(cache_key)
+    if db is None:
+        with _lock:
+            db = _databases.get(cache_key)
+            if db is None:
+                db = client.database(db_name)
+                _databases[cache_key] = db
+    return db
+
+
+def get_collection(client: tcvectordb.VectorDBClient, db_name: str, collection_name: str):
+    """
+    Resolve a collection handle once, `db.collection()` describes the collection on every call.
+    """
+    cache_key = (id(client), db_name, collection_name)
+    coll = _collections.get(cache_key)
+    if coll is None:
+        db = get_database(client, db_name)
+        with _lock:
+            coll = _collections.get(cache_key)
+            if coll is None:
+                coll = db.collection(collection_name)
+                _collections[cache_key] = coll
+    return coll
+
+
+def invalidate(client: tcvectordb.VectorDBClient, db_name: str, collection_name: str = None):
+    """
+    Forget cached handles after a drop or re-create, `collection_name` None forgets the whole database.
+    """
+    with _lock:
+        if collection_name is None:
+            _databases.pop((id(client), db_name), None)
+            for cache_key in [k for k in _collections if k[:2] == (id(client), db_name)]:
+                del _collections[cache_key]
+        else:
+            _collections.pop((id(client), db_name, collection_name), None)
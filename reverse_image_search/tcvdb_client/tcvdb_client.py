@@ -1,13 +1,24 @@
 import logging
-import uuid
+import threading
 import json
-import tcvectordb
+from concurrent.futures import ThreadPoolExecutor
 from tcvectordb.model.document import Document
-from tcvectordb.model.enum import FieldType, IndexType, MetricType, ReadConsistency
+from tcvectordb.model.enum import FieldType, IndexType, MetricType
 from tcvectordb.model.index import Index, VectorIndex, FilterIndex, HNSWParams
 
+from reverse_image_search.tcvdb_client.connection_pool import DEFAULT_POOL_SIZE, get_client, get_collection, \
+    get_database, invalidate
+from reverse_image_search.timing import timed
+from reverse_image_search.utils import document_id, to_float_list, to_float_lists
+
 logger = logging.getLogger()
 
+# 单次 upsert 请求最多写入的文档数
+MAX_UPSERT_BATCH = 1000
+
+# 单次 search 请求最多指定的检索向量数
+MAX_SEARCH_VECTORS = 20
+
 
 def print_object(obj):
     for elem in obj:
@@ -17,39 +28,172 @@ def print_object(obj):
             print(json.dumps(elem, indent=2))
 
 
+def hits_to_rows(hits):
+    # 过滤只显示指定的变量
+    with timed('parse') as span:
+        rows = [[hit["path"], hit["score"]] for hit in hits]
+        span.set_items(len(rows))
+    return rows
+
+
+def search_in_groups(search, vectors, max_workers: int = 1):
+    """
+    Split `vectors` into groups of at most `MAX_SEARCH_VECTORS`, call `search(group)` for every group,
+    from a thread pool when `max_workers` > 1, and return the hit lists of all vectors in input order.
+    """
+    groups = [vectors[i:i + MAX_SEARCH_VECTORS] for i in range(0, len(vectors), MAX_SEARCH_VECTORS)]
+    if max_workers > 1 and len(groups) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(groups))) as executor:
+            results = list(executor.map(search, groups))
+    else:
+        results = [search(group) for group in groups]
+    return [hits for result in results for hits in result]
+
+
+class TcvdbWriter:
+    """
+    Buffer documents and upsert them in chunks.
+
+    A chunk is sent once `batch_size` documents are buffered or the oldest buffered document is
+    older than `max_delay` seconds, whichever comes first. Call `flush()` or use the writer as a
+    context manager to send the remainder.
+
+    Args:
+        client (`TcvdbClient`):
+            The client the documents are written with.
+        batch_size (`int`):
+            The number of documents per upsert request, at most `MAX_UPSERT_BATCH`.
+        max_delay (`float`):
+            The maximum time in seconds a document stays in the buffer.
+    """
+
+    def __init__(self, client: 'TcvdbClient', batch_size: int = 100, max_delay: float = 5.0):
+        self._client = client
+        self.batch_size = min(batch_size, MAX_UPSERT_BATCH)
+        self.max_delay = max_delay
+        self._buffer = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _start_timer(self):
+        if not self._buffer:
+            self._arm_timer()
+
+    def _arm_timer(self):
+        if self.max_delay != float('inf'):
+            # Flush from a timer thread, so a partial chunk is sent even if no more rows arrive
+            self._timer = threading.Timer(self.max_delay, self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            # Nobody waits on the timer thread, `_flush` re-armed the timer for the rows still buffered
+            logger.exception('Failed to flush %d buffered documents to tcvdb', len(self._buffer))
+
+    def add(self, path, item, id: str = None):
+        with self._lock:
+            self._start_timer()
+            with timed('serialize'):
+                vector = to_float_list(item)
+            self._buffer.append(Document(id=id or document_id(path), path=path, vector=vector))
+            if len(self._buffer) >= self.batch_size:
+                self._flush()
+
+    def add_many(self, paths, items, ids=None):
+        """
+        Add many rows, `items` being an (N, D) array converted in one pass.
+        """
+        with timed('serialize') as span:
+            vectors = to_float_lists(items)
+            span.set_items(len(vectors))
+        ids = ids or [None] * len(paths)
+        with self._lock:
+            self._start_timer()
+            for path, vector, id in zip(paths, vectors, ids):
+                self._buffer.append(Document(id=id or document_id(path), path=path, vector=vector))
+            if len(self._buffer) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        try:
+            while self._buffer:
+                # Only drop a chunk from the buffer once it was written
+                self._client.upsert_data(self._buffer[:self.batch_size])
+                self._buffer = self._buffer[self.batch_size:]
+        finally:
+            # After a failed upsert the rows left are retried by the timer, even if no more rows arrive
+            if self._buffer and self._timer is None:
+                self._arm_timer()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class TcvdbClient:
 
     def __init__(self, host: str, port: str, username: str, key: str, dbName: str, collectionName: str,
-                 timeout: int = 20):
+                 timeout: int = 20, batch_size: int = 1, max_delay: float = 5.0, pool_size: int = DEFAULT_POOL_SIZE):
         """
         初始化客户端
+
+        `batch_size` 和 `max_delay` 只影响作为 towhee 算子调用（`__call__`）时的写入方式：
+        batch_size 大于 1 时，数据先缓存，攒够 batch_size 条或超过 max_delay 秒后批量写入。
+        相同地址和账号的客户端共用一个 VectorDBClient 及其 keep-alive 连接池（最多 pool_size 个连接）。
         """
-        # 创建客户端时可以指定 read_consistency，后续调用 sdk 接口的 read_consistency 将延用该值
         self.collectionName = collectionName
         self.db_name = dbName
-        self._client = tcvectordb.VectorDBClient(url="http://" + host + ":" + port, username=username, key=key,
-                                                 read_consistency=ReadConsistency.EVENTUAL_CONSISTENCY, timeout=timeout)
+        self._client = get_client("http://" + host + ":" + port, username=username, key=key, timeout=timeout,
+                                  pool_size=pool_size)
+        self._writer = TcvdbWriter(self, batch_size=batch_size, max_delay=max_delay) if batch_size > 1 else None
+        # 每次写入、删除或重建后递增，缓存的检索结果以此判断是否过期（只统计本进程内的修改）
+        self.version = 0
+
+    def _collection(self):
+        # 获取 Collection 对象，只在第一次调用时解析，drop 或重建后失效
+        return get_collection(self._client, self.db_name, self.collectionName)
 
     def clear(self):
-        db = self._client.database(self.db_name)
+        db = get_database(self._client, self.db_name)
+        invalidate(self._client, self.db_name)
         db.drop_database(self.db_name)
+        self.version += 1
 
     def delete_and_drop(self):
-        db = self._client.database(self.db_name)
+        db = get_database(self._client, self.db_name)
+        invalidate(self._client, self.db_name)
 
         # 删除collection，删除collection的同时，其中的数据也将被全部删除
         db.drop_collection(self.collectionName)
 
         # 删除db，db下的所有collection都将被删除
         db.drop_database(self.db_name)
+        self.version += 1
 
-    def create_db_and_collection(self):
+    def create_db_and_collection(self, dim: int = 2048):
+        # dim 为向量维度，使用 PCA 降维时传入降维后的维度
         database = self.db_name
         coll_embedding_name = self.collectionName
         coll_alias = self.collectionName + "-alias"
 
         # 创建DB
         db = self._client.create_database(database)
+        invalidate(self._client, self.db_name)
 
         database_list = self._client.list_databases()
         for db_item in database_list:
@@ -74,7 +218,7 @@ class TcvdbClient:
         #             multilingual-e5-base        ｜ 768
         #     -----------------------------------------------------
         index = Index()
-        index.add(VectorIndex('vector', 2048, IndexType.HNSW, MetricType.COSINE, HNSWParams(m=16, efconstruction=200)))
+        index.add(VectorIndex('vector', dim, IndexType.HNSW, MetricType.COSINE, HNSWParams(m=16, efconstruction=200)))
         index.add(FilterIndex('id', FieldType.String, IndexType.PRIMARY_KEY))
         # index.add(FilterIndex('bookName', FieldType.String, IndexType.FILTER))
         index.add(FilterIndex('path', FieldType.String, IndexType.FILTER))
@@ -111,13 +255,14 @@ class TcvdbClient:
         db.delete_alias(coll_alias)
 
     def upsert_data(self, document_list):
-        # 获取 Collection 对象
-        db = self._client.database(self.db_name)
-        coll = db.collection(self.collectionName)
+        coll = self._collection()
         # upsert 写入数据，可能会有一定延迟
         # 1. 支持动态 Schema，除了 id、vector 字段必须写入，可以写入其他任意字段；
         # 2. upsert 会执行覆盖写，若文档id已存在，则新数据会直接覆盖原有数据(删除原有数据，再插入新数据)
-        coll.upsert(documents=document_list)
+        with timed('upsert') as span:
+            coll.upsert(documents=document_list)
+            span.set_items(len(document_list))
+        self.version += 1
 
     # def upsert_data_test(self):
     #     # 获取 Collection 对象
@@ -139,7 +284,52 @@ class TcvdbClient:
     #     ]
     #     coll.upsert(documents=document_list)
 
-    def upsert(self, path, item):
+    def __call__(self, path, item):
+        """
+        Insert one row to Tcvdb, buffered when the client was created with `batch_size` > 1.
+        """
+        if self._writer is None:
+            return self.upsert(path, item)
+        return self._writer.add(path, item)
+
+    def flush(self):
+        """
+        Send the rows buffered by `__call__`.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def writer(self, batch_size: int = 100, max_delay: float = 5.0) -> TcvdbWriter:
+        """
+        Create a buffered writer, see `TcvdbWriter`.
+        """
+        return TcvdbWriter(self, batch_size=batch_size, max_delay=max_delay)
+
+    def upsert_many(self, paths, items, batch_size: int = 100, ids=None):
+        """
+        Insert many rows to Tcvdb, `batch_size` rows per request.
+
+        Args:
+        paths (`List[str]`):
+            The paths of the images to insert into Tcvdb.
+        items (`np.ndarray`):
+            The feature vectors of the images, one row per path.
+        ids (`List[str]`):
+            The document ids, defaults to `document_id(path)` for every path.
+        """
+        with self.writer(batch_size=batch_size, max_delay=float('inf')) as writer:
+            writer.add_many(paths, items, ids=ids)
+
+    def delete(self, ids, batch_size: int = MAX_UPSERT_BATCH):
+        """
+        Delete documents by id.
+        """
+        coll = self._collection()
+        for i in range(0, len(ids), batch_size):
+            coll.delete(document_ids=list(ids[i:i + batch_size]))
+        self.version += 1
+
+    def upsert(self, path, item, id: str = None):
         """
         Insert one row to Tcvdb.
 
@@ -148,9 +338,11 @@ class TcvdbClient:
             The path of the image to insert into Tcvdb.
         item (`np.ndarray`):
             The feature vector of the image.
+        id (`str`):
+            The document id, defaults to `document_id(path)` so re-inserting a path overwrites it.
         """
-        # Convert ndarray to list and float32 to float
-        vector = list(map(float, item.ravel()))
+        with timed('serialize'):
+            vector = to_float_list(item)
         # for item in data:
         #     if isinstance(item, np.ndarray):
         #         # Convert ndarray to list and float32 to float
@@ -160,10 +352,9 @@ class TcvdbClient:
         #     else:
         #         path = item
 
-        # Generate a random UUID and convert to string
         document_list = [
             Document(
-                id=str(uuid.uuid4()),
+                id=id or document_id(path),
                 path=path,
                 vector=vector),
         ]
@@ -171,28 +362,46 @@ class TcvdbClient:
         self.upsert_data(document_list)
         return
 
-    def search(self, query: 'ndarray'):
-        tcvdb_result = self.query_data(query)
-
-        result = []
-        # 过滤只显示指定的变量
-        for hit in tcvdb_result[0]:
-            row = []
-            row.extend([hit["path"], hit["score"]])
-            result.append(row)
-        return result
-
-    def query_data(self, query: []):
-        # 获取 Collection 对象
-        db = self._client.database(self.db_name)
-        coll = db.collection(self.collectionName)
-        vector = query
-        # if isinstance(query, np.ndarray):
-        #     vector = list(map(float, query))  # Convert ndarray to list and float32 to float
-        vector = list(map(float, query.ravel()))
-        # print(type(vector))
-        # print(type(vector[0]))
-        # print(vector)
+    def __del__(self):
+        if getattr(self, '_writer', None) is None:
+            return
+        try:
+            self._writer.flush()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to flush buffered rows to Tcvdb')
+
+    def search(self, query: 'ndarray', k: int = 10, filter=None):
+        tcvdb_result = self.query_data(query, limit=k, filter=filter)
+        return hits_to_rows(tcvdb_result[0])
+
+    def search_many(self, queries: 'ndarray', k: int = 10, max_workers: int = 1, filter=None):
+        """
+        Search many query vectors, `MAX_SEARCH_VECTORS` per request.
+
+        Args:
+        queries (`np.ndarray`):
+            The query vectors, shape (N, D).
+        k (`int`):
+            The number of results per query.
+        max_workers (`int`):
+            The number of requests in flight at the same time.
+        filter (`Filter`):
+            Optional tcvectordb filter on the scalar fields.
+
+        Returns:
+            N lists of [path, score] rows, in the order of `queries`.
+        """
+        vectors = to_float_lists(queries)
+        results = search_in_groups(lambda group: self.query_data(group, limit=k, filter=filter), vectors,
+                                   max_workers)
+        return [hits_to_rows(hits) for hits in results]
+
+    def query_data(self, query: [], limit: int = 10, filter=None):
+        coll = self._collection()
+        # Convert ndarray to list and float32 to float, one vector per row
+        with timed('serialize') as span:
+            vectors = to_float_lists(query)
+            span.set_items(len(vectors))
 
         # search
         # 1. search 提供按照 vector 搜索的能力
@@ -201,15 +410,16 @@ class TcvdbClient:
         # 批量相似性查询，根据指定的多个向量查找多个 Top K 个相似性结果
         # query_all = coll.query(document_ids=document_ids, retrieve_vector=True, limit=2)
         # query_document_vector = [x.get("vector") for x in query_all]
-        res = coll.search(
-            vectors=[vector],  # 指定检索向量，最多指定20个
-            # params=SearchParams(ef=200),  # 若使用HNSW索引，则需要指定参数ef，ef越大，召回率越高，但也会影响检索速度
-            retrieve_vector=False,  # 是否需要返回向量字段，False：不返回，True：返回
-            limit=10,  # 指定 Top K 的 K 值
-            # filter=filter_param  # 对搜索结果进行过滤
-        )
-        # 输出相似性检索结果，检索结果为二维数组，每一位为一组返回结果，分别对应search时指定的多个向量
-        print_object(res)
+        with timed('network') as span:
+            res = coll.search(
+                vectors=vectors,  # 指定检索向量，最多指定20个
+                # params=SearchParams(ef=200),  # 若使用HNSW索引，则需要指定参数ef，ef越大，召回率越高，但也会影响检索速度
+                retrieve_vector=False,  # 是否需要返回向量字段，False：不返回，True：返回
+                limit=limit,  # 指定 Top K 的 K 值
+                filter=filter  # 对搜索结果进行过滤
+            )
+            # 检索结果为二维数组，每一位为一组返回结果，分别对应search时指定的多个向量
+            span.set_items(sum(len(hits) for hits in res))
         return res
 
         # 通过 embedding 文本搜索
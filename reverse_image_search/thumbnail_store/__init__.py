@@ -0,0 +1,5 @@
+from reverse_image_search.thumbnail_store.thumbnail_store import ThumbnailStore
+
+
+def thumbnail_store(*args, **kwargs):
+    return ThumbnailStore(*args, **kwargs)
@@ -0,0 +1,113 @@
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from reverse_image_search.embedding_cache.embedding_cache import file_key
+
+logger = logging.getLogger()
+
+# file extension of every supported thumbnail format
+EXTENSIONS = {'WEBP': '.webp', 'JPEG': '.jpg'}
+
+
+class ThumbnailStore:
+    """
+    Content-addressed cache of fixed-size thumbnails, so galleries ship a few KB per result
+    instead of the full-resolution original.
+
+    A thumbnail is stored at `<cache_dir>/<size>-<format>/<hash[:2]>/<hash><ext>`, the hash being
+    the content hash of the original: copies of an image share one thumbnail, an edited image gets
+    a new one. Thumbnails are written atomically, so concurrent writers and interrupted runs never
+    leave a truncated file. They can be generated at ingest time with `generate`, or lazily by
+    `thumbnail` on first access.
+
+    Args:
+        cache_dir (`str`):
+            The directory holding the thumbnails.
+        size (`int`):
+            The maximum width and height of a thumbnail, the aspect ratio is kept.
+        format (`str`):
+            'WEBP' or 'JPEG'.
+        quality (`int`):
+            The encoder quality, 0-100.
+    """
+
+    def __init__(self, cache_dir: str, size: int = 256, format: str = 'WEBP', quality: int = 80):
+        format = format.upper()
+        if format not in EXTENSIONS:
+            raise ValueError('Unsupported thumbnail format %s, expected one of %s' % (format, list(EXTENSIONS)))
+        self.size = size
+        self.format = format
+        self.quality = quality
+        self.directory = os.path.join(cache_dir, '%d-%s' % (size, format.lower()))
+        os.makedirs(self.directory, exist_ok=True)
+        # path -> (mtime, size, thumbnail path), skips hashing the original on repeated access
+        self._known = {}
+        self._lock = threading.Lock()
+
+    def path_of(self, key: bytes) -> str:
+        name = key.hex()
+        return os.path.join(self.directory, name[:2], name + EXTENSIONS[self.format])
+
+    def thumbnail(self, path: str) -> str:
+        """
+        The path of the thumbnail of an image, generated on first access. Falls back to the
+        original when it cannot be decoded.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path
+        with self._lock:
+            known = self._known.get(path)
+        if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size) and os.path.exists(known[2]):
+            return known[2]
+
+        thumbnail_path = self.path_of(file_key(path))
+        if not os.path.exists(thumbnail_path):
+            try:
+                self._write(path, thumbnail_path)
+            except (OSError, ValueError) as e:
+                logger.warning('Failed to create the thumbnail of %s: %s', path, e)
+                return path
+        with self._lock:
+            self._known[path] = (stat.st_mtime_ns, stat.st_size, thumbnail_path)
+        return thumbnail_path
+
+    def thumbnails(self, paths, num_workers: int = 0) -> list:
+        """
+        The thumbnail paths of a list of images, in input order.
+        """
+        paths = list(paths)
+        if num_workers and len(paths) > 1:
+            # Pillow releases the GIL while decoding, resizing and encoding
+            with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='thumbnail') as executor:
+                return list(executor.map(self.thumbnail, paths))
+        return [self.thumbnail(path) for path in paths]
+
+    def generate(self, paths, num_workers: int = 4) -> int:
+        """
+        Create the missing thumbnails of a batch of images, e.g. at ingest time. Returns their number.
+        """
+        return len(self.thumbnails(paths, num_workers=num_workers))
+
+    def _write(self, path: str, thumbnail_path: str):
+        with Image.open(path) as img:
+            # Let the JPEG decoder downscale by DCT scaling, much cheaper than decoding the full image
+            img.draft('RGB', (self.size, self.size))
+            img = img.convert('RGB')
+            img.thumbnail((self.size, self.size), Image.BICUBIC)
+        directory = os.path.dirname(thumbnail_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(f, format=self.format, quality=self.quality)
+            os.replace(tmp_path, thumbnail_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -0,0 +1 @@
+from reverse_image_search.timing.timing import Timings, timed, timings
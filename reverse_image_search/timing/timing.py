@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+
+# Timings are only measured when this logger is enabled for DEBUG, e.g.
+# logging.getLogger('reverse_image_search.timing').setLevel(logging.DEBUG)
+logger = logging.getLogger('reverse_image_search.timing')
+
+
+class Timings:
+    """
+    Per-stage counters: number of calls, total seconds, max seconds and number of items (hits, vectors, ...).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage: str, seconds: float, items: int = 0):
+        with self._lock:
+            stat = self._stages.get(stage)
+            if stat is None:
+                stat = self._stages[stage] = [0, 0.0, 0.0, 0]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            stat[3] += items
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                stage: {'calls': calls, 'total_s': total, 'mean_ms': 1000 * total / calls, 'max_ms': 1000 * peak,
+                        'items': items}
+                for stage, (calls, total, peak, items) in self._stages.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+
+# Process wide registry fed by `timed`
+timings = Timings()
+
+
+class _Span:
+    __slots__ = ('stage', 'items', '_start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.items = 0
+
+    def set_items(self, items: int):
+        self.items = items
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self._start
+        timings.record(self.stage, elapsed, self.items)
+        logger.debug('%s took %.3f ms, %d items', self.stage, 1000 * elapsed, self.items)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set_items(self, items: int):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def timed(stage: str):
+    """
+    Time a block as `stage`, a no-op unless the timing logger is enabled for DEBUG:
+
+        with timed('network') as span:
+            res = coll.search(...)
+            span.set_items(len(res))
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        return _Span(stage)
+    return _NULL_SPAN
@@ -0,0 +1,77 @@
+import itertools
+import logging
+import os
+import random
+import time
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+def chunked(iterable, size: int):
+    """
+    Split an iterable (list, generator, ...) into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def document_id(path: str) -> str:
+    """
+    Derive a stable document id from an image path, so re-inserting an image overwrites its document.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, os.path.normpath(path)))
+
+
+def to_float_list(item) -> list:
+    """
+    Convert one vector (an array of any shape, e.g. (D,) or (1, D)) to a list of Python floats,
+    the format of the vector DB SDKs.
+    """
+    return _as_float_array(item).ravel().tolist()
+
+
+def to_float_lists(items) -> list:
+    """
+    Convert vectors to lists of Python floats: a 1-D array is a single vector, a 2-D array one
+    vector per row. Lists of float lists are returned as they are.
+
+    `ndarray.tolist` converts the whole array in C, there is no per-element Python call.
+    """
+    if isinstance(items, list) and (not items or isinstance(items[0], list)):
+        return items
+    array = _as_float_array(items)
+    return array.reshape(-1, array.shape[-1]).tolist()
+
+
+def _as_float_array(items):
+    array = np.asarray(items)
+    # float32 and float64 convert as they are, anything else (ints, float16) goes through float64
+    if array.dtype != np.float32 and array.dtype != np.float64:
+        array = array.astype(np.float64)
+    return array
+
+
+def retry_with_backoff(fn, *args, attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                       exceptions=(Exception,), **kwargs):
+    """
+    Call `fn(*args, **kwargs)`, on one of `exceptions` wait and call again, at most `attempts` times.
+    The delay doubles after every failure up to `max_delay`, with random jitter so concurrent
+    callers don't retry in lockstep. The last exception is raised.
+    """
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except exceptions as e:
+            if attempt + 1 >= attempts:
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            logger.warning('%s failed (attempt %d of %d), retrying in %.1fs: %s', getattr(fn, '__name__', fn),
+                           attempt + 1, attempts, delay, e)
+            time.sleep(delay)
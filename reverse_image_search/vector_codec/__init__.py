@@ -0,0 +1,6 @@
+from reverse_image_search.vector_codec.vector_codec import Float16Codec, ProductQuantizer, ScalarQuantizer, \
+    load_codec, make_codec
+
+
+def vector_codec(*args, **kwargs):
+    return make_codec(*args, **kwargs)
@@ -0,0 +1,243 @@
+import logging
+import re
+
+import numpy as np
+
+logger = logging.getLogger()
+
+
+def kmeans(vectors: 'ndarray', nlist: int, niter: int = 20, seed: int = 0) -> 'ndarray':
+    """
+    Lloyd's k-means, returns an (nlist, dim) float32 array of centroids.
+    Empty clusters are re-seeded from random training points.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(niter):
+        assign = assign_centroids(vectors, centroids)
+        counts = np.bincount(assign, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_centroids(vectors: 'ndarray', centroids: 'ndarray', block_size: int = 1 << 14) -> 'ndarray':
+    """
+    Index of the nearest centroid (L2) of every vector.
+    """
+    c_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        assign[start:start + len(block)] = np.argmin(c_norms[None, :] - 2 * block @ centroids.T, axis=1)
+    return assign
+
+
+class Float16Codec:
+    """
+    Half precision storage, 2 bytes per dimension and no training.
+    """
+
+    kind = 'float16'
+    dtype = np.float16
+    is_trained = True
+    min_train = 0
+
+    @property
+    def name(self) -> str:
+        return self.kind
+
+    def code_size(self, dim: int) -> int:
+        return dim
+
+    def train(self, vectors: 'ndarray'):
+        pass
+
+    def encode(self, vectors: 'ndarray') -> 'ndarray':
+        return np.asarray(vectors, dtype=np.float16)
+
+    def decode(self, codes: 'ndarray') -> 'ndarray':
+        return np.asarray(codes, dtype=np.float32)
+
+    def inner_products(self, queries: 'ndarray', codes: 'ndarray') -> 'ndarray':
+        """
+        Inner products of float32 queries (N, dim) with the B encoded vectors of `codes`, shape (N, B).
+        """
+        return queries @ codes.astype(np.float32).T
+
+    def save(self, path):
+        np.savez(path, kind=self.kind)
+
+    @classmethod
+    def from_arrays(cls, data):
+        return cls()
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension int8 scalar quantization, 1 byte per dimension.
+
+    Every dimension is mapped linearly from its [min, max] over the training vectors to 0..255.
+    Inner products are computed on the codes directly: q . x = (q * scale) . code + q . min.
+
+    Args:
+        min_train (`int`):
+            The number of vectors to wait for before training.
+    """
+
+    kind = 'sq8'
+    dtype = np.uint8
+
+    def __init__(self, min_train: int = 256):
+        self.min_train = min_train
+        self.vmin = None
+        self.scale = None
+
+    @property
+    def name(self) -> str:
+        return self.kind
+
+    @property
+    def is_trained(self) -> bool:
+        return self.vmin is not None
+
+    def code_size(self, dim: int) -> int:
+        return dim
+
+    def train(self, vectors: 'ndarray'):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.vmin = vectors.min(axis=0)
+        self.scale = np.maximum(vectors.max(axis=0) - self.vmin, np.finfo(np.float32).tiny) / 255
+
+    def encode(self, vectors: 'ndarray') -> 'ndarray':
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.vmin) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes: 'ndarray') -> 'ndarray':
+        return self.vmin + codes.astype(np.float32) * self.scale
+
+    def inner_products(self, queries: 'ndarray', codes: 'ndarray') -> 'ndarray':
+        return (queries * self.scale) @ codes.astype(np.float32).T + (queries @ self.vmin)[:, None]
+
+    def save(self, path):
+        np.savez(path, kind=self.kind, min_train=self.min_train, vmin=self.vmin, scale=self.scale)
+
+    @classmethod
+    def from_arrays(cls, data):
+        codec = cls(min_train=int(data['min_train']))
+        codec.vmin = data['vmin']
+        codec.scale = data['scale']
+        return codec
+
+
+class ProductQuantizer:
+    """
+    Product quantization: the vector is split into `m` sub-vectors, each replaced by the index of
+    its nearest centroid among 256 trained on that subspace, `m` bytes per vector.
+
+    Searches use asymmetric distance computation: the query stays float32, one (m, 256) table of
+    sub-vector inner products is computed per query and a code scores as the sum of its m entries.
+
+    Args:
+        m (`int`):
+            The number of sub-quantizers, must divide the dimension.
+        niter (`int`):
+            The number of k-means iterations per subspace.
+        min_train (`int`):
+            The number of vectors to wait for before training, at least 256.
+        max_train (`int`):
+            The maximum number of vectors sampled for training.
+    """
+
+    kind = 'pq'
+    dtype = np.uint8
+    ksub = 256
+
+    def __init__(self, m: int = 64, niter: int = 20, min_train: int = 256, max_train: int = 65536):
+        self.m = m
+        self.niter = niter
+        self.min_train = max(min_train, self.ksub)
+        self.max_train = max_train
+        # (m, 256, dim / m) centroids of every subspace
+        self.codebooks = None
+
+    @property
+    def name(self) -> str:
+        return '%s%d' % (self.kind, self.m)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.codebooks is not None
+
+    def code_size(self, dim: int) -> int:
+        return self.m
+
+    def _split(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[1] % self.m:
+            raise ValueError('PQ needs a dimension divisible by m=%d, got %d' % (self.m, vectors.shape[1]))
+        return vectors.reshape(len(vectors), self.m, -1)
+
+    def train(self, vectors: 'ndarray', seed: int = 0):
+        if len(vectors) > self.max_train:
+            vectors = vectors[np.sort(np.random.default_rng(seed).choice(len(vectors), self.max_train, replace=False))]
+        sub = self._split(vectors)
+        logger.info('Training %d PQ sub-quantizers on %d vectors', self.m, len(vectors))
+        self.codebooks = np.stack([kmeans(sub[:, j], self.ksub, self.niter, seed) for j in range(self.m)])
+
+    def encode(self, vectors: 'ndarray') -> 'ndarray':
+        sub = self._split(vectors)
+        codes = np.empty((len(sub), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign_centroids(sub[:, j], self.codebooks[j])
+        return codes
+
+    def decode(self, codes: 'ndarray') -> 'ndarray':
+        sub = self.codebooks[np.arange(self.m), codes]
+        return sub.reshape(len(codes), -1)
+
+    def inner_products(self, queries: 'ndarray', codes: 'ndarray') -> 'ndarray':
+        # (N, m, 256) tables, summed over the subspaces one code column at a time
+        tables = np.einsum('nmd,mkd->nmk', self._split(queries), self.codebooks)
+        products = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j in range(self.m):
+            products += tables[:, j, codes[:, j]]
+        return products
+
+    def save(self, path):
+        np.savez(path, kind=self.kind, m=self.m, niter=self.niter, min_train=self.min_train,
+                 max_train=self.max_train, codebooks=self.codebooks)
+
+    @classmethod
+    def from_arrays(cls, data):
+        codec = cls(m=int(data['m']), niter=int(data['niter']), min_train=int(data['min_train']),
+                    max_train=int(data['max_train']))
+        codec.codebooks = data['codebooks']
+        return codec
+
+
+CODEC_TYPES = {codec_type.kind: codec_type for codec_type in (Float16Codec, ScalarQuantizer, ProductQuantizer)}
+
+
+def make_codec(name: str):
+    """
+    Build a codec from its name: 'float16', 'sq8' or 'pq<m>' e.g. 'pq64'. 'float32' gives None.
+    """
+    if name in (None, '', 'float32'):
+        return None
+    match = re.fullmatch(r'pq(\d+)', name)
+    if match:
+        return ProductQuantizer(m=int(match.group(1)))
+    if name not in CODEC_TYPES:
+        raise ValueError('Unknown vector codec %s, expected float32, float16, sq8 or pq<m>' % name)
+    return CODEC_TYPES[name]()
+
+
+def load_codec(path: str):
+    with np.load(path) as data:
+        return CODEC_TYPES[str(data['kind'])].from_arrays(data)
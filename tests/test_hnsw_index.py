@@ -0,0 +1,39 @@
+import numpy as np
+
+from reverse_image_search.local_vector_store import HnswIndex, LocalVectorStore
+
+
+def _self_recall(store, vectors):
+    found = [rows[0][0] for rows in store.search_many(vectors, k=1)]
+    return found
+
+
+def test_overwritten_vectors_are_found(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((600, 16)).astype(np.float32)
+    paths = ['p%d' % i for i in range(len(vectors))]
+    store = LocalVectorStore(str(tmp_path), dim=16, index=HnswIndex(m=8, ef_construction=64, ef=64))
+    store.upsert_many(paths, vectors)
+
+    changed = rng.choice(len(vectors), 60, replace=False)
+    vectors[changed] = rng.standard_normal((len(changed), 16)).astype(np.float32)
+    store.upsert_many([paths[i] for i in changed], vectors[changed])
+
+    found = _self_recall(store, vectors[changed])
+    recall = np.mean([path == paths[i] for path, i in zip(found, changed)])
+    assert recall >= 0.95
+    # The untouched rows are still reachable
+    found = _self_recall(store, vectors[:100])
+    assert np.mean([path == paths[i] for i, path in enumerate(found)]) >= 0.95
+
+
+def test_overwriting_the_same_id_returns_it_once(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((100, 8)).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path), dim=8, index=HnswIndex(m=4, ef_construction=32))
+    store.upsert_many(['p%d' % i for i in range(len(vectors))], vectors)
+    for _ in range(3):
+        store.upsert_many(['p0'], vectors[:1])
+
+    paths = [path for path, _ in store.search(vectors[0], k=10)]
+    assert paths.count('p0') == 1
@@ -0,0 +1,36 @@
+import os
+
+from reverse_image_search.ingest_manifest import IngestManifest
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_diff_yields_new_and_changed_files(tmp_path):
+    paths = [_write(tmp_path / ('%d.jpg' % i), b'image %d' % i) for i in range(3)]
+    with IngestManifest(str(tmp_path / 'manifest.sqlite')) as manifest:
+        entries = list(manifest.diff(paths))
+        assert [entry.path for entry in entries] == paths
+        manifest.record(entries)
+        assert list(manifest.diff(paths)) == []
+
+        _write(paths[1], b'changed')
+        # Same content, only the mtime moved
+        os.utime(paths[2], ns=(0, 0))
+        assert [entry.path for entry in manifest.diff(paths)] == [paths[1]]
+        # Not recorded yet, the touched file was refreshed without being yielded
+        assert [entry.path for entry in manifest.diff(paths)] == [paths[1]]
+
+
+def test_removed_lists_the_files_not_seen(tmp_path):
+    paths = [_write(tmp_path / ('%d.jpg' % i), b'image %d' % i) for i in range(3)]
+    with IngestManifest(str(tmp_path / 'manifest.sqlite')) as manifest:
+        manifest.record(list(manifest.diff(paths)))
+        assert list(manifest.diff(paths[1:])) == []
+        removed = manifest.removed()
+        assert [entry.path for entry in removed] == [paths[0]]
+        manifest.forget(removed)
+        assert len(manifest) == 2
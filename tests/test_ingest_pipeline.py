@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+# The package also holds the model stages, which need torch
+pytest.importorskip('torch')
+pytest.importorskip('torchvision')
+
+from reverse_image_search.ingest_pipeline import IngestCheckpoint, IngestPipeline, Stage  # noqa: E402
+from reverse_image_search.ingest_pipeline.checkpoint import source_fingerprint, to_ranges  # noqa: E402
+
+
+def _stages(upsert, sink):
+    def double(items):
+        return [(row, value * 2) for row, value in items]
+
+    def store(items):
+        upsert(items)
+        sink.extend(items)
+        return [row for row, _ in items]
+
+    return [Stage('double', double, workers=2, batch_size=4), Stage('store', store, workers=2, batch_size=8)]
+
+
+def _recording(fn, checkpoint):
+    def store(items):
+        rows = fn(items)
+        checkpoint.record(rows)
+        return rows
+    return store
+
+
+def test_pipeline_runs_every_item_through_the_stages():
+    sink = []
+    stats = IngestPipeline(_stages(lambda items: None, sink), report_interval=None).run(enumerate(range(100)))
+    assert sorted(sink) == [(i, 2 * i) for i in range(100)]
+    assert stats['stages']['double']['items'] == 100
+    assert stats['stages']['store']['items'] == 100
+    assert stats['bottleneck'] in stats['stages']
+
+
+def test_failing_stage_stops_the_pipeline():
+    sink = []
+
+    def upsert(items):
+        if any(row >= 40 for row, _ in items):
+            raise ConnectionError('store unavailable')
+
+    produced = []
+
+    def items():
+        for i in range(100000):
+            produced.append(i)
+            yield i, i
+
+    with pytest.raises(ConnectionError):
+        IngestPipeline(_stages(upsert, sink), report_interval=None).run(items())
+    # The reader stopped too, the input was not consumed to the end
+    assert len(produced) < 100000
+    assert all(row < 40 for row, _ in sink)
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('ingest-')]
+
+
+def test_checkpoint_resumes_after_a_partial_run(tmp_path):
+    path = str(tmp_path / 'checkpoint.sqlite')
+    paths = ['img%d.jpg' % i for i in range(100)]
+    sink = []
+
+    def upsert_until(limit):
+        def upsert(items):
+            if any(row >= limit for row, _ in items):
+                raise ConnectionError('store unavailable')
+        return upsert
+
+    with IngestCheckpoint(path, source='src') as checkpoint:
+        stages = _stages(upsert_until(60), sink)
+        stages[-1].fn = _recording(stages[-1].fn, checkpoint)
+        with pytest.raises(ConnectionError):
+            IngestPipeline(stages, report_interval=None).run(checkpoint.pending(paths))
+    acked = {row for row, _ in sink}
+    assert acked and all(row < 60 for row in acked)
+
+    resumed = []
+    with IngestCheckpoint(path, source='src') as checkpoint:
+        assert len(checkpoint) == len(acked)
+        stages = _stages(upsert_until(len(paths)), resumed)
+        stages[-1].fn = _recording(stages[-1].fn, checkpoint)
+        IngestPipeline(stages, report_interval=None).run(checkpoint.pending(paths))
+    assert sorted(row for row, _ in resumed) == sorted(set(range(100)) - acked)
+
+    with IngestCheckpoint(path, source='src') as checkpoint:
+        assert len(checkpoint) == 100 and list(checkpoint.pending(paths)) == []
+    with pytest.raises(ValueError):
+        IngestCheckpoint(path, source='other')
+
+
+def test_to_ranges_and_fingerprint(tmp_path):
+    assert to_ranges([5, 1, 2, 3, 7]) == [[1, 4], [5, 6], [7, 8]]
+    for name in ('b.jpg', 'a.jpg'):
+        (tmp_path / name).write_bytes(b'x')
+    pattern = str(tmp_path / '*.jpg')
+    fingerprint = source_fingerprint(pattern)
+    (tmp_path / 'c.jpg').write_bytes(b'x')
+    assert source_fingerprint(pattern) != fingerprint
@@ -0,0 +1,30 @@
+import numpy as np
+
+from reverse_image_search.local_vector_store import IvfIndex, LocalVectorStore
+
+
+def test_upserting_the_same_id_returns_it_once(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.random((64, 8)).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path), dim=8, index=IvfIndex(nlist=4, nprobe=4, min_train=16))
+    store.upsert_many(['p%d' % i for i in range(len(vectors))], vectors)
+    for _ in range(3):
+        store.upsert_many(['p0'], vectors[:1])
+
+    paths = [path for path, _ in store.search(vectors[0], k=10)]
+    assert paths.count('p0') == 1
+    assert len(paths) == len(set(paths))
+
+
+def test_row_moving_back_to_its_bucket_is_listed_once(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.random((64, 8)).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path), dim=8, index=IvfIndex(nlist=4, nprobe=4, min_train=16))
+    store.upsert_many(['p%d' % i for i in range(len(vectors))], vectors)
+    # Move p0 to the bucket of a far away vector and back
+    far = int(np.argmin(vectors @ vectors[0]))
+    store.upsert_many(['p0'], vectors[far:far + 1])
+    store.upsert_many(['p0'], vectors[:1])
+
+    paths = [path for path, _ in store.search(vectors[0], k=64)]
+    assert paths.count('p0') == 1
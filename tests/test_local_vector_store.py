@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from reverse_image_search.local_vector_store import IvfIndex, LocalVectorStore
+from reverse_image_search.utils import document_id
+
+
+def test_unsupported_search_parameters_raise(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((64, 8)).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path / 'flat'), dim=8)
+    store.upsert_many(['p%d' % i for i in range(len(vectors))], vectors)
+    with pytest.raises(TypeError):
+        store.search(vectors[0], k=5, filter='label="goldfish"')
+    with pytest.raises(TypeError):
+        store.search(vectors[0], k=5, nprobe=4)
+
+    store = LocalVectorStore(str(tmp_path / 'ivf'), dim=8, index=IvfIndex(nlist=4, nprobe=1, min_train=16))
+    store.upsert_many(['p%d' % i for i in range(len(vectors))], vectors)
+    assert store.search(vectors[0], k=5, nprobe=4)[0][0] == 'p0'
+    with pytest.raises(TypeError):
+        store.search(vectors[0], k=5, ef=64)
+
+
+def _brute_force(vectors, queries, metric, k):
+    if metric == 'COSINE':
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        scores = queries @ vectors.T
+        order = np.argsort(-scores, axis=1)[:, :k]
+    else:
+        scores = ((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+        order = np.argsort(scores, axis=1)[:, :k]
+    return order, np.take_along_axis(scores, order, axis=1)
+
+
+@pytest.mark.parametrize('metric', ['COSINE', 'L2'])
+def test_search_matches_brute_force(tmp_path, metric):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((500, 8)).astype(np.float32)
+    queries = rng.standard_normal((10, 8)).astype(np.float32)
+    # Small blocks so the scan merges the top-k of several blocks
+    store = LocalVectorStore(str(tmp_path), dim=8, metric=metric, block_size=64)
+    store.upsert_many(['p%d' % i for i in range(len(vectors))], vectors)
+
+    order, scores = _brute_force(vectors, queries, metric, 5)
+    results = store.search_many(queries, k=5)
+    assert [[path for path, _ in rows] for rows in results] == [['p%d' % i for i in row] for row in order]
+    np.testing.assert_allclose([[score for _, score in rows] for rows in results], scores, rtol=1e-4, atol=1e-4)
+
+
+def test_delete_and_reopen(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((100, 8)).astype(np.float32)
+    paths = ['p%d' % i for i in range(len(vectors))]
+    store = LocalVectorStore(str(tmp_path), dim=8)
+    store.upsert_many(paths, vectors)
+    store.delete([document_id('p0')])
+    # Overwritten in place, the old vector must not be found any more
+    store.upsert('p1', vectors[2])
+    assert len(store) == 99
+    assert 'p0' not in [path for path, _ in store.search(vectors[0], k=10)]
+
+    reopened = LocalVectorStore(str(tmp_path), dim=8)
+    assert len(reopened) == 99
+    assert reopened.search(vectors[0], k=10) == store.search(vectors[0], k=10)
+    assert reopened.search(vectors[1], k=1)[0][0] != 'p1'
+    assert {path for path, _ in reopened.search(vectors[2], k=2)} == {'p1', 'p2'}
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+import pytest
+
+from reverse_image_search.micro_batcher import MicroBatcher
+
+
+def test_concurrent_calls_share_batches():
+    sizes = []
+    release = threading.Event()
+
+    def double(items):
+        sizes.append(len(items))
+        # Hold the first batch so the next calls queue up behind it
+        release.wait(5)
+        return [item * 2 for item in items]
+
+    with MicroBatcher(double, max_batch_size=8, max_delay=0.05) as batcher:
+        futures = [batcher.submit(i) for i in range(20)]
+        release.set()
+        assert [future.result(5) for future in futures] == [i * 2 for i in range(20)]
+    assert sum(sizes) == 20
+    assert max(sizes) == 8 and len(sizes) < 20
+
+
+def test_errors_reach_every_caller_of_the_batch():
+    def fail(items):
+        raise RuntimeError('model failed')
+
+    with MicroBatcher(fail, max_batch_size=4, max_delay=0.05) as batcher:
+        futures = [batcher.submit(i) for i in range(3)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match='model failed'):
+                future.result(5)
+
+
+def test_wrong_number_of_results_is_an_error():
+    with MicroBatcher(lambda items: [], max_batch_size=4, max_delay=0.05) as batcher:
+        with pytest.raises(ValueError):
+            batcher(1)
+
+
+def test_run_awaits_the_result():
+    async def main(batcher):
+        return await asyncio.gather(*(batcher.run(i) for i in range(5)))
+
+    with MicroBatcher(lambda items: [item + 1 for item in items], max_delay=0.01) as batcher:
+        assert asyncio.run(main(batcher)) == [1, 2, 3, 4, 5]
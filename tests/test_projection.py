@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from reverse_image_search.projection import PcaProjection, load_projection
+
+
+def _fitted(whiten=False):
+    rng = np.random.default_rng(0)
+    # Most of the variance in the first dimensions
+    vectors = rng.standard_normal((500, 16)).astype(np.float32) * np.linspace(10, 0.1, 16, dtype=np.float32)
+    return PcaProjection(dim=4, whiten=whiten).fit(vectors), vectors
+
+
+def test_transform_keeps_the_largest_components():
+    projection, vectors = _fitted(whiten=True)
+    projected = projection.transform(vectors)
+    assert projected.shape == (500, 4) and projected.dtype == np.float32
+    np.testing.assert_allclose(projected.std(axis=0, ddof=1), 1, rtol=1e-2)
+    assert projection.transform(vectors[0]).shape == (4,)
+    with pytest.raises(ValueError):
+        PcaProjection(dim=16).fit(vectors[:16])
+
+
+def test_save_and_load(tmp_path):
+    projection, vectors = _fitted()
+    path = str(tmp_path / 'projection.npz')
+    projection.save(path)
+    loaded = load_projection(path)
+    assert loaded.version == projection.version
+    np.testing.assert_array_equal(loaded.transform(vectors), projection.transform(vectors))
+
+
+def test_load_checks_the_version(tmp_path):
+    projection, _ = _fitted()
+    assert projection.version != _fitted(whiten=True)[0].version
+    path = str(tmp_path / 'projection.npz')
+    projection.save(path)
+    with np.load(path) as data:
+        arrays = dict(data)
+    # Parameters of another fit under the saved version
+    arrays['mean'] = arrays['mean'] + 1
+    np.savez(path, **arrays)
+    with pytest.raises(ValueError):
+        load_projection(path)
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import numpy as np
+
+from reverse_image_search.query_cache import LruCache, QueryCache
+
+
+class CountingClient:
+    """
+    Returns the first coordinate of each query as its only result and records the searched batches.
+    """
+
+    def __init__(self, gate: threading.Event = None):
+        self.version = 0
+        self.batches = []
+        self.gate = gate
+
+    def search(self, query, k):
+        return self.search_many(np.asarray(query)[None, :], k)[0]
+
+    def search_many(self, queries, k):
+        self.batches.append(len(queries))
+        if self.gate is not None:
+            self.gate.wait(5)
+        return [[['p%d' % int(query[0]), 1.0]] for query in queries]
+
+
+def test_search_many_sends_duplicates_once():
+    client = CountingClient()
+    cache = QueryCache(client)
+    queries = np.array([[1, 0], [2, 0], [1, 0], [2, 0], [3, 0]], dtype=np.float32)
+    results = cache.search_many(queries, k=1)
+    assert [rows[0][0] for rows in results] == ['p1', 'p2', 'p1', 'p2', 'p3']
+    assert client.batches == [3]
+    cache.search_many(queries, k=1)
+    assert client.batches == [3]
+
+
+def test_search_many_waits_for_concurrent_search():
+    gate = threading.Event()
+    client = CountingClient(gate)
+    cache = QueryCache(client)
+    query = np.array([1, 0], dtype=np.float32)
+    thread = threading.Thread(target=cache.search, args=(query, 1))
+    thread.start()
+    while not client.batches:
+        pass
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(cache.search_many(np.stack([query, query * 2]), k=1)))
+    waiter.start()
+    # The waiter sends only the second query, the first one is waited for
+    while len(client.batches) < 2:
+        pass
+    gate.set()
+    thread.join()
+    waiter.join()
+    assert [rows[0][0] for rows in results[0]] == ['p1', 'p2']
+    assert client.batches == [1, 1]
+
+
+def test_lru_cache_evicts_the_least_recently_used():
+    cache = LruCache(max_bytes=30)
+    for key in 'abc':
+        cache.put(key, key.upper(), 10)
+    cache.get('a')
+    cache.put('d', 'D', 10)
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == ['A', 'C', 'D']
+    assert cache.size == 30
+    # Larger than the whole cache, never stored
+    cache.put('e', 'E', 31)
+    assert cache.get('e') is None and len(cache) == 3
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = LruCache(max_bytes=100, ttl=10)
+    cache.put('a', 'A', 1)
+    now[0] += 9
+    assert cache.get('a') == 'A'
+    now[0] += 2
+    assert cache.get('a') is None
+    assert cache.size == 0 and cache.misses == 1
+
+
+def test_writes_invalidate_cached_results():
+    client = CountingClient()
+    cache = QueryCache(client)
+    query = np.array([1, 0], dtype=np.float32)
+    cache.search(query, k=1)
+    cache.search(query, k=1)
+    assert client.batches == [1]
+    # Another k or filter is another result
+    cache.search(query, k=2)
+    assert client.batches == [1, 1]
+    client.version += 1
+    cache.search(query, k=1)
+    assert client.batches == [1, 1, 1]
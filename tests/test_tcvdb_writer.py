@@ -0,0 +1,63 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tcvectordb')
+pytest.importorskip('requests')
+
+from reverse_image_search.tcvdb_client.tcvdb_client import TcvdbWriter  # noqa: E402
+
+
+class RecordingClient:
+    """
+    Stands in for `TcvdbClient`, records the upserted chunks and fails the first `fail` requests.
+    """
+
+    def __init__(self, fail: int = 0):
+        self.fail = fail
+        self.chunks = []
+        self.sent = threading.Event()
+
+    def upsert_data(self, documents):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError('tcvdb unavailable')
+        self.chunks.append(len(documents))
+        self.sent.set()
+
+
+def test_flush_on_size():
+    client = RecordingClient()
+    writer = TcvdbWriter(client, batch_size=3, max_delay=float('inf'))
+    for i in range(4):
+        writer.add('p%d' % i, np.ones(4))
+    assert client.chunks == [3]
+    writer.add_many(['q%d' % i for i in range(5)], np.ones((5, 4)))
+    assert client.chunks == [3, 3, 3]
+    writer.close()
+    assert client.chunks == [3, 3, 3]
+    writer.add('r', np.ones(4))
+    with writer:
+        pass
+    assert client.chunks == [3, 3, 3, 1]
+
+
+def test_flush_on_timer():
+    client = RecordingClient()
+    writer = TcvdbWriter(client, batch_size=100, max_delay=0.05)
+    writer.add_many(['p0', 'p1'], np.ones((2, 4)))
+    assert client.sent.wait(5)
+    assert client.chunks == [2]
+
+
+def test_failed_flush_is_retried_by_the_timer():
+    client = RecordingClient(fail=1)
+    writer = TcvdbWriter(client, batch_size=2, max_delay=0.05)
+    with pytest.raises(ConnectionError):
+        writer.add_many(['p0', 'p1', 'p2'], np.ones((3, 4)))
+    deadline = time.monotonic() + 5
+    while sum(client.chunks) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert client.chunks == [2, 1]
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from reverse_image_search import utils
+from reverse_image_search.utils import chunked, retry_with_backoff, to_float_list, to_float_lists
+
+
+def test_chunked():
+    assert list(chunked(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
+
+
+def test_to_float_lists():
+    array = np.arange(6, dtype=np.float32).reshape(2, 3)
+    assert to_float_lists(array) == [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]]
+    assert to_float_lists(array[0]) == [[0.0, 1.0, 2.0]]
+    assert to_float_lists(np.arange(3)) == [[0.0, 1.0, 2.0]]
+    assert all(type(v) is float for v in to_float_lists(array.astype(np.float16))[0])
+    lists = [[1.0, 2.0]]
+    assert to_float_lists(lists) is lists
+    assert to_float_list(array[:1]) == [0.0, 1.0, 2.0]
+
+
+def test_retry_with_backoff(monkeypatch):
+    delays = []
+    monkeypatch.setattr(utils.time, 'sleep', delays.append)
+    calls = []
+
+    def flaky(value, fail=2):
+        calls.append(value)
+        if len(calls) <= fail:
+            raise ConnectionError('down')
+        return value
+
+    assert retry_with_backoff(flaky, 'ok', base_delay=1.0, max_delay=1.5) == 'ok'
+    assert len(calls) == 3
+    assert 0.5 <= delays[0] <= 1.0 and 0.75 <= delays[1] <= 1.5
+
+    calls.clear()
+    with pytest.raises(ConnectionError):
+        retry_with_backoff(flaky, 'ok', fail=5, attempts=3)
+    assert len(calls) == 3
+    # Exceptions not listed are raised at once
+    calls.clear()
+    with pytest.raises(ConnectionError):
+        retry_with_backoff(flaky, 'ok', exceptions=(ValueError,))
+    assert len(calls) == 1
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from reverse_image_search.local_vector_store import LocalVectorStore
+from reverse_image_search.vector_codec import Float16Codec, ProductQuantizer, ScalarQuantizer, load_codec
+
+
+def _data(n=1000, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((n, dim)).astype(np.float32), rng.standard_normal((5, dim)).astype(np.float32)
+
+
+@pytest.mark.parametrize('codec, atol', [(Float16Codec(), 1e-2), (ScalarQuantizer(min_train=16), 5e-2)])
+def test_scalar_codecs_round_trip(codec, atol):
+    vectors, _ = _data()
+    codec.train(vectors)
+    codes = codec.encode(vectors)
+    assert codes.dtype == codec.dtype and codes.shape == (len(vectors), codec.code_size(16))
+    np.testing.assert_allclose(codec.decode(codes), vectors, atol=atol)
+
+
+@pytest.mark.parametrize('codec', [Float16Codec(), ScalarQuantizer(min_train=16), ProductQuantizer(m=4, niter=5)])
+def test_inner_products_score_the_decoded_vectors(codec, tmp_path):
+    vectors, queries = _data()
+    codec.train(vectors)
+    codes = codec.encode(vectors)
+    expected = queries @ codec.decode(codes).T
+    np.testing.assert_allclose(codec.inner_products(queries, codes), expected, rtol=1e-4, atol=1e-3)
+
+    codec.save(str(tmp_path / 'codec.npz'))
+    loaded = load_codec(str(tmp_path / 'codec.npz'))
+    np.testing.assert_array_equal(loaded.encode(vectors), codes)
+
+
+def test_pq_codes_are_m_bytes():
+    vectors, _ = _data()
+    pq = ProductQuantizer(m=4, niter=5)
+    pq.train(vectors)
+    assert pq.encode(vectors).shape == (len(vectors), 4)
+    with pytest.raises(ValueError):
+        pq.encode(vectors[:, :15])
+
+
+def test_rerank_restores_the_exact_order(tmp_path):
+    vectors, queries = _data()
+    paths = ['p%d' % i for i in range(len(vectors))]
+    exact = LocalVectorStore(str(tmp_path / 'exact'), dim=16)
+    exact.upsert_many(paths, vectors)
+    store = LocalVectorStore(str(tmp_path / 'pq'), dim=16, codec=ProductQuantizer(m=4, niter=5), rerank=200)
+    store.upsert_many(paths, vectors)
+    assert store.bytes_per_vector == 4
+
+    truth = [[path for path, _ in rows] for rows in exact.search_many(queries, k=5)]
+    reranked = [[path for path, _ in rows] for rows in store.search_many(queries, k=5)]
+    assert reranked == truth
+    # Without the rerank the PQ scores are approximate
+    _, scores = store.search_rows(queries, k=5, rerank=0)
+    _, exact_scores = store.search_rows(queries, k=5, exact=True)
+    assert not np.allclose(scores, exact_scores)